@@ -9,6 +9,11 @@ setup(
     packages=find_packages('src'),
     package_dir={'': 'src'},
     install_requires=requirements,
+    extras_require={
+        'parquet': ['pyarrow>=8.0.0'],
+        'evtx': ['python-evtx>=0.7.4'],
+        'test': ['pytest>=7.0.0'],
+    },
     entry_points={
         'console_scripts': [
             'eventlogcollector=latma.eventlogcollector:main',
@@ -0,0 +1,252 @@
+import csv
+import logging
+
+from latma.analyzer.authentications import Authentication, format_minute
+from latma.analyzer.baseline import Interner
+from latma.analyzer.detection import StreamingDetector
+from latma.sinks import OUTPUT_HEADER
+
+ALERT_EXPIRATION = 7 * 24 * 60
+EXPIRATION_INTERVAL = 60
+CREATED = 'created'
+JOINED = 'joined'
+MERGED = 'merged'
+PROPAGATION_FILE_NAME = "propagation.csv"
+PROPAGATION_HEADER = [*OUTPUT_HEADER, 'IoC', 'Alert', 'Action']
+# node keys of hosts are even and of accounts odd, so both share one disjoint set
+_HOST = 0
+_ACCOUNT = 1
+
+
+class Alert:
+    """
+    Connected hosts and accounts of suspicious edges, suspected to be part of the same lateral movement.
+    """
+
+    def __init__(self, alert_id, minute):
+        self.alert_id = alert_id
+        self.first_minute = minute
+        self.last_minute = minute
+        self.nodes = []
+        self.edge_count = 0
+
+
+class AlertGraph:
+    """
+    Incremental clustering of suspicious edges into alerts. Hosts and accounts are nodes of a disjoint set with union
+    by size and path compression, so a new edge creates, joins or merges alerts in near constant time. Alerts with no
+    new edge within the expiration window are expired, their hosts and accounts start new alerts afterwards.
+    """
+
+    def __init__(self, expiration=ALERT_EXPIRATION, hosts=None, accounts=None):
+        """
+        :param expiration: minutes without new edges after which an alert expires
+        :param hosts: Interner of host names, e.g. the one of the baseline, a new one by default
+        :param accounts: Interner of account names
+        """
+        self.expiration = expiration
+        self.hosts = hosts if hosts is not None else Interner()
+        self.accounts = accounts if accounts is not None else Interner()
+        # node key to slot, slots index parent and size and are recycled when their alert expires
+        self.slots = {}
+        self.parent = []
+        self.size = []
+        self.free_slots = []
+        # root slot to Alert
+        self.alerts = {}
+        self.alert_roots = {}
+        self.alert_count = 0
+        self.last_expiration = None
+
+    def _slot(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.parent[slot] = slot
+                self.size[slot] = 1
+            else:
+                slot = len(self.parent)
+                self.parent.append(slot)
+                self.size.append(1)
+            self.slots[key] = slot
+        return slot
+
+    def find(self, slot):
+        """
+        :return: root slot of the set of a slot, halving the path to it on the way.
+        """
+        parent = self.parent
+        while parent[slot] != slot:
+            parent[slot] = parent[parent[slot]]
+            slot = parent[slot]
+        return slot
+
+    def _union(self, first, second):
+        """
+        Join the sets of two roots, the larger set keeps its root.
+        :return: root of the joined set
+        """
+        if self.size[first] < self.size[second]:
+            first, second = second, first
+        self.parent[second] = first
+        self.size[first] += self.size[second]
+        return first
+
+    def add(self, authentication: Authentication):
+        """
+        Add a suspicious edge, creating a new alert, joining the alert of one of its hosts or account or merging the
+        alerts of several of them.
+        :return: tuple of (alert id, CREATED, JOINED or MERGED, list of the ids of the alerts merged into it)
+        """
+        minute = authentication.minute
+        if self.last_expiration is None:
+            self.last_expiration = minute
+        elif minute - self.last_expiration >= EXPIRATION_INTERVAL:
+            self.expire(minute)
+        keys = (self.hosts.intern(authentication.source) << 1 | _HOST,
+                self.hosts.intern(authentication.destination) << 1 | _HOST,
+                self.accounts.intern(authentication.username) << 1 | _ACCOUNT)
+        new_keys = [key for key in keys if key not in self.slots]
+        roots = list(dict.fromkeys(self.find(self.slots[key]) for key in keys if key in self.slots))
+
+        merged = []
+        if not roots:
+            action = CREATED
+            self.alert_count += 1
+            alert = Alert(self.alert_count, minute)
+            root = self._slot(new_keys[0])
+        else:
+            action = JOINED if len(roots) == 1 else MERGED
+            # the oldest alert keeps its id
+            roots.sort(key=lambda other: self.alerts[other].alert_id)
+            alert = self.alerts.pop(roots[0])
+            root = roots[0]
+            for other in roots[1:]:
+                other_alert = self.alerts.pop(other)
+                del self.alert_roots[other_alert.alert_id]
+                merged.append(other_alert.alert_id)
+                alert.nodes.extend(other_alert.nodes)
+                alert.edge_count += other_alert.edge_count
+                alert.first_minute = min(alert.first_minute, other_alert.first_minute)
+                root = self._union(root, other)
+        for key in new_keys:
+            slot = self._slot(key)
+            if slot != root:
+                root = self._union(root, slot)
+            alert.nodes.append(key)
+        alert.last_minute = max(alert.last_minute, minute)
+        alert.edge_count += 1
+        self.alerts[root] = alert
+        self.alert_roots[alert.alert_id] = root
+        return alert.alert_id, action, merged
+
+    def expire(self, minute):
+        """
+        Drop the alerts without new edges within the expiration window.
+        :return: list of the ids of the expired alerts
+        """
+        self.last_expiration = minute
+        expired = [root for root, alert in self.alerts.items() if minute - alert.last_minute > self.expiration]
+        expired_ids = []
+        for root in expired:
+            alert = self.alerts.pop(root)
+            del self.alert_roots[alert.alert_id]
+            for key in alert.nodes:
+                self.free_slots.append(self.slots.pop(key))
+            expired_ids.append(alert.alert_id)
+            logging.debug(f"Alert {alert.alert_id} expired after {alert.edge_count} edges")
+        return expired_ids
+
+    def _alert_of(self, key):
+        slot = self.slots.get(key)
+        return self.alerts[self.find(slot)] if slot is not None else None
+
+    def host_alert(self, host):
+        """
+        :return: active Alert of a host, None if the host is in no alert.
+        """
+        host_id = self.hosts.get(host)
+        return self._alert_of(host_id << 1 | _HOST) if host_id is not None else None
+
+    def account_alert(self, username):
+        """
+        :return: active Alert of an account, None if the account is in no alert.
+        """
+        account_id = self.accounts.get(username)
+        return self._alert_of(account_id << 1 | _ACCOUNT) if account_id is not None else None
+
+    def members(self, alert_id):
+        """
+        :return: tuple of (host names, account names) of an active alert, None if it expired or was merged.
+        """
+        root = self.alert_roots.get(alert_id)
+        if root is None:
+            return None
+        nodes = self.alerts[root].nodes
+        return ([self.hosts.name(key >> 1) for key in nodes if key & 1 == _HOST],
+                [self.accounts.name(key >> 1) for key in nodes if key & 1 == _ACCOUNT])
+
+
+class PropagationTracker:
+    """
+    Streams authentications through the baseline, the IoC detection and the alert graph, and turns every edge that
+    completes an IoC into a propagation row as soon as it is detected.
+    """
+
+    def __init__(self, detector=None, alert_graph=None):
+        """
+        :param detector: StreamingDetector, a new one by default
+        :param alert_graph: AlertGraph, by default a new one sharing the names interned by the detector baseline
+        """
+        self.detector = detector or StreamingDetector()
+        baseline = self.detector.baseline
+        self.alert_graph = alert_graph or AlertGraph(hosts=baseline.hosts, accounts=baseline.accounts)
+        # edge id to (alert id, action, IoCs it was already reported with), an edge is added to the alert graph once
+        self.reported = {}
+
+    def process(self, authentication: Authentication):
+        """
+        :param authentication: next Authentication of the collector output
+        :return: list of propagation rows, in the PROPAGATION_HEADER order
+        """
+        rows = []
+        for detection in self.detector.process(authentication):
+            for edge_id in detection.edges:
+                edge = self.detector.edge(edge_id)
+                reported = self.reported.get(edge_id)
+                if reported is None:
+                    alert_id, action, _ = self.alert_graph.add(edge)
+                    reported = self.reported[edge_id] = (alert_id, action, set())
+                alert_id, action, iocs = reported
+                if detection.ioc in iocs:
+                    continue
+                iocs.add(detection.ioc)
+                rows.append([edge.username, edge.source, edge.destination, edge.spn, format_minute(edge.minute),
+                             edge.auth_type, detection.ioc, alert_id, action])
+        if len(self.reported) > len(self.detector.edges):
+            # edges the detector evicted can't be part of new detections
+            self.reported = {edge_id: reported for edge_id, reported in self.reported.items()
+                             if edge_id in self.detector.edges}
+        return rows
+
+
+def write_propagation(authentications, output_path=PROPAGATION_FILE_NAME):
+    """
+    Detect the lateral movement in a stream of authentications and write the propagation rows as they are detected.
+    :param authentications: iterable of Authentication in time order, e.g. from read_authentications
+    :param output_path: propagation csv path
+    :return: amount of rows written
+    """
+    tracker = PropagationTracker()
+    rows_written = 0
+    with open(output_path, 'w', newline='', encoding='utf-8') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(PROPAGATION_HEADER)
+        for authentication in authentications:
+            rows = tracker.process(authentication)
+            if rows:
+                writer.writerows(rows)
+                rows_written += len(rows)
+    logging.info(f"Wrote {rows_written} propagation rows in {tracker.alert_graph.alert_count} alerts to {output_path}")
+    return rows_written
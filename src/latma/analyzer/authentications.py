@@ -0,0 +1,99 @@
+import csv
+import gzip
+from datetime import date
+from functools import lru_cache
+from typing import NamedTuple
+
+from latma.records import NO_TIMESTAMP, RecordStore
+from latma.sinks import COUNT_COLUMN, OUTPUT_HEADER, RecordStoreSink
+
+MINUTES_PER_DAY = 24 * 60
+RECORD_STORE_CHUNK_SIZE = 100 * 1000
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+USERNAME, SOURCE, DESTINATION, SPN, TIMESTAMP, AUTH_TYPE = OUTPUT_HEADER
+
+
+class Authentication(NamedTuple):
+    username: str
+    source: str
+    destination: str
+    spn: str
+    minute: int
+    auth_type: str
+    count: int = 1
+
+    @property
+    def day(self):
+        return self.minute // MINUTES_PER_DAY
+
+
+@lru_cache(maxsize=4096)
+def _day_of(date_string):
+    day, month, year = date_string.split('/')
+    return date(int(year), int(month), int(day)).toordinal() - _EPOCH_ORDINAL
+
+
+def parse_timestamp(timestamp):
+    """
+    Convert a collector output timestamp to minutes since the epoch.
+    :param timestamp: timestamp in the collector output format, e.g. 01/05/2022 10:11
+    :return: minutes since 01/01/1970 00:00
+    """
+    return _day_of(timestamp[:10]) * MINUTES_PER_DAY + int(timestamp[11:13]) * 60 + int(timestamp[14:16])
+
+
+def format_minute(minute):
+    """
+    Convert minutes since the epoch back to the collector output timestamp format.
+    """
+    day, minute_of_day = divmod(minute, MINUTES_PER_DAY)
+    return f"{date.fromordinal(day + _EPOCH_ORDINAL).strftime('%d/%m/%Y')} " \
+           f"{minute_of_day // 60:02d}:{minute_of_day % 60:02d}"
+
+
+def read_authentications(path):
+    """
+    Stream the authentications of a collector output file, csv, gzip compressed csv or a record store, plain or
+    aggregated.
+    :param path: collector output file path
+    :return: generator of Authentication
+    """
+    if path.rstrip('/\\').endswith(RecordStoreSink.extension):
+        yield from _read_record_store(path)
+        return
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='', encoding='utf-8') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = [header.index(column) for column in OUTPUT_HEADER]
+        count_index = header.index(COUNT_COLUMN) if COUNT_COLUMN in header else None
+        for row in reader:
+            if not row:
+                continue
+            username, source, destination, spn, timestamp, auth_type = (row[i] for i in columns)
+            if not timestamp:
+                continue
+            yield Authentication(username, source, destination, spn, parse_timestamp(timestamp), auth_type,
+                                 int(row[count_index]) if count_index is not None else 1)
+
+
+def _read_record_store(path):
+    """
+    Stream the authentications of a record store, timestamps are already stored as numbers and need no parsing.
+    """
+    store = RecordStore(path)
+    string_columns = [(store.column(column), store.values(column))
+                      for column in (USERNAME, SOURCE, DESTINATION, SPN, AUTH_TYPE)]
+    timestamps = store.column(TIMESTAMP)
+    counts = store.column(COUNT_COLUMN) if COUNT_COLUMN in store.header else None
+    for start in range(0, len(store), RECORD_STORE_CHUNK_SIZE):
+        stop = start + RECORD_STORE_CHUNK_SIZE
+        username, source, destination, spn, auth_type = ([values[code] for code in codes[start:stop].tolist()]
+                                                         for codes, values in string_columns)
+        seconds = timestamps[start:stop].tolist()
+        count = counts[start:stop].tolist() if counts is not None else [1] * len(seconds)
+        for row in zip(username, source, destination, spn, seconds, auth_type, count):
+            if row[4] != NO_TIMESTAMP:
+                yield Authentication(row[0], row[1], row[2], row[3], row[4] // 60, row[5], row[6])
@@ -0,0 +1,195 @@
+SINK_ACCOUNTS = 50
+HUB_ACCOUNTS = 20
+MATCH_DAYS = 3
+WINDOW_DAYS = 21
+BENIGN_SINK = 'sink'
+BENIGN_HUB = 'hub'
+BENIGN_MATCH = 'match'
+_PAIR_SHIFT = 32
+
+
+class Interner:
+    """
+    Maps names to dense integer ids, so profiles hold small ints instead of strings.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def intern(self, name):
+        """
+        :return: id of the name, a new id if it was never seen.
+        """
+        name_id = self.ids.get(name)
+        if name_id is None:
+            name_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def get(self, name):
+        """
+        :return: id of the name, None if it was never seen.
+        """
+        return self.ids.get(name)
+
+    def name(self, name_id):
+        return self.names[name_id]
+
+    def __len__(self):
+        return len(self.names)
+
+
+def _touch(profiles, host, account, day, capacity):
+    """
+    Record an account seen on a host. A host keeps only the capacity accounts seen most recently, ordered from the
+    least recently seen, which is enough to tell if capacity different accounts were seen within the window.
+    """
+    accounts = profiles.get(host)
+    if accounts is None:
+        profiles[host] = {account: day}
+        return
+    last_day = accounts.pop(account, None)
+    accounts[account] = day if last_day is None or day > last_day else last_day
+    if len(accounts) > capacity:
+        del accounts[next(iter(accounts))]
+
+
+def _trim(profiles, window_start):
+    for host in list(profiles):
+        accounts = profiles[host]
+        if next(reversed(accounts.values())) < window_start:
+            del profiles[host]
+            continue
+        while next(iter(accounts.values())) < window_start:
+            del accounts[next(iter(accounts))]
+
+
+class Baseline:
+    """
+    Incremental learning phase of the LATMA algorithm over a stream of authentications.
+    Sinks are hosts accessed by at least sink_accounts different accounts, hubs are hosts at least hub_accounts
+    different accounts authenticate from, and an account matches a machine it authenticated from on at least match_days
+    different days. All profiles cover the last window_days days, older data is evicted as the stream advances.
+    Authentications are expected roughly in time order, as written by the collector.
+    """
+
+    def __init__(self, sink_accounts=SINK_ACCOUNTS, hub_accounts=HUB_ACCOUNTS, match_days=MATCH_DAYS,
+                 window_days=WINDOW_DAYS):
+        self.sink_accounts = sink_accounts
+        self.hub_accounts = hub_accounts
+        self.match_days = match_days
+        self.window_days = window_days
+        self.window_mask = (1 << window_days) - 1
+        self.accounts = Interner()
+        self.hosts = Interner()
+        # host id to {account id: last day seen}
+        self.destination_accounts = {}
+        self.source_accounts = {}
+        # account id << 32 | source host id to last day seen << window_days | bitmap of the days seen before it
+        self.pair_days = {}
+        self.first_day = None
+        self.current_day = None
+
+    def learn(self, username, source, destination, day):
+        """
+        Add an authentication to the profiles.
+        :param username: authenticating account
+        :param source: host the account authenticated from
+        :param destination: host the account authenticated to
+        :param day: days since the epoch of the authentication
+        """
+        if self.current_day is None:
+            self.first_day = self.current_day = day
+        elif day > self.current_day:
+            self.current_day = day
+            self._evict()
+        account = self.accounts.intern(username)
+        source_id = self.hosts.intern(source)
+        _touch(self.destination_accounts, self.hosts.intern(destination), account, day, self.sink_accounts)
+        _touch(self.source_accounts, source_id, account, day, self.hub_accounts)
+
+        pair = account << _PAIR_SHIFT | source_id
+        packed = self.pair_days.get(pair)
+        if packed is None:
+            self.pair_days[pair] = day << self.window_days | 1
+            return
+        last_day, days = packed >> self.window_days, packed & self.window_mask
+        if day > last_day:
+            days = (days << (day - last_day) | 1) & self.window_mask if day - last_day < self.window_days else 1
+            last_day = day
+        elif last_day - day < self.window_days:
+            days |= 1 << (last_day - day)
+        self.pair_days[pair] = last_day << self.window_days | days
+
+    def _evict(self):
+        window_start = self.current_day - self.window_days + 1
+        self.pair_days = {pair: packed for pair, packed in self.pair_days.items()
+                          if packed >> self.window_days >= window_start}
+        _trim(self.destination_accounts, window_start)
+        _trim(self.source_accounts, window_start)
+
+    def _window_start(self, day):
+        return max(day, self.current_day or day) - self.window_days + 1
+
+    def is_sink(self, host, day=None):
+        """
+        :param host: host name
+        :param day: days since the epoch to classify at, default is the latest day learned
+        """
+        return self._has_accounts(self.destination_accounts, self.hosts.get(host), self.sink_accounts, day)
+
+    def is_hub(self, host, day=None):
+        return self._has_accounts(self.source_accounts, self.hosts.get(host), self.hub_accounts, day)
+
+    def _has_accounts(self, profiles, host, capacity, day):
+        accounts = profiles.get(host)
+        if accounts is None or len(accounts) < capacity:
+            return False
+        return next(iter(accounts.values())) >= self._window_start(day if day is not None else self.current_day)
+
+    def is_match(self, username, source, day=None):
+        """
+        :return: True if the account authenticated from the source host on enough different days within the window.
+        """
+        account, source_id = self.accounts.get(username), self.hosts.get(source)
+        if account is None or source_id is None:
+            return False
+        packed = self.pair_days.get(account << _PAIR_SHIFT | source_id)
+        if packed is None:
+            return False
+        day = self.current_day if day is None else day
+        age = max(day - (packed >> self.window_days), 0)
+        if age >= self.window_days:
+            return False
+        days = packed & self.window_mask & ((1 << (self.window_days - age)) - 1)
+        return bin(days).count('1') >= self.match_days
+
+    def benign_reason(self, username, source, destination, day=None):
+        """
+        Check if an authentication is explained by the learned behavior.
+        :return: BENIGN_SINK, BENIGN_HUB or BENIGN_MATCH, None if the authentication is not benign.
+        """
+        if self.is_sink(destination, day):
+            return BENIGN_SINK
+        if self.is_hub(source, day):
+            return BENIGN_HUB
+        if self.is_match(username, source, day):
+            return BENIGN_MATCH
+        return None
+
+    def is_benign(self, username, source, destination, day=None):
+        return self.benign_reason(username, source, destination, day) is not None
+
+    def in_learning_period(self, day):
+        """
+        :return: True during the first window_days days of the stream, when no alerts are raised.
+        """
+        return self.first_day is None or day - self.first_day < self.window_days
+
+    def size(self):
+        """
+        :return: dict of the amount of entries in every profile.
+        """
+        return {'accounts': len(self.accounts), 'hosts': len(self.hosts), 'destinations': len(self.destination_accounts),
+                'sources': len(self.source_accounts), 'pairs': len(self.pair_days)}
@@ -0,0 +1,409 @@
+from collections import deque
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from latma.analyzer.authentications import Authentication
+from latma.analyzer.baseline import Baseline
+from latma.event_parser import KERBEROS, NTLM
+from latma.filters import RELEVANT_SERVICES
+
+WHITE_CANE_DESTINATIONS = 5
+WHITE_CANE_WINDOW = 60
+BLAST_DESTINATIONS = 10
+BLAST_WINDOW = 5
+BRIDGE_WINDOW = 24 * 60
+WEIGHT_SHIFT_WINDOW = 24 * 60
+EVICT_INTERVAL = 60
+WHITE_CANE = 'White Cane'
+BLAST = 'Blast'
+BRIDGE = 'Bridge'
+SWITCHED_BRIDGE = 'Switched Bridge'
+WEIGHT_SHIFT = 'Weight Shift'
+EDGE_COLUMNS = list(Authentication._fields)
+
+
+class Detection(NamedTuple):
+    ioc: str
+    minute: int
+    edges: tuple
+
+
+def is_relevant(authentication: Authentication):
+    """
+    :return: True for the authentications kept in the authentication graph, NTLM and Kerberos to rpc, rpcss or
+             termsrv services.
+    """
+    if authentication.source == authentication.destination:
+        return False
+    if authentication.auth_type == NTLM:
+        return True
+    return authentication.auth_type == KERBEROS and \
+        authentication.spn.split('/', 1)[0] in RELEVANT_SERVICES
+
+
+def filter_edges(authentications, baseline: Baseline):
+    """
+    Learn every authentication and keep the authentication graph edges, relevant authentications that are not
+    explained by the baseline, after its learning period.
+    :param authentications: iterable of Authentication in time order
+    :param baseline: Baseline learning the stream
+    :return: generator of Authentication
+    """
+    for authentication in authentications:
+        day = authentication.day
+        baseline.learn(authentication.username, authentication.source, authentication.destination, day)
+        if not is_relevant(authentication) or baseline.in_learning_period(day):
+            continue
+        if not baseline.is_benign(authentication.username, authentication.source, authentication.destination, day):
+            yield authentication
+
+
+def edge_frame(edges):
+    """
+    Build a frame of authentication graph edges, row positions are the edge ids of batch detection.
+    :param edges: iterable of Authentication
+    """
+    frame = pd.DataFrame.from_records(edges, columns=EDGE_COLUMNS)
+    for column in ('username', 'source', 'destination', 'spn', 'auth_type'):
+        frame[column] = frame[column].astype('category')
+    return frame
+
+
+class _FanOut:
+    """
+    Distinct destinations each (account, source) reached within a sliding window.
+    """
+
+    def __init__(self, window, threshold):
+        self.window = window
+        self.threshold = threshold
+        self.edges = {}
+        self.counts = {}
+        self.bursts = {}
+
+    def add(self, key, minute, destination, edge_id):
+        """
+        :return: tuple of (edge ids, True if the burst starts with this edge). Once the fan-out reached the threshold
+                 the edge ids are the whole window, and the first edge of the burst with the new edge after that.
+                 None below the threshold.
+        """
+        edges = self.edges.get(key)
+        if edges is None:
+            edges = self.edges[key] = deque()
+            self.counts[key] = {}
+        counts = self.counts[key]
+        self._expire(key, minute)
+        edges.append((minute, destination, edge_id))
+        counts[destination] = counts.get(destination, 0) + 1
+        if len(counts) < self.threshold:
+            self.bursts.pop(key, None)
+            return None
+        first_edge = self.bursts.get(key)
+        if first_edge is None:
+            self.bursts[key] = edges[0][2]
+            return [window_edge_id for _, _, window_edge_id in edges], True
+        return [first_edge, edge_id], False
+
+    def window_edges(self, key):
+        """
+        :return: (minute, destination, edge id) of the edges of a fan-out within the window.
+        """
+        return self.edges[key]
+
+    def _expire(self, key, minute):
+        edges, counts = self.edges[key], self.counts[key]
+        while edges and edges[0][0] <= minute - self.window:
+            _, destination, _ = edges.popleft()
+            counts[destination] -= 1
+            if not counts[destination]:
+                del counts[destination]
+
+    def evict(self, minute):
+        for key in list(self.edges):
+            self._expire(key, minute)
+            if not self.edges[key]:
+                del self.edges[key], self.counts[key]
+                self.bursts.pop(key, None)
+
+
+class StreamingDetector:
+    """
+    Detects the lateral movement IoCs one authentication at a time. Edges are kept in time indexed structures
+    covering the IoC windows only, so every edge is checked against a bounded amount of earlier edges.
+    """
+
+    def __init__(self, baseline=None):
+        """
+        :param baseline: Baseline learning the stream, a new one by default
+        """
+        self.baseline = baseline or Baseline()
+        self.white_canes = _FanOut(WHITE_CANE_WINDOW, WHITE_CANE_DESTINATIONS)
+        self.blasts = _FanOut(BLAST_WINDOW, BLAST_DESTINATIONS)
+        # destination to {(account, source): (minute, edge id)} ordered from the oldest edge
+        self.in_edges = {}
+        # host to (minute, edge id) of the last white cane edge into it
+        self.white_cane_destinations = {}
+        self.edges = {}
+        self.edge_count = 0
+        self.last_eviction = None
+
+    def edge(self, edge_id):
+        """
+        :return: Authentication of a recent edge.
+        """
+        return self.edges[edge_id]
+
+    def process(self, authentication: Authentication):
+        """
+        Learn an authentication and detect the IoCs it completes.
+        :param authentication: next Authentication of the stream
+        :return: list of Detection
+        """
+        edges = filter_edges((authentication,), self.baseline)
+        if next(edges, None) is None:
+            return []
+        edge_id = self.edge_count
+        self.edge_count += 1
+        self.edges[edge_id] = authentication
+        minute = authentication.minute
+        if self.last_eviction is None:
+            self.last_eviction = minute
+        elif minute - self.last_eviction >= EVICT_INTERVAL:
+            self._evict(minute)
+
+        detections = self._bridges(authentication, edge_id)
+        fan_out_key = (authentication.username, authentication.source)
+        blast = self.blasts.add(fan_out_key, minute, authentication.destination, edge_id)
+        if blast is not None:
+            detections.append(Detection(BLAST, minute, tuple(blast[0])))
+        white_cane = self.white_canes.add(fan_out_key, minute, authentication.destination, edge_id)
+        if white_cane is not None:
+            white_cane_edges, burst_started = white_cane
+            detections.append(Detection(WHITE_CANE, minute, tuple(white_cane_edges)))
+            if burst_started:
+                detections.extend(self._weight_shift(authentication, white_cane_edges))
+                for window_minute, destination, window_edge_id in self.white_canes.window_edges(fan_out_key):
+                    self.white_cane_destinations[destination] = (window_minute, window_edge_id)
+            else:
+                self.white_cane_destinations[authentication.destination] = (minute, edge_id)
+
+        in_edges = self.in_edges.setdefault(authentication.destination, {})
+        in_edges.pop((authentication.username, authentication.source), None)
+        in_edges[(authentication.username, authentication.source)] = (minute, edge_id)
+        return detections
+
+    def _bridges(self, authentication, edge_id):
+        """
+        Pair an edge out of B with the latest edge into B within the bridge window, of the same account for a Bridge
+        and of another account for a Switched Bridge.
+        """
+        detections = []
+        bridge = switched_bridge = None
+        for (account, source), (minute, in_edge_id) in reversed(self.in_edges.get(authentication.source, {}).items()):
+            if authentication.minute - minute > BRIDGE_WINDOW:
+                break
+            if source == authentication.destination:
+                continue
+            if account == authentication.username:
+                bridge = bridge or in_edge_id
+            else:
+                switched_bridge = switched_bridge or in_edge_id
+            if bridge is not None and switched_bridge is not None:
+                break
+        if bridge is not None:
+            detections.append(Detection(BRIDGE, authentication.minute, (bridge, edge_id)))
+        if switched_bridge is not None:
+            detections.append(Detection(SWITCHED_BRIDGE, authentication.minute, (switched_bridge, edge_id)))
+        return detections
+
+    def _weight_shift(self, authentication, white_cane_edges):
+        """
+        Pair a white cane from B with an earlier white cane edge into B within the weight shift window.
+        """
+        previous = self.white_cane_destinations.get(authentication.source)
+        if previous is None or authentication.minute - previous[0] > WEIGHT_SHIFT_WINDOW:
+            return []
+        return [Detection(WEIGHT_SHIFT, authentication.minute, (previous[1], *white_cane_edges))]
+
+    def _evict(self, minute):
+        self.last_eviction = minute
+        self.white_canes.evict(minute)
+        self.blasts.evict(minute)
+        for destination in list(self.in_edges):
+            in_edges = self.in_edges[destination]
+            while in_edges and minute - next(iter(in_edges.values()))[0] > BRIDGE_WINDOW:
+                del in_edges[next(iter(in_edges))]
+            if not in_edges:
+                del self.in_edges[destination]
+        self.white_cane_destinations = {host: edge for host, edge in self.white_cane_destinations.items()
+                                        if minute - edge[0] <= WEIGHT_SHIFT_WINDOW}
+        oldest = minute - max(BRIDGE_WINDOW, WEIGHT_SHIFT_WINDOW, WHITE_CANE_WINDOW)
+        self.edges = {edge_id: edge for edge_id, edge in self.edges.items() if edge.minute >= oldest}
+
+
+def _fan_outs(group, destination, minute, window, threshold):
+    """
+    Find the fan-outs reaching threshold distinct destinations within a sliding window, vectorized, as the streaming
+    detector reports them. Every occurrence of a destination keeps it in the window of its group until the window passes
+    or the destination occurs again, so the distinct destinations at an edge are the occurrence intervals covering it.
+    A fan-out starts at the edge reaching the threshold with the edges of its window, and goes on with the following
+    edges of its group as long as they keep the threshold.
+    :param group: int array of (account, source) codes, sorted by group and stream position together with the other
+                  arrays
+    :param destination: int array of destination codes
+    :param minute: int array of minutes relative to the first edge
+    :return: tuple of int arrays of the index of the first window edge, the starting edge and the end of every fan-out
+    """
+    count = len(group)
+    index = np.arange(count)
+    span = int(minute.max()) + window + 1
+    keys = group * span + minute
+    window_end = np.searchsorted(keys, keys + window, 'left')
+    by_destination = np.lexsort((index, destination, group))
+    next_occurrence = np.full(count, count)
+    sorted_group, sorted_destination = group[by_destination], destination[by_destination]
+    same = (sorted_group[1:] == sorted_group[:-1]) & (sorted_destination[1:] == sorted_destination[:-1])
+    next_occurrence[by_destination[:-1][same]] = by_destination[1:][same]
+    distinct = index + 1 - np.searchsorted(np.sort(np.minimum(window_end, next_occurrence)), index, 'right')
+
+    reached = distinct >= threshold
+    continued = np.zeros(count, dtype=bool)
+    continued[1:] = reached[1:] & reached[:-1] & (group[1:] == group[:-1])
+    starts = np.flatnonzero(reached & ~continued)
+    stops = np.flatnonzero(reached & ~np.append(continued[1:], False)) + 1
+    firsts = np.searchsorted(keys, keys[starts] - window, 'right')
+    return firsts, starts, stops
+
+
+def _latest_predecessors(in_groups, in_positions, in_minutes, out_groups, out_positions, out_minutes, window,
+                         excluded=()):
+    """
+    Find for every out edge the latest in edge of the same group before it in the stream and within the window, whose
+    excluded values all differ from the ones of the out edge. A disqualified in edge is skipped with the whole run of
+    in edges before it repeating its excluded value, so every lookup is a few binary searches and jumps.
+    :param in_positions: int array of the stream positions of the in edges, out edges only pair with earlier ones
+    :param excluded: list of (in values, out values) int array pairs, the in minutes must follow the in positions to
+                     exclude values, skipping stops at the first in edge out of the window
+    :return: int array of the position of the predecessor of every out edge in the in arrays, -1 if it has none
+    """
+    order = np.lexsort((in_positions, in_groups))
+    groups, minutes = in_groups[order], in_minutes[order]
+    span = int(max(in_positions.max(), out_positions.max())) + 1
+    position = np.searchsorted(groups * span + in_positions[order], out_groups * span + out_positions, 'left') - 1
+    found = position >= 0
+    found[found] &= groups[position[found]] == out_groups[found]
+
+    runs = []
+    for in_values, out_values in excluded:
+        values = in_values[order]
+        change = np.ones(len(groups), dtype=bool)
+        change[1:] = (groups[1:] != groups[:-1]) | (values[1:] != values[:-1])
+        runs.append((values, out_values, np.maximum.accumulate(np.where(change, np.arange(len(groups)), 0))))
+    pending = np.flatnonzero(found)
+    while len(pending) and runs:
+        candidates = position[pending]
+        run_start = candidates + 1
+        for values, out_values, starts in runs:
+            repeat = values[candidates] == out_values[pending]
+            run_start[repeat] = np.minimum(run_start[repeat], starts[candidates[repeat]])
+        repeat = run_start <= candidates
+        pending = pending[repeat]
+        position[pending] = run_start[repeat] - 1
+        valid = position[pending] >= 0
+        valid[valid] = groups[position[pending[valid]]] == out_groups[pending[valid]]
+        valid[valid] = out_minutes[pending[valid]] - minutes[position[pending[valid]]] <= window
+        found[pending[~valid]] = False
+        pending = pending[valid]
+
+    found[found] &= out_minutes[found] - minutes[position[found]] <= window
+    return np.where(found, order[np.maximum(position, 0)], -1)
+
+
+def _batch_bridges(username, source, destination, minute, edge_ids):
+    """
+    Pair every edge out of B with the latest earlier edge into B within the bridge window, coming from another host
+    than the edge destination, of the same account for a Bridge and of another account for a Switched Bridge.
+    """
+    detections = []
+    positions = np.arange(len(minute))
+    account_count = int(username.max()) + 1
+    pair_codes, _ = pd.factorize(np.concatenate([destination * account_count + username,
+                                                 source * account_count + username]))
+    predecessors = _latest_predecessors(pair_codes[:len(minute)], positions, minute, pair_codes[len(minute):],
+                                        positions, minute, BRIDGE_WINDOW, [(source, destination)])
+    found = np.flatnonzero(predecessors >= 0)
+    detections.extend(Detection(BRIDGE, int(minute[i]), (int(edge_ids[predecessors[i]]), int(edge_ids[i])))
+                      for i in found)
+
+    predecessors = _latest_predecessors(destination, positions, minute, source, positions, minute, BRIDGE_WINDOW,
+                                        [(username, username), (source, destination)])
+    found = np.flatnonzero(predecessors >= 0)
+    detections.extend(Detection(SWITCHED_BRIDGE, int(minute[i]), (int(edge_ids[predecessors[i]]), int(edge_ids[i])))
+                      for i in found)
+    return detections
+
+
+def _batch_weight_shifts(fan_outs, destination, minute, positions, edge_ids, burst_sources):
+    """
+    Pair every white cane from B with the latest white cane edge into B reported before it started, within the weight
+    shift window. The edges of a white cane are reported when it starts and then one by one as it goes on.
+    :param fan_outs: white canes as returned by _fan_outs, indexes into the other arrays
+    :param positions: int array of the stream positions of the edges
+    :param burst_sources: int array of the source host code of every white cane
+    """
+    firsts, starts, stops = fan_outs
+    if not len(starts):
+        return []
+    window_sizes = starts - firsts + 1
+    window_edges = np.arange(window_sizes.sum()) - np.repeat(np.cumsum(window_sizes) - window_sizes - firsts,
+                                                             window_sizes)
+    run_sizes = stops - starts - 1
+    continued = np.arange(run_sizes.sum()) - np.repeat(np.cumsum(run_sizes) - run_sizes - starts - 1, run_sizes)
+    reported = np.concatenate([window_edges, continued])
+    reported_at = np.concatenate([np.repeat(positions[starts], window_sizes), positions[continued]])
+    order = np.lexsort((positions[reported], reported_at))
+    reported, reported_at = reported[order], reported_at[order]
+    predecessors = _latest_predecessors(destination[reported], np.arange(len(reported)), minute[reported],
+                                        burst_sources, np.searchsorted(reported_at, positions[starts], 'left'),
+                                        minute[starts], WEIGHT_SHIFT_WINDOW)
+    return [Detection(WEIGHT_SHIFT, int(minute[start]),
+                      (int(edge_ids[reported[predecessor]]), *edge_ids[first:start + 1].tolist()))
+            for first, start, predecessor in zip(firsts, starts, predecessors) if predecessor >= 0]
+
+
+def detect_batch(edges: pd.DataFrame):
+    """
+    Detect the lateral movement IoCs over a whole frame of authentication graph edges, vectorized. Finds what
+    StreamingDetector finds over the same edges, except that every fan-out is one Detection with all its edges, where
+    the streaming detector reports its start and then every edge that continues it.
+    :param edges: frame with the username, source, destination and minute columns, as returned by edge_frame
+    :return: list of Detection ordered by time, edge ids are row positions in the frame
+    """
+    if edges.empty:
+        return []
+    order = np.argsort(edges['minute'].to_numpy(), kind='stable')
+    edge_ids = np.arange(len(edges))[order]
+    username = pd.factorize(edges['username'].astype(str).to_numpy()[order])[0]
+    hosts = pd.factorize(np.concatenate([edges['source'].astype(str).to_numpy()[order],
+                                         edges['destination'].astype(str).to_numpy()[order]]))[0]
+    source, destination = hosts[:len(edges)], hosts[len(edges):]
+    base_minute = int(edges['minute'].min())
+    minute = edges['minute'].to_numpy(dtype=np.int64)[order] - base_minute
+
+    detections = []
+    fan_out_group = pd.factorize(username * (int(hosts.max()) + 1) + source)[0]
+    fan_out_order = np.lexsort((np.arange(len(edges)), fan_out_group))
+    group_ids, group_minutes = edge_ids[fan_out_order], minute[fan_out_order]
+    fan_out_edges = fan_out_group[fan_out_order], destination[fan_out_order], group_minutes
+    blasts = _fan_outs(*fan_out_edges, BLAST_WINDOW, BLAST_DESTINATIONS)
+    white_canes = _fan_outs(*fan_out_edges, WHITE_CANE_WINDOW, WHITE_CANE_DESTINATIONS)
+    for ioc, fan_outs in ((BLAST, blasts), (WHITE_CANE, white_canes)):
+        detections.extend(Detection(ioc, int(group_minutes[start]), tuple(group_ids[first:stop].tolist()))
+                          for first, start, stop in zip(*fan_outs))
+    detections.extend(_batch_weight_shifts(white_canes, destination[fan_out_order], group_minutes, fan_out_order,
+                                           group_ids, source[fan_out_order][white_canes[1]]))
+    detections.extend(_batch_bridges(username, source, destination, minute, edge_ids))
+    detections = [detection._replace(minute=detection.minute + base_minute) for detection in detections]
+    return sorted(detections, key=lambda detection: detection.minute)
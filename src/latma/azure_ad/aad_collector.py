@@ -1,11 +1,16 @@
 import urllib.parse
+from datetime import datetime, timedelta
 import requests
-import pandas as pd
 from http import HTTPStatus
 import logging
 import ujson as json
 import os
-from retry import retry
+from latma.azure_ad.graph_client import DEFAULT_MAX_RETRY_WAIT, DEFAULT_REQUESTS_PER_SECOND, DEFAULT_THREADS, \
+    DEFAULT_TIMEOUT, GRAPH_URL, GraphClient
+from latma.hosts import HostCanonicalizer
+from latma.metrics import PROGRESS_INTERVAL, ProgressReporter, metrics
+from latma.sinks import open_sink
+from latma.state import STATE_FILE_NAME, StateStore
 config = json.loads(open(os.path.join(os.getcwd(), "azure_config.json"), "rb").read())
 
 LOG = logging.getLogger()
@@ -20,6 +25,7 @@ class AdLogsNames(str):
 
 
 class SignInNames(str):
+    ID = 'id'
     USER = 'userPrincipalName'
     TIMESTAMP = 'createdDateTime'
     DESTINATION = 'resourceDisplayName'
@@ -28,71 +34,102 @@ class SignInNames(str):
     AUTH_TYPE = 'Cloud'
 
 
-def convert_sign_in_logs_to_df(signin_response, output_filename='cloud_logs'):
+SIGN_IN_LOGS_PATH = "auditLogs/signIns"
+GRAPH_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+DEFAULT_LOOKBACK_DAYS = 30
+# graph lists sign-ins some time after they are created, every run fetches this many minutes before the watermark again
+DEFAULT_SIGN_IN_DELAY_MINUTES = 60
+WINDOWS_PER_THREAD = 4
+SIGN_IN_FIELDS = [SignInNames.ID, SignInNames.USER, SignInNames.TIMESTAMP, SignInNames.DESTINATION,
+                  SignInNames.DEVICE_DETAILS]
+SIGN_IN_LOGS_HEADER = [AdLogsNames.USERNAME, AdLogsNames.TIMESTAMP, AdLogsNames.DESTINATION, AdLogsNames.SOURCE,
+                       AdLogsNames.AUTH_TYPE]
+OUTPUT_FILE_NAME = 'cloud_logs'
+# counters of the periodic progress line
+PROGRESS_FIELDS = [('pages', 'graph_pages_total'), ('sign-ins', 'sign_ins_written_total')]
+
+
+def write_sign_in_logs(signin_response, output_sink, host_canonicalizer=None):
+    """
+    Write sign-ins from hybrid or azure-ad joined devices to an output sink.
+    :param signin_response: sign-in records as returned from graph
+    :param output_sink: latma.sinks.OutputSink opened with SIGN_IN_LOGS_HEADER
+    :param host_canonicalizer: HostCanonicalizer naming devices like the on-premises collector, None keeps the device
+                               display names
+    """
     sign_in_logs = []
     for signin in signin_response:
-        device_details = signin.get(SignInNames.DEVICE_DETAILS, {})
+        device_details = signin.get(SignInNames.DEVICE_DETAILS) or {}
         device_display_name = device_details.get(SignInNames.DISPLAY_NAME)
         if device_display_name:
-            sign_in_logs.append({
-                AdLogsNames.USERNAMWE: signin[SignInNames.USER],
-                AdLogsNames.TIMESTAMP: signin[SignInNames.TIMESTAMP],
-                AdLogsNames.DESTINATION: signin[SignInNames.DESTINATION],
-                AdLogsNames.SOURCE: device_display_name
-            })
-
-    sign_in_logs_df = pd.DataFrame(sign_in_logs)
-    sign_in_logs_df.to_csv(output_filename)
-
-
-@retry(Exception, delay=2, tries=3)
-def do_azure_request(url, json_data, token):
-    headers = {
-        'Authorization': 'Bearer {}'.format(token)
+            if host_canonicalizer is not None:
+                device_display_name = host_canonicalizer.canonical(device_display_name)
+            sign_in_logs.append([signin[SignInNames.USER], signin[SignInNames.TIMESTAMP],
+                                 signin[SignInNames.DESTINATION], device_display_name, SignInNames.AUTH_TYPE])
+    output_sink.writerows(sign_in_logs)
+    metrics.increment('sign_ins_written_total', len(sign_in_logs))
+
+
+def split_time_range(since, until, windows):
+    """
+    Split the collected time range into windows that can be fetched concurrently.
+    :param since: createdDateTime of the last collected sign-in
+    :param until: datetime, end of the collected range
+    :param windows: amount of windows
+    :return: list of (start, end) createdDateTime strings of windows covering [since, until], every window but the
+             first one excludes its start
+    """
+    start = datetime.strptime(since[:19], GRAPH_TIME_FORMAT[:-1])
+    step = (until - start) / windows
+    bounds = [since] + [(start + step * i).strftime(GRAPH_TIME_FORMAT) for i in range(1, windows)] + \
+        [until.strftime(GRAPH_TIME_FORMAT)]
+    return [(low, high) for low, high in zip(bounds, bounds[1:]) if low < high]
+
+
+def build_sign_in_logs_url(since, until, include_since=False):
+    """
+    Build a sign-in logs query of a time window, selecting only the written fields.
+    :param since: createdDateTime the sign-ins are created after
+    :param until: createdDateTime the sign-ins are created at or before
+    :param include_since: fetch the sign-ins created at since as well
+    :return: url of the first sign-in logs page of the window
+    """
+    query = {
+        "$select": ",".join(SIGN_IN_FIELDS),
+        "$filter": f"{SignInNames.TIMESTAMP} {'ge' if include_since else 'gt'} {since} and "
+                   f"{SignInNames.TIMESTAMP} le {until}",
     }
-    response = None
-    try:
-        response = requests.get(url, headers=headers, json=json_data)
-        if response is None:
-            return None
-
-        if response.status_code != HTTPStatus.OK:
-            LOG.info(f"Unexpected status code from {url=}: {response.status_code}")
-            return None
-
-    except Exception as e:
-        LOG.info(f"Error while accessing {url=}: {e=}")
-
-    LOG.info(f"Done getting azure data from the following url: {url=}")
-    return response
-
-
-def get_next_request_url(json_response):
-    next_link = json_response.get("@odata.nextLink")
-    return urllib.parse.unquote_plus(next_link) if next_link is not None else None
-
-
-def get_aad_component(token):
-    records = []
-    url = "https://graph.microsoft.com/v1.0/auditLogs/signIns"
-
-    while url is not None:
-        LOG.info(f"Retrieving AAD records by the following URL: {url}")
-        response = do_azure_request(url, None, token)
-        if response is None:
-            LOG.info("Got error in middle of get_aad_component loop")
-            return None
-
-        response_content = response.json()
-        if "error" in response_content:
-            LOG.info(f'Got error from Azure: {response_content}')
-            return None
-
-        records += response_content["value"]
-        url = get_next_request_url(response_content)
-
-    LOG.info(f"Got {len(records)} records from azure")
-    return records
+    return f"{SIGN_IN_LOGS_PATH}?{urllib.parse.urlencode(query, safe='$,:', quote_via=urllib.parse.quote)}"
+
+
+def shift_created_date_time(created_date_time, delta):
+    """
+    :param created_date_time: createdDateTime string
+    :param delta: timedelta
+    :return: createdDateTime string delta later, without fractions of a second
+    """
+    return (datetime.strptime(created_date_time[:19], GRAPH_TIME_FORMAT[:-1]) + delta).strftime(GRAPH_TIME_FORMAT)
+
+
+def get_aad_component(client, since=None):
+    """
+    Stream the sign-in logs page by page. The time range is split into windows fetched concurrently.
+    :param client: GraphClient
+    :param since: createdDateTime the fetched sign-ins are created at or after. Default is the LOOKBACK_DAYS of the
+                  config file.
+    :return: generator of sign-in record pages
+    """
+    until = datetime.utcnow().replace(microsecond=0)
+    if since is None:
+        since = (until - timedelta(days=config.get("LOOKBACK_DAYS", DEFAULT_LOOKBACK_DAYS))).strftime(GRAPH_TIME_FORMAT)
+    windows = split_time_range(since, until, client.threads * WINDOWS_PER_THREAD)
+    urls = [build_sign_in_logs_url(low, high, include_since=index == 0) for index, (low, high) in enumerate(windows)]
+    record_count = 0
+    for page in client.iter_pages_concurrently(urls):
+        record_count += len(page)
+        yield page
+
+    LOG.info(f"Got {record_count} records from azure")
 
 
 def get_azure_ad_access_token():
@@ -120,11 +157,59 @@ def get_azure_ad_access_token():
 
 
 def main():
-    access_token = get_azure_ad_access_token()
-    assert access_token is not None, "Failed to retrieve access token."
-    sign_in_logs = get_aad_component(access_token)
-    assert sign_in_logs is not None, "Failed to retrieve sign-in logs from Azure AD"
-    convert_sign_in_logs_to_df(sign_in_logs)
+    metrics_json = config.get("METRICS_JSON")
+    metrics_textfile = config.get("METRICS_TEXTFILE")
+    progress_interval = config.get("PROGRESS_INTERVAL", PROGRESS_INTERVAL)
+    metrics.enabled = bool(metrics_json or metrics_textfile or progress_interval)
+    metrics.detailed = bool(metrics_json or metrics_textfile)
+    progress = None
+    if progress_interval:
+        progress = ProgressReporter(metrics, PROGRESS_FIELDS, interval=progress_interval,
+                                    textfile=metrics_textfile).start()
+    try:
+        collect()
+    finally:
+        if progress is not None:
+            progress.stop()
+        metrics.export(metrics_json, metrics_textfile)
+
+
+def collect():
+    client = GraphClient(get_azure_ad_access_token, base_url=config.get("GRAPH_URL", GRAPH_URL),
+                         threads=config.get("FETCH_THREADS", DEFAULT_THREADS),
+                         requests_per_second=config.get("REQUESTS_PER_SECOND", DEFAULT_REQUESTS_PER_SECOND),
+                         timeout=config.get("COMPONENT_TIMEOUT", DEFAULT_TIMEOUT),
+                         max_retry_wait=config.get("MAX_THROTTLING_WAIT_TIME", DEFAULT_MAX_RETRY_WAIT))
+    host_canonicalizer = None if config.get("RAW_HOSTS") else HostCanonicalizer(resolve_ips=False)
+    with client, StateStore(config.get("STATE_FILE", STATE_FILE_NAME)) as state_store:
+        tenant = config["TENANT_ID"]
+        # sign-ins listed late are collected by fetching the last minutes before the watermark again, the sign-ins
+        # collected in them before are dropped by id
+        delay = timedelta(minutes=config.get("SIGN_IN_DELAY_MINUTES", DEFAULT_SIGN_IN_DELAY_MINUTES))
+        watermark = state_store.get_sign_in_watermark(tenant)
+        since, collected_ids = None, set()
+        if watermark is not None:
+            since = shift_created_date_time(watermark, -delay)
+            collected_ids = state_store.get_sign_in_watermark_ids(tenant)
+            LOG.info(f"Collecting sign-ins created at or after {since}")
+        last_created, new_ids = watermark, []
+        with open_sink(config.get("OUTPUT_FORMAT", "csv"), header=SIGN_IN_LOGS_HEADER,
+                       base_name=OUTPUT_FILE_NAME) as output_sink:
+            for sign_in_logs in get_aad_component(client, since):
+                if collected_ids:
+                    sign_in_logs = [signin for signin in sign_in_logs
+                                    if signin.get(SignInNames.ID) not in collected_ids]
+                write_sign_in_logs(sign_in_logs, output_sink, host_canonicalizer)
+                for signin in sign_in_logs:
+                    created = signin[SignInNames.TIMESTAMP]
+                    if signin.get(SignInNames.ID) is not None:
+                        new_ids.append((signin[SignInNames.ID], created))
+                    if last_created is None or created > last_created:
+                        last_created = created
+        # windows are fetched concurrently and newest first, so the watermark only moves once all pages were written
+        if new_ids or last_created != watermark:
+            state_store.set_sign_in_watermark(tenant, last_created, new_ids,
+                                              keep_since=shift_created_date_time(last_created, -delay))
 
 
 if __name__ == '__main__':
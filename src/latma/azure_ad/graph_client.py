@@ -0,0 +1,221 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from queue import Queue
+from threading import Event, Lock
+from time import monotonic, sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from latma.metrics import metrics
+
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+DEFAULT_THREADS = 4
+DEFAULT_REQUESTS_PER_SECOND = 2
+DEFAULT_BURST = 5
+DEFAULT_TIMEOUT = 60
+DEFAULT_MAX_RETRY_WAIT = 60
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1
+PAGES_IN_FLIGHT = 2
+_RETRY_STATUS_CODES = {HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.INTERNAL_SERVER_ERROR, HTTPStatus.BAD_GATEWAY,
+                       HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.GATEWAY_TIMEOUT}
+_QUERY_DONE = object()
+
+LOG = logging.getLogger()
+
+
+class TokenBucket:
+    """
+    Request rate limiter shared by all fetching threads. A throttling response blocks every thread for its
+    Retry-After, not only the one that received it.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: requests per second
+        :param capacity: maximal burst of requests
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.blocked_until = 0
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+        Wait until a request may be sent.
+        """
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def block(self, seconds):
+        """
+        Hold all requests for a while and restart from an empty bucket.
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, monotonic() + seconds)
+            self.tokens = 0
+
+
+class GraphClient:
+    """
+    Microsoft Graph client fetching paged queries concurrently over a pooled keep-alive session.
+    Failed pages are retried on their own, throttled requests wait for their Retry-After and an expired access token
+    is refreshed once for all threads.
+    """
+
+    def __init__(self, token_provider, base_url=GRAPH_URL, threads=DEFAULT_THREADS,
+                 requests_per_second=DEFAULT_REQUESTS_PER_SECOND, burst=DEFAULT_BURST, timeout=DEFAULT_TIMEOUT,
+                 max_retry_wait=DEFAULT_MAX_RETRY_WAIT):
+        """
+        :param token_provider: callable returning a new access token, None on failure
+        :param base_url: graph endpoint, e.g. a local stand-in server
+        :param threads: amount of queries fetched concurrently
+        :param requests_per_second: sustained request rate of all threads
+        :param burst: maximal burst of requests
+        :param timeout: seconds to wait for a response
+        :param max_retry_wait: maximal seconds to wait before retrying a page
+        """
+        self.token_provider = token_provider
+        self.base_url = base_url.rstrip('/')
+        self.threads = threads
+        self.timeout = timeout
+        self.max_retry_wait = max_retry_wait
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=threads)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.token_lock = Lock()
+        self.token = token_provider()
+        if self.token is None:
+            raise RuntimeError("Failed to retrieve access token.")
+
+    def _refresh_token(self, expired_token):
+        with self.token_lock:
+            # another thread may have refreshed it already
+            if self.token == expired_token:
+                LOG.info("Access token expired, refreshing it")
+                metrics.increment('graph_token_refreshes_total')
+                token = self.token_provider()
+                if token is None:
+                    raise RuntimeError("Failed to refresh access token.")
+                self.token = token
+
+    def _retry_wait(self, response, attempt):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(int(retry_after), self.max_retry_wait)
+        return min(BACKOFF_BASE * 2 ** attempt, self.max_retry_wait)
+
+    def get(self, url):
+        """
+        Get a single page, retrying until it is received.
+        :param url: absolute url, or a path relative to the graph endpoint
+        :return: decoded json response
+        """
+        if not url.startswith(('https://', 'http://')):
+            url = f"{self.base_url}/{url.lstrip('/')}"
+        for attempt in range(MAX_ATTEMPTS):
+            with metrics.timer('graph_rate_limit_wait_seconds'):
+                self.bucket.acquire()
+            token = self.token
+            request_start = monotonic()
+            try:
+                response = self.session.get(url, headers={'Authorization': f'Bearer {token}'}, timeout=self.timeout)
+            except requests.RequestException as e:
+                LOG.warning(f"Error while accessing {url=}: {e=}")
+                metrics.increment('graph_request_errors_total')
+                sleep(self._retry_wait(None, attempt))
+                continue
+            metrics.observe('graph_request_seconds', monotonic() - request_start, status=response.status_code)
+            if response.status_code == HTTPStatus.OK:
+                metrics.increment('graph_pages_total')
+                return response.json()
+            if response.status_code == HTTPStatus.UNAUTHORIZED:
+                self._refresh_token(token)
+            elif response.status_code in _RETRY_STATUS_CODES:
+                wait = self._retry_wait(response, attempt)
+                LOG.info(f"Got status code {response.status_code} from {url=}, retrying in {wait}s")
+                metrics.increment('graph_throttled_total', status=response.status_code)
+                metrics.observe('graph_throttle_wait_seconds', wait)
+                self.bucket.block(wait)
+            else:
+                raise RuntimeError(f"Unexpected status code from {url=}: {response.status_code} {response.text}")
+        raise RuntimeError(f"Failed to get {url=} after {MAX_ATTEMPTS} attempts")
+
+    def iter_pages(self, url):
+        """
+        Follow the @odata.nextLink of a query.
+        :return: generator of the value list of every page
+        """
+        while url is not None:
+            LOG.debug(f"Retrieving {url}")
+            response_content = self.get(url)
+            yield response_content.get("value", [])
+            url = response_content.get("@odata.nextLink")
+
+    def iter_pages_concurrently(self, urls):
+        """
+        Fetch several queries concurrently, e.g. the time windows of a long range.
+        :param urls: query urls
+        :return: generator of the value list of every page of every query, in arrival order
+        """
+        pages = Queue(maxsize=self.threads * PAGES_IN_FLIGHT)
+        stop = Event()
+
+        def fetch(query_url):
+            try:
+                if not stop.is_set():
+                    for page in self.iter_pages(query_url):
+                        pages.put(page)
+                        if stop.is_set():
+                            break
+            except Exception as e:
+                pages.put(e)
+                return
+            pages.put(_QUERY_DONE)
+
+        remaining = len(urls)
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for url in urls:
+                executor.submit(fetch, url)
+            try:
+                while remaining:
+                    item = pages.get()
+                    if item is _QUERY_DONE:
+                        remaining -= 1
+                    elif isinstance(item, Exception):
+                        remaining -= 1
+                        raise item
+                    else:
+                        yield item
+            finally:
+                stop.set()
+                # unblock the fetching threads so the executor can shut down
+                while remaining:
+                    item = pages.get()
+                    if item is _QUERY_DONE or isinstance(item, Exception):
+                        remaining -= 1
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
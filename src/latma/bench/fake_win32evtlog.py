@@ -0,0 +1,113 @@
+import re
+from contextlib import contextmanager
+from itertools import islice
+from threading import Lock
+from time import sleep
+from types import SimpleNamespace
+
+from latma import sources
+
+DEFAULT_EVENTS_PER_HOST = 1000
+ERROR_TIMEOUT = 1460
+_MIN_RECORD_ID_REGEX = re.compile(r'EventRecordID(?:&gt;|>)(\d+)')
+
+
+class error(Exception):
+    """
+    Stand-in for pywintypes.error.
+    """
+
+    def __init__(self, winerror, funcname, strerror):
+        super().__init__(winerror, funcname, strerror)
+        self.winerror = winerror
+        self.funcname = funcname
+        self.strerror = strerror
+
+
+_PYWINTYPES = SimpleNamespace(error=error)
+
+
+class _Session(SimpleNamespace):
+    pass
+
+
+class _ResultSet(SimpleNamespace):
+    pass
+
+
+class FakeEventLog:
+    """
+    Stand-in for the win32evtlog module, serving the events of a SyntheticEnvironment with the latencies of remote
+    hosts. Implements the calls RpcEventSource makes: EvtOpenSession, EvtQuery, EvtNext and EvtRender. Events are
+    generated as EvtNext pages them, so generation costs the fetching threads about what rendering would.
+    """
+    EvtRpcLoginAuthDefault = 0
+    EvtQueryForwardDirection = 0x100
+
+    def __init__(self, environment, events_per_host=DEFAULT_EVENTS_PER_HOST, events_per_domain_controller=None,
+                 session_latency=0, query_latency=0, page_latency=0, event_latency=0):
+        """
+        :param environment: SyntheticEnvironment generating the events
+        :param events_per_host: amount of events in the log of every host
+        :param events_per_domain_controller: amount of events in the log of every domain controller, default is
+                                             events_per_host
+        :param session_latency: seconds EvtOpenSession takes
+        :param query_latency: seconds EvtQuery takes
+        :param page_latency: seconds every EvtNext call takes
+        :param event_latency: additional seconds EvtNext takes per returned event
+        """
+        self.environment = environment
+        self.events_per_host = events_per_host
+        self.events_per_domain_controller = events_per_domain_controller or events_per_host
+        self.domain_controllers = {self.environment.fqdn(name).lower() for name in environment.domain_controllers}
+        self.session_latency = session_latency
+        self.query_latency = query_latency
+        self.page_latency = page_latency
+        self.event_latency = event_latency
+        self.lock = Lock()
+        self.calls = {'EvtOpenSession': 0, 'EvtQuery': 0, 'EvtNext': 0}
+
+    def _count(self, call):
+        with self.lock:
+            self.calls[call] += 1
+
+    def EvtOpenSession(self, Login, Timeout=0, Flags=0):
+        self._count('EvtOpenSession')
+        sleep(self.session_latency)
+        return _Session(host=Login[0])
+
+    def EvtQuery(self, Path, Flags, Query=None, Session=None):
+        self._count('EvtQuery')
+        sleep(self.query_latency)
+        host = Session.host.lower()
+        count = self.events_per_domain_controller if host in self.domain_controllers else self.events_per_host
+        min_record_id = _MIN_RECORD_ID_REGEX.search(Query or '')
+        first_record_id = int(min_record_id.group(1)) + 1 if min_record_id else 1
+        return _ResultSet(events=self.environment.events(host.split('.', 1)[0].upper(), Path, count, first_record_id))
+
+    def EvtNext(self, ResultSet, Count, Timeout=-1, Flags=0):
+        self._count('EvtNext')
+        events = tuple(islice(ResultSet.events, Count))
+        latency = self.page_latency + self.event_latency * len(events)
+        if 0 <= Timeout < latency * 1000:
+            sleep(Timeout / 1000)
+            raise error(ERROR_TIMEOUT, 'EvtNext', 'This operation returned because the timeout period expired.')
+        sleep(latency)
+        return events
+
+    def EvtRender(self, Event, Flags):
+        return Event
+
+
+@contextmanager
+def installed(event_log):
+    """
+    Make RpcEventSource use a FakeEventLog instead of pywin32, on any platform.
+    :param event_log: FakeEventLog
+    """
+    previous = sources.win32evtlog, sources.pywintypes
+    sources.win32evtlog, sources.pywintypes = event_log, _PYWINTYPES
+    try:
+        yield event_log
+    finally:
+        sources.win32evtlog, sources.pywintypes = previous
@@ -0,0 +1,210 @@
+import random
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from latma.event_parser import KERBEROS_EVENT_ID, NTLM_EVENT_ID
+
+DEFAULT_DOMAIN = 'corp.local'
+DEFAULT_HOSTS = 200
+DEFAULT_DOMAIN_CONTROLLERS = 2
+DEFAULT_ACCOUNTS = 2000
+# accounts and destination hosts are drawn with weights 1 / rank ** skew, a few busy ones and a long tail
+DEFAULT_SKEW = 1.1
+START_TIME = datetime(2022, 5, 1)
+# average seconds between two events of a log
+EVENT_INTERVAL = 5
+SIGN_IN_INTERVAL = 2
+MACHINE_ACCOUNT_SHARE = 0.2
+LOOPBACK_SHARE = 0.05
+UNMANAGED_DEVICE_SHARE = 0.25
+NTLM_CHANNEL = 'Microsoft-Windows-NTLM/Operational'
+SECURITY_CHANNEL = 'Security'
+SERVICES = ('cifs', 'host', 'rpcss', 'termsrv', 'ldap', 'http', 'mssqlsvc', 'wsman')
+APPLICATIONS = ('Office 365 Exchange Online', 'Microsoft Teams', 'Office 365 SharePoint Online', 'Azure Portal',
+                'Windows Sign In', 'Microsoft Graph', 'OneDrive SyncEngine')
+GRAPH_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+_NTLM_EVENT = (
+    '<Event xmlns="http://schemas.microsoft.com/win/2004/08/events/event"><System>'
+    '<Provider Name="Microsoft-Windows-NTLM" Guid="{{ac43300d-5fcc-4800-8e99-1bd3f85f0320}}"/>'
+    '<EventID>8004</EventID><Version>0</Version><Level>4</Level><Task>3</Task><Opcode>0</Opcode>'
+    '<Keywords>0x8000000000000000</Keywords><TimeCreated SystemTime="{time}"/>'
+    '<EventRecordID>{record_id}</EventRecordID><Correlation/><Execution ProcessID="{pid}" ThreadID="{tid}"/>'
+    '<Channel>Microsoft-Windows-NTLM/Operational</Channel><Computer>{computer}</Computer>'
+    '<Security UserID="S-1-5-18"/></System><EventData>'
+    '<Data Name="SChannelName">{server}</Data><Data Name="UserName">{account}</Data>'
+    '<Data Name="DomainName">{netbios_domain}</Data><Data Name="WorkstationName">{workstation}</Data>'
+    '<Data Name="SChannelType">2</Data></EventData></Event>'
+)
+_KERBEROS_EVENT = (
+    '<Event xmlns="http://schemas.microsoft.com/win/2004/08/events/event"><System>'
+    '<Provider Name="Microsoft-Windows-Security-Auditing" Guid="{{54849625-5478-4994-a5ba-3e3b0328c30d}}"/>'
+    '<EventID>4648</EventID><Version>0</Version><Level>0</Level><Task>12544</Task><Opcode>0</Opcode>'
+    '<Keywords>0x8020000000000000</Keywords><TimeCreated SystemTime="{time}"/>'
+    '<EventRecordID>{record_id}</EventRecordID><Correlation ActivityID="{{{activity}}}"/>'
+    '<Execution ProcessID="{pid}" ThreadID="{tid}"/><Channel>Security</Channel><Computer>{computer}</Computer>'
+    '<Security/></System><EventData>'
+    '<Data Name="SubjectUserSid">S-1-5-18</Data><Data Name="SubjectUserName">{subject}</Data>'
+    '<Data Name="SubjectDomainName">{netbios_domain}</Data><Data Name="SubjectLogonId">0x3e7</Data>'
+    '<Data Name="LogonGuid">{{00000000-0000-0000-0000-000000000000}}</Data>'
+    '<Data Name="TargetUserName">{account}</Data><Data Name="TargetDomainName">{netbios_domain}</Data>'
+    '<Data Name="TargetLogonGuid">{{00000000-0000-0000-0000-000000000000}}</Data>'
+    '<Data Name="TargetServerName">{server}</Data><Data Name="TargetInfo">{spn}</Data>'
+    '<Data Name="ProcessId">0x{pid:x}</Data><Data Name="ProcessName">C:\\Windows\\System32\\svchost.exe</Data>'
+    '<Data Name="IpAddress">-</Data><Data Name="IpPort">-</Data></EventData></Event>'
+)
+
+
+def _cumulative_weights(count, skew):
+    return list(accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+
+def _system_time(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%f') + '0Z'
+
+
+class SyntheticEnvironment:
+    """
+    Synthetic domain of hosts, domain controllers and accounts producing realistic 8004 and 4648 event xml and Graph
+    sign-in records. Every log is generated from its own seeded random stream, so a (host, log) pair always yields the
+    same events regardless of the order or the threads reading them.
+    """
+
+    def __init__(self, hosts=DEFAULT_HOSTS, accounts=DEFAULT_ACCOUNTS,
+                 domain_controllers=DEFAULT_DOMAIN_CONTROLLERS, domain=DEFAULT_DOMAIN, skew=DEFAULT_SKEW, seed=0):
+        """
+        :param hosts: amount of workstations and servers
+        :param accounts: amount of user accounts
+        :param domain_controllers: amount of domain controllers
+        :param domain: domain fqdn
+        :param skew: popularity skew of accounts and destination hosts, 0 draws them uniformly
+        :param seed: seed of all generated data
+        """
+        self.domain = domain
+        self.netbios_domain = domain.split('.', 1)[0].upper()
+        self.seed = seed
+        self.hosts = [f"WS{index:05d}" for index in range(hosts)]
+        self.domain_controllers = [f"DC{index:02d}" for index in range(domain_controllers)]
+        self.accounts = [f"user{index:05d}" for index in range(accounts)]
+        self.host_weights = _cumulative_weights(hosts, skew)
+        self.account_weights = _cumulative_weights(accounts, skew)
+
+    def fqdn(self, name):
+        return f"{name}.{self.domain}"
+
+    def workstations(self, domain_controllers=False):
+        """
+        :param domain_controllers: list the domain controllers instead of the hosts
+        :return: list of LDAP-like workstation entries, as the collectors enumerate them
+        """
+        names = self.domain_controllers if domain_controllers else self.hosts
+        operating_system = 'Windows Server 2019 Standard' if domain_controllers else 'Windows 10 Enterprise'
+        return [{'raw_dn': f"CN={name},OU=Computers,DC={self.netbios_domain}".encode(),
+                 'attributes': {'name': name, 'dNSHostName': self.fqdn(name), 'operatingSystem': operating_system}}
+                for name in names]
+
+    def _random(self, *key):
+        return random.Random(':'.join(map(str, (self.seed, *key))))
+
+    def _host(self, rng):
+        return rng.choices(self.hosts, cum_weights=self.host_weights)[0]
+
+    def _account(self, rng):
+        return rng.choices(self.accounts, cum_weights=self.account_weights)[0]
+
+    def ntlm_events(self, domain_controller, count, first_record_id=1):
+        """
+        :param domain_controller: NETBIOS name of the domain controller logging the events
+        :param count: amount of events
+        :param first_record_id: EventRecordID of the first event, earlier events are skipped
+        :return: generator of 8004 event xml strings
+        """
+        rng = self._random(domain_controller, NTLM_EVENT_ID)
+        computer = self.fqdn(domain_controller)
+        moment = START_TIME
+        for record_id in range(1, count + 1):
+            moment += timedelta(seconds=rng.expovariate(1 / EVENT_INTERVAL))
+            account = f"{self._host(rng)}$" if rng.random() < MACHINE_ACCOUNT_SHARE else self._account(rng)
+            workstation = self._host(rng)
+            server = self._host(rng)
+            pid = rng.randrange(400, 900, 4)
+            if record_id < first_record_id:
+                continue
+            yield _NTLM_EVENT.format(time=_system_time(moment), record_id=record_id, pid=pid, tid=pid + 4,
+                                     computer=computer, server=server, account=account,
+                                     netbios_domain=self.netbios_domain, workstation=workstation)
+
+    def kerberos_events(self, host, count, first_record_id=1):
+        """
+        :param host: NETBIOS name of the host logging the events
+        :param count: amount of events
+        :param first_record_id: EventRecordID of the first event, earlier events are skipped
+        :return: generator of 4648 event xml strings
+        """
+        rng = self._random(host, KERBEROS_EVENT_ID)
+        computer = self.fqdn(host)
+        moment = START_TIME
+        for record_id in range(1, count + 1):
+            moment += timedelta(seconds=rng.expovariate(1 / EVENT_INTERVAL))
+            subject = f"{host}$" if rng.random() < MACHINE_ACCOUNT_SHARE else self._account(rng)
+            account = self._account(rng)
+            server = 'localhost' if rng.random() < LOOPBACK_SHARE else self.fqdn(self._host(rng))
+            service = rng.choice(SERVICES)
+            pid = rng.randrange(400, 9000, 4)
+            activity = f"{rng.getrandbits(128):032x}"
+            if record_id < first_record_id:
+                continue
+            yield _KERBEROS_EVENT.format(time=_system_time(moment), record_id=record_id, pid=pid, tid=pid + 4,
+                                         activity=activity, computer=computer, subject=subject, account=account,
+                                         netbios_domain=self.netbios_domain, server=server,
+                                         spn=f"{service}/{server.split('.', 1)[0]}")
+
+    def events(self, host, log, count, first_record_id=1):
+        """
+        :param host: NETBIOS name of the host logging the events
+        :param log: NTLM_CHANNEL or SECURITY_CHANNEL
+        :return: generator of the event xml strings of the log
+        """
+        if log == NTLM_CHANNEL:
+            return self.ntlm_events(host, count, first_record_id)
+        return self.kerberos_events(host, count, first_record_id)
+
+    def mixed_events(self, count):
+        """
+        :return: list of count events, a fifth NTLM events of the domain controllers, the rest Kerberos events of the
+                 hosts.
+        """
+        ntlm_count = count // 5
+        events = []
+        for index, domain_controller in enumerate(self.domain_controllers):
+            events.extend(self.ntlm_events(domain_controller, ntlm_count // len(self.domain_controllers) +
+                                           (index < ntlm_count % len(self.domain_controllers))))
+        kerberos_count = count - len(events)
+        per_host, remainder = divmod(kerberos_count, len(self.hosts))
+        for index, host in enumerate(self.hosts):
+            events.extend(self.kerberos_events(host, per_host + (index < remainder)))
+        return events
+
+    def sign_ins(self, count, until=None):
+        """
+        :param count: amount of sign-ins
+        :param until: datetime of the newest sign-in, default is now
+        :return: list of Graph sign-in records, oldest first
+        """
+        rng = self._random('signIns')
+        moment = (until or datetime.utcnow()).replace(microsecond=0) - timedelta(seconds=count * SIGN_IN_INTERVAL)
+        sign_ins = []
+        for index in range(count):
+            moment += timedelta(seconds=SIGN_IN_INTERVAL)
+            device = '' if rng.random() < UNMANAGED_DEVICE_SHARE else self._host(rng)
+            sign_ins.append({
+                'id': f"{rng.getrandbits(128):032x}",
+                'createdDateTime': moment.strftime(GRAPH_TIME_FORMAT),
+                'userPrincipalName': f"{self._account(rng)}@{self.domain}",
+                'appDisplayName': rng.choice(APPLICATIONS),
+                'resourceDisplayName': rng.choice(APPLICATIONS),
+                'ipAddress': f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}",
+                'deviceDetail': {'deviceId': '', 'displayName': device, 'operatingSystem': 'Windows 10',
+                                 'browser': 'Edge', 'isCompliant': bool(device), 'isManaged': bool(device)},
+            })
+        return sign_ins
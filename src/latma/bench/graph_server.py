@@ -0,0 +1,159 @@
+import json
+import re
+import urllib.parse
+from bisect import bisect_left, bisect_right
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+SIGN_IN_LOGS_PATH = '/v1.0/auditLogs/signIns'
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_RETRY_AFTER = 1
+_TIME_FILTER_REGEX = re.compile(r"createdDateTime (gt|ge) (\S+) and createdDateTime (le|lt) (\S+)")
+
+
+class _SignInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        graph = self.server.graph
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != SIGN_IN_LOGS_PATH:
+            self._send(HTTPStatus.NOT_FOUND, {'error': {'code': 'ResourceNotFound', 'message': url.path}})
+            return
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer ') or \
+                (graph.tokens is not None and authorization[len('Bearer '):] not in graph.tokens):
+            self._send(HTTPStatus.UNAUTHORIZED, {'error': {'code': 'InvalidAuthenticationToken'}})
+            return
+        status = graph.failure_status()
+        if status == HTTPStatus.TOO_MANY_REQUESTS:
+            self._send(status, {'error': {'code': 'TooManyRequests'}}, {'Retry-After': str(graph.retry_after)})
+            return
+        if status is not None:
+            self._send(status, {'error': {'code': HTTPStatus(status).phrase}})
+            return
+        sleep(graph.latency)
+        query = {name: values[0] for name, values in urllib.parse.parse_qs(url.query).items()}
+        try:
+            page, next_skip = graph.page(query)
+        except ValueError as e:
+            self._send(HTTPStatus.BAD_REQUEST, {'error': {'code': 'BadRequest', 'message': str(e)}})
+            return
+        content = {'@odata.context': f"{graph.url}/$metadata#auditLogs/signIns", 'value': page}
+        if next_skip is not None:
+            next_query = dict(query, **{'$skiptoken': str(next_skip)})
+            next_query_text = urllib.parse.urlencode(next_query, safe='$,:', quote_via=urllib.parse.quote)
+            content['@odata.nextLink'] = f"{graph.url}/auditLogs/signIns?{next_query_text}"
+        self._send(HTTPStatus.OK, content)
+
+    def _send(self, status, content, headers=None):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.graph.record(status, self.path)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SignInGraphServer:
+    """
+    Local stand-in for the Microsoft Graph sign-in logs endpoint. Serves a fixed list of sign-ins newest first,
+    honoring the createdDateTime range $filter, $select and $top of the query, pages with @odata.nextLink and answers
+    every throttle_every-th request with 429 and a Retry-After. Every response is recorded in responses.
+    """
+
+    def __init__(self, sign_ins, page_size=DEFAULT_PAGE_SIZE, latency=0, throttle_every=0,
+                 retry_after=DEFAULT_RETRY_AFTER, host='127.0.0.1', port=0, tokens=None, failures=None):
+        """
+        :param sign_ins: list of sign-in records, oldest first, e.g. from SyntheticEnvironment.sign_ins
+        :param page_size: sign-ins per page unless the query has a smaller $top
+        :param latency: seconds every page takes
+        :param throttle_every: throttle every n-th request, 0 never throttles
+        :param retry_after: Retry-After seconds of throttled requests
+        :param host: listening address
+        :param port: listening port, 0 picks a free one
+        :param tokens: accepted access tokens, other tokens are answered with 401. None accepts any token.
+        :param failures: dict of authorized request number, counted from 1, to the status code answered to it
+        """
+        self.sign_ins = sign_ins
+        self.times = [sign_in['createdDateTime'] for sign_in in sign_ins]
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.tokens = tokens
+        self.failures = failures or {}
+        self.lock = Lock()
+        self.requests = 0
+        self.throttled = 0
+        # (monotonic time, status code, request path) of every response
+        self.responses = []
+        self.server = ThreadingHTTPServer((host, port), _SignInHandler)
+        self.server.daemon_threads = True
+        self.server.graph = self
+        self.url = f"http://{self.server.server_address[0]}:{self.server.server_address[1]}/v1.0"
+        self.thread = Thread(target=self.server.serve_forever, name="graph-server", daemon=True)
+
+    def failure_status(self):
+        """
+        Count an authorized request.
+        :return: status code to answer it with instead of a page, None to serve the page
+        """
+        with self.lock:
+            self.requests += 1
+            if self.requests in self.failures:
+                return self.failures[self.requests]
+            if self.throttle_every and self.requests % self.throttle_every == 0:
+                self.throttled += 1
+                return HTTPStatus.TOO_MANY_REQUESTS
+        return None
+
+    def record(self, status, path):
+        with self.lock:
+            self.responses.append((monotonic(), status, path))
+
+    def page(self, query):
+        """
+        :param query: decoded query parameters
+        :return: tuple of (sign-ins of the page, offset of the next page, None on the last page)
+        """
+        low, high = 0, len(self.sign_ins)
+        if '$filter' in query:
+            time_filter = _TIME_FILTER_REGEX.fullmatch(query['$filter'].strip())
+            if time_filter is None:
+                raise ValueError(f"Unsupported filter {query['$filter']}")
+            low_operator, since, high_operator, until = time_filter.groups()
+            low = (bisect_right if low_operator == 'gt' else bisect_left)(self.times, since)
+            high = max((bisect_right if high_operator == 'le' else bisect_left)(self.times, until), low)
+        page_size = min(int(query.get('$top', self.page_size)), self.page_size)
+        skip = int(query.get('$skiptoken', 0))
+        # newest first, as graph returns them
+        stop = high - skip
+        start = max(stop - page_size, low)
+        page = self.sign_ins[start:stop][::-1]
+        if '$select' in query:
+            fields = query['$select'].split(',')
+            page = [{field: sign_in.get(field) for field in fields} for sign_in in page]
+        return page, skip + page_size if start > low else None
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,37 @@
+from datetime import datetime, timezone
+
+from latma.event_parser import KERBEROS, KERBEROS_EVENT_ID, NTLM, NTLM_EVENT_ID, TIMESTAMP_FORMAT
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+
+def legacy_parse_event(event_xml, domain):
+    """
+    Parse a rendered event the way the collector did before the lxml XPath decoder, with BeautifulSoup and the
+    positions of the event data fields. A reference for parity tests and the parse benchmark, requires bs4.
+    :param event_xml: event xml as rendered by EvtRender
+    :param domain: collecting user domain
+    :return: [username, source host, destination, spn, timestamp, auth type], None for unsupported events.
+    """
+    system_time = None
+    tree = BeautifulSoup(event_xml, 'xml')
+    data = tree.find_all("Data")
+    for time in tree.find_all("TimeCreated"):
+        system_time = datetime.fromisoformat(time['SystemTime'][:23]).astimezone(timezone.utc).strftime(
+            TIMESTAMP_FORMAT)
+    event_id = tree.find("EventID").get_text()
+    if event_id == NTLM_EVENT_ID:
+        dest = f"{data[0].get_text()}@{domain}".lower()
+        user_name = data[1].get_text().lower()
+        source = f"{data[3].get_text()}@{domain}".lower()
+        return [user_name, source, dest, "-", system_time, NTLM]
+    if event_id == KERBEROS_EVENT_ID:
+        dest = data[8].get_text().lower()
+        user_name = data[5].get_text().lower()
+        source = tree.find("Computer").get_text().lower()
+        spn = data[9].get_text().lower()
+        return [user_name, source, dest, spn, system_time, KERBEROS]
+    return None
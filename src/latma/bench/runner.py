@@ -0,0 +1,368 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import monotonic
+
+from latma.bench.fake_win32evtlog import DEFAULT_EVENTS_PER_HOST, FakeEventLog, installed
+from latma.bench.generators import DEFAULT_ACCOUNTS, DEFAULT_DOMAIN_CONTROLLERS, DEFAULT_HOSTS, DEFAULT_SKEW, \
+    GRAPH_TIME_FORMAT, SyntheticEnvironment
+from latma.bench.graph_server import DEFAULT_PAGE_SIZE, DEFAULT_RETRY_AFTER, SignInGraphServer
+from latma.bench.legacy_parser import BeautifulSoup, legacy_parse_event
+from latma.eventlogcollector import KerberosCollector, NTLMCollector
+from latma.hosts import HostCanonicalizer
+from latma.metrics import metrics
+from latma.pipeline import parse_batch
+from latma.scheduler import CollectionScheduler
+from latma.sinks import SINK_FORMATS, open_sink
+from latma.sources import EVENT_BULK_MAX, RpcEventSource
+from latma.utils import Credentials
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SCENARIOS = ('parse', 'sinks', 'collect', 'graph')
+REPORT_FILE_NAME = 'bench_report.json'
+DEFAULT_EVENTS = 200 * 1000
+# the BeautifulSoup parser is an order of magnitude slower, it parses a sample of the events only
+DEFAULT_LEGACY_EVENTS = 20 * 1000
+DEFAULT_EVENTS_PER_DOMAIN_CONTROLLER = 20 * 1000
+DEFAULT_SIGN_INS = 100 * 1000
+DEFAULT_THREADS = 5
+DEFAULT_GRAPH_THREADS = 4
+DEFAULT_REQUESTS_PER_SECOND = 1000
+# endpoint port the stand-in hosts are reachable on, hosts are never swept
+BENCH_ENDPOINT_PORT = 49152
+COLLECT_STAGES = ('host_connect_seconds', 'host_query_seconds', 'evtnext_seconds', 'host_fetch_seconds',
+                  'queue_put_wait_seconds', 'parse_wait_seconds', 'sink_write_seconds', 'checkpoint_seconds')
+GRAPH_STAGES = ('graph_request_seconds', 'graph_rate_limit_wait_seconds', 'graph_throttle_wait_seconds',
+                'sign_in_write_seconds')
+
+
+class BenchEventSource(RpcEventSource):
+    """
+    RpcEventSource over fixed synthetic targets that are all reachable, for use with a FakeEventLog.
+    """
+
+    def __init__(self, credentials, workstations):
+        super().__init__(credentials)
+        self.workstations = workstations
+
+    def list_targets(self):
+        return self.workstations
+
+    def preflight(self, workstations):
+        for workstation in workstations:
+            self.endpoints[self.target_name(workstation)] = BENCH_ENDPOINT_PORT
+            yield workstation
+
+
+def peak_rss():
+    """
+    :return: tuple of the peak resident set size in bytes of this process and of its largest finished child process,
+             e.g. a parser. None where the platform doesn't report it.
+    """
+    if resource is None:
+        return None, None
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def stage_timings(names=None):
+    """
+    :param names: summary names, default is all summaries
+    :return: dict of stage name to its count, total, mean and maximal seconds over all labels
+    """
+    stages = {}
+    for name, summaries in metrics.report()['summaries'].items():
+        if names is not None and name not in names:
+            continue
+        count = sum(summary['count'] for summary in summaries.values())
+        total = sum(summary['sum'] for summary in summaries.values())
+        stages[name] = {'count': count, 'sum': total, 'mean': total / count if count else 0,
+                        'max': max(summary['max'] for summary in summaries.values())}
+    return stages
+
+
+def _chunks(items, size):
+    return (items[start:start + size] for start in range(0, len(items), size))
+
+
+def _disk_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, file_name)) for root, _, files in os.walk(path)
+               for file_name in files)
+
+
+def _parse_all(batches, domain):
+    rows = []
+    for batch in batches:
+        with metrics.timer('parse_batch_seconds'):
+            rows.extend(parse_batch(batch, domain)[0])
+    return rows
+
+
+def bench_parse(environment, options, work_dir):
+    """
+    Parse synthetic events in a single process, the throughput of one parser process, compared with the BeautifulSoup
+    parser it replaced when bs4 is installed.
+    """
+    events = environment.mixed_events(options.events)
+    batches = list(_chunks(events, EVENT_BULK_MAX))
+    start = monotonic()
+    rows = _parse_all(batches, environment.domain)
+    elapsed = monotonic() - start
+    result = {'events': options.events, 'rows': len(rows), 'seconds': elapsed,
+              'events_per_second': options.events / elapsed, 'stages': stage_timings()}
+    if BeautifulSoup is None:
+        result['legacy'] = {'skipped': 'bs4 is not installed'}
+        return result
+    # every n-th event, the events are grouped by log
+    legacy_events = events[::max(1, len(events) // max(1, options.legacy_events))][:options.legacy_events]
+    start = monotonic()
+    for event in legacy_events:
+        legacy_parse_event(event, environment.domain)
+    legacy_elapsed = monotonic() - start
+    result['legacy'] = {'events': len(legacy_events), 'seconds': legacy_elapsed,
+                        'events_per_second': len(legacy_events) / legacy_elapsed}
+    return result
+
+
+def bench_sinks(environment, options, work_dir):
+    """
+    Write the parsed rows of synthetic events with every output format.
+    """
+    rows = _parse_all(_chunks(environment.mixed_events(options.events), EVENT_BULK_MAX), environment.domain)
+    results = {}
+    for output_format, aggregate in [(output_format, False) for output_format in SINK_FORMATS] + [('csv', True)]:
+        name = f"{output_format}_aggregated" if aggregate else output_format
+        sink_dir = os.path.join(work_dir, 'sinks', name)
+        shutil.rmtree(sink_dir, ignore_errors=True)
+        os.makedirs(sink_dir)
+        try:
+            sink = open_sink(output_format, base_name=os.path.join(sink_dir, 'logs'), aggregate=aggregate)
+        except RuntimeError as e:
+            logging.warning(f"Skipping {name} output: {e}")
+            results[name] = {'skipped': str(e)}
+            continue
+        start = monotonic()
+        for chunk in _chunks(rows, EVENT_BULK_MAX):
+            sink.writerows(chunk)
+        write_end = monotonic()
+        sink.close()
+        elapsed = monotonic() - start
+        results[name] = {'rows': len(rows), 'seconds': elapsed, 'write_seconds': write_end - start,
+                         'close_seconds': elapsed - (write_end - start), 'rows_per_second': len(rows) / elapsed,
+                         'bytes': _disk_size(sink_dir)}
+    return {'rows': len(rows), 'formats': results}
+
+
+def bench_collect(environment, options, work_dir):
+    """
+    Collect the NTLM logs of the domain controllers and the Kerberos logs of the hosts end to end, through the
+    collectors, the scheduler and the parse pipeline, from a FakeEventLog.
+    """
+    event_log = FakeEventLog(environment, options.events_per_host, options.events_per_dc,
+                             session_latency=options.session_latency, query_latency=options.query_latency,
+                             page_latency=options.page_latency, event_latency=options.event_latency)
+    credentials = Credentials('bench', 'bench', environment.domain)
+    host_canonicalizer = HostCanonicalizer(environment.domain, resolve_ips=False)
+    collect_dir = os.path.join(work_dir, 'collect')
+    shutil.rmtree(collect_dir, ignore_errors=True)
+    os.makedirs(collect_dir)
+    start = monotonic()
+    with installed(event_log), open_sink(options.output_format,
+                                         base_name=os.path.join(collect_dir, 'logs')) as output_sink:
+        collectors = [
+            NTLMCollector(credentials, None, None, options.threads, False, parsers=options.parsers,
+                          output_sink=output_sink, source=BenchEventSource(credentials, environment.workstations(True)),
+                          host_canonicalizer=host_canonicalizer),
+            KerberosCollector(credentials, None, None, options.threads, False, parsers=options.parsers,
+                              output_sink=output_sink, source=BenchEventSource(credentials, environment.workstations()),
+                              host_canonicalizer=host_canonicalizer),
+        ]
+        CollectionScheduler(collectors, options.threads, output_sink, parsers=options.parsers,
+                            host_canonicalizer=host_canonicalizer).run()
+    elapsed = monotonic() - start
+    events = metrics.total('events_read_total')
+    return {'hosts': len(environment.hosts) + len(environment.domain_controllers), 'events': events,
+            'rows': metrics.total('rows_written_total'), 'seconds': elapsed, 'events_per_second': events / elapsed,
+            'calls': event_log.calls, 'bytes': _disk_size(collect_dir), 'stages': stage_timings(COLLECT_STAGES)}
+
+
+def bench_graph(environment, options, work_dir):
+    """
+    Collect synthetic sign-ins from a SignInGraphServer with the Azure AD collector pager.
+    """
+    # the azure ad collector reads its config from the working directory when it is imported
+    from latma.azure_ad.aad_collector import SIGN_IN_LOGS_HEADER, get_aad_component, write_sign_in_logs
+    from latma.azure_ad.graph_client import GraphClient
+
+    sign_ins = environment.sign_ins(options.sign_ins)
+    graph_dir = os.path.join(work_dir, 'graph')
+    shutil.rmtree(graph_dir, ignore_errors=True)
+    os.makedirs(graph_dir)
+    first = datetime.strptime(min(sign_in['createdDateTime'] for sign_in in sign_ins), GRAPH_TIME_FORMAT)
+    since = (first - timedelta(seconds=1)).strftime(GRAPH_TIME_FORMAT)
+    start = monotonic()
+    with SignInGraphServer(sign_ins, page_size=options.page_size, latency=options.graph_latency,
+                           throttle_every=options.throttle_every, retry_after=options.retry_after) as server, \
+            GraphClient(lambda: 'bench-token', base_url=server.url, threads=options.graph_threads,
+                        requests_per_second=options.requests_per_second, burst=options.graph_threads,
+                        max_retry_wait=options.retry_after) as client, \
+            open_sink(options.output_format, header=SIGN_IN_LOGS_HEADER,
+                      base_name=os.path.join(graph_dir, 'cloud_logs')) as output_sink:
+        for page in get_aad_component(client, since):
+            with metrics.timer('sign_in_write_seconds'):
+                write_sign_in_logs(page, output_sink)
+    elapsed = monotonic() - start
+    written = metrics.total('sign_ins_written_total')
+    return {'sign_ins': len(sign_ins), 'written': written, 'pages': metrics.total('graph_pages_total'),
+            'requests': server.requests, 'throttled': server.throttled, 'seconds': elapsed,
+            'sign_ins_per_second': len(sign_ins) / elapsed, 'stages': stage_timings(GRAPH_STAGES)}
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'sinks': bench_sinks,
+    'collect': bench_collect,
+    'graph': bench_graph,
+}
+
+
+def _summary(scenario, result):
+    if scenario == 'sinks':
+        return ', '.join(f"{name} {format_result['rows_per_second']:.0f} rows/s "
+                         f"{format_result['bytes'] / 1024 ** 2:.1f}MB" for name, format_result in
+                         result['formats'].items() if 'skipped' not in format_result)
+    if scenario == 'graph':
+        return (f"{result['written']:.0f} of {result['sign_ins']} sign-ins in {result['seconds']:.1f}s, "
+                f"{result['sign_ins_per_second']:.0f} sign-ins/s, {result['pages']:.0f} pages, "
+                f"{result['throttled']} throttled")
+    summary = f"{result['events']:.0f} events in {result['seconds']:.1f}s, {result['events_per_second']:.0f} events/s"
+    if 'events_per_second' in result.get('legacy', {}):
+        summary += (f", {result['legacy']['events_per_second']:.0f} events/s with BeautifulSoup "
+                    f"({result['events_per_second'] / result['legacy']['events_per_second']:.1f}x)")
+    return summary
+
+
+def run_benchmarks(options, work_dir):
+    """
+    Run the benchmarks of the options in the working directory.
+    :param options: parsed runner arguments
+    :param work_dir: directory of the benchmark outputs
+    :return: benchmark report
+    """
+    if not os.path.exists('azure_config.json'):
+        with open('azure_config.json', 'w', encoding='utf-8') as config_file:
+            json.dump({'TENANT_ID': 'bench'}, config_file)
+    metrics.enabled = True
+    environment = SyntheticEnvironment(options.hosts, options.accounts, options.dcs, skew=options.skew,
+                                       seed=options.seed)
+    report = {'options': vars(options), 'work_dir': work_dir, 'scenarios': {}}
+    for scenario in dict.fromkeys(options.scenarios):
+        logging.info(f"Running the {scenario} benchmark")
+        metrics.reset()
+        result = BENCHMARKS[scenario](environment, options, work_dir)
+        result['peak_rss'], result['peak_child_rss'] = peak_rss()
+        report['scenarios'][scenario] = result
+        logging.info(f"{scenario}: {_summary(scenario, result)}")
+        for stage, timing in result.get('stages', {}).items():
+            logging.info(f"    {stage}: {timing['count']} calls, {timing['sum']:.2f}s total, "
+                         f"{timing['mean'] * 1000:.2f}ms mean, {timing['max'] * 1000:.1f}ms max")
+    self_rss, child_rss = peak_rss()
+    if self_rss is not None:
+        logging.info(f"Peak RSS {self_rss / 1024 ** 2:.0f}MB, largest child process {child_rss / 1024 ** 2:.0f}MB")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True, description="Measure the collector performance on synthetic "
+                                                                "events, with local stand-ins for remote event logs "
+                                                                "and Microsoft Graph")
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                        help=f"benchmarks to run, default is all of: {', '.join(SCENARIOS)}. Run a single benchmark "
+                             f"to measure its own peak RSS")
+    parser.add_argument('-hosts', type=int, default=DEFAULT_HOSTS, help=f'Amount of hosts. Default is {DEFAULT_HOSTS}')
+    parser.add_argument('-dcs', type=int, default=DEFAULT_DOMAIN_CONTROLLERS,
+                        help=f'Amount of domain controllers. Default is {DEFAULT_DOMAIN_CONTROLLERS}')
+    parser.add_argument('-accounts', type=int, default=DEFAULT_ACCOUNTS,
+                        help=f'Amount of accounts. Default is {DEFAULT_ACCOUNTS}')
+    parser.add_argument('-skew', type=float, default=DEFAULT_SKEW,
+                        help=f'Popularity skew of accounts and destinations, 0 is uniform. Default is {DEFAULT_SKEW}')
+    parser.add_argument('-seed', type=int, default=0, help='Seed of the synthetic data. Default is 0')
+    parser.add_argument('-events', type=int, default=DEFAULT_EVENTS,
+                        help=f'Amount of events of the parse and sinks benchmarks. Default is {DEFAULT_EVENTS}')
+    parser.add_argument('-legacy_events', type=int, default=DEFAULT_LEGACY_EVENTS,
+                        help=f'Amount of events the parse benchmark parses with the BeautifulSoup parser, when bs4 is '
+                             f'installed. Default is {DEFAULT_LEGACY_EVENTS}')
+    parser.add_argument('-events_per_host', type=int, default=DEFAULT_EVENTS_PER_HOST,
+                        help=f'Kerberos events of every host in the collect benchmark. '
+                             f'Default is {DEFAULT_EVENTS_PER_HOST}')
+    parser.add_argument('-events_per_dc', type=int, default=DEFAULT_EVENTS_PER_DOMAIN_CONTROLLER,
+                        help=f'NTLM events of every domain controller in the collect benchmark. '
+                             f'Default is {DEFAULT_EVENTS_PER_DOMAIN_CONTROLLER}')
+    parser.add_argument('-session_latency', type=float, default=0, help='Seconds opening a session takes')
+    parser.add_argument('-query_latency', type=float, default=0, help='Seconds querying a log takes')
+    parser.add_argument('-page_latency', type=float, default=0, help='Seconds fetching a page of events takes')
+    parser.add_argument('-event_latency', type=float, default=0,
+                        help='Additional seconds fetching a page takes per event')
+    parser.add_argument('-threads', type=int, default=DEFAULT_THREADS,
+                        help=f'Collector working threads. Default is {DEFAULT_THREADS}')
+    parser.add_argument('-parsers', type=int, default=None,
+                        help='Event parsing processes. Default is the number of CPUs')
+    parser.add_argument('-output_format', choices=list(SINK_FORMATS), default='csv',
+                        help='Output format of the collect and graph benchmarks. Default is csv')
+    parser.add_argument('-sign_ins', type=int, default=DEFAULT_SIGN_INS,
+                        help=f'Amount of sign-ins of the graph benchmark. Default is {DEFAULT_SIGN_INS}')
+    parser.add_argument('-page_size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help=f'Sign-ins per graph page. Default is {DEFAULT_PAGE_SIZE}')
+    parser.add_argument('-graph_latency', type=float, default=0, help='Seconds every graph page takes')
+    parser.add_argument('-throttle_every', type=int, default=0,
+                        help='Throttle every n-th graph request. Default is 0, never throttle')
+    parser.add_argument('-retry_after', type=int, default=DEFAULT_RETRY_AFTER,
+                        help=f'Retry-After seconds of throttled graph requests. Default is {DEFAULT_RETRY_AFTER}')
+    parser.add_argument('-graph_threads', type=int, default=DEFAULT_GRAPH_THREADS,
+                        help=f'Concurrent graph queries. Default is {DEFAULT_GRAPH_THREADS}')
+    parser.add_argument('-requests_per_second', type=float, default=DEFAULT_REQUESTS_PER_SECOND,
+                        help=f'Graph request rate limit. Default is {DEFAULT_REQUESTS_PER_SECOND}')
+    parser.add_argument('-work_dir', default=None,
+                        help='Directory of the benchmark outputs, kept after the run. Default is a new temporary '
+                             'directory, removed after the run')
+    parser.add_argument('-report', default=REPORT_FILE_NAME,
+                        help=f'Json report path, relative to the current directory. Default is {REPORT_FILE_NAME}')
+    parser.add_argument('-debug', action='store_true', help='Turn DEBUG output ON')
+    options = parser.parse_args()
+    unknown = [scenario for scenario in options.scenarios if scenario not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks {', '.join(unknown)}, choose from {', '.join(SCENARIOS)}")
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    # the benchmarks run in the work directory, the report is written where the runner was invoked
+    report_path = os.path.abspath(options.report)
+    invoking_dir = os.getcwd()
+    work_dir = os.path.abspath(options.work_dir or tempfile.mkdtemp(prefix='latma-bench-'))
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    try:
+        report = run_benchmarks(options, work_dir)
+    finally:
+        os.chdir(invoking_dir)
+        if options.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    with open(report_path, 'w', encoding='utf-8') as report_file:
+        json.dump(report, report_file, indent=2)
+    logging.info(f"Wrote the benchmark report to {report_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import logging
+import math
+import os
+import sqlite3
+
+import numpy as np
+
+DEDUP_FILE_NAME = "collector_dedup"
+DEFAULT_CAPACITY = 10 * 1000 * 1000
+DEFAULT_ERROR_RATE = 0.01
+REBUILD_CHUNK_SIZE = 1000 * 1000
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS sources (
+        id INTEGER PRIMARY KEY,
+        host TEXT NOT NULL,
+        log TEXT NOT NULL,
+        UNIQUE (host, log)
+    )""",
+    """CREATE TABLE IF NOT EXISTS seen (
+        source INTEGER NOT NULL,
+        record_id INTEGER NOT NULL,
+        PRIMARY KEY (source, record_id)
+    ) WITHOUT ROWID""",
+]
+_ONE = np.uint64(1)
+_GOLDEN_GAMMA = np.uint64(0x9e3779b97f4a7c15)
+_MIX_1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX_2 = np.uint64(0x94d049bb133111eb)
+
+
+def _mix(values):
+    """
+    splitmix64 finalizer, spreads consecutive record ids over the whole filter.
+    """
+    values = (values ^ (values >> np.uint64(30))) * _MIX_1
+    values = (values ^ (values >> np.uint64(27))) * _MIX_2
+    return values ^ (values >> np.uint64(31))
+
+
+class DedupIndex:
+    """
+    Persistent set of the collected (host, log, EventRecordID) keys, used to drop events that were already written
+    by a previous run or by an overlapping source.
+    Keys are kept in a sqlite table, in front of which a memory mapped Bloom filter answers most lookups of new keys
+    without touching the table. A key the filter reports as seen is looked up in the table, so false positives never
+    drop an event. New keys are kept in memory until they are committed.
+    """
+
+    def __init__(self, path=DEDUP_FILE_NAME, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        """
+        :param path: index file path without extension, keys are kept in path.db and the filter in path.bloom
+        :param capacity: expected amount of keys. Beyond it the filter sends more lookups to the table.
+        :param error_rate: false positive rate of the filter at its capacity
+        """
+        self.path = path
+        self.bit_count = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.duplicates = 0
+        self.pending = set()
+        self.conn = sqlite3.connect(f"{path}.db", check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            for statement in _SCHEMA:
+                self.conn.execute(statement)
+        self.sources = {(host, log): source
+                        for source, host, log in self.conn.execute("SELECT id, host, log FROM sources")}
+        self.bits = self._open_filter(f"{path}.bloom")
+
+    def _open_filter(self, bloom_path):
+        """
+        Map the filter file, rebuilding it from the key table if it is missing or was sized for another capacity.
+        """
+        size = (self.bit_count + 7) // 8
+        rebuild = not os.path.exists(bloom_path) or os.path.getsize(bloom_path) != size
+        if rebuild:
+            with open(bloom_path, 'wb') as bloom_file:
+                bloom_file.truncate(size)
+        bits = np.memmap(bloom_path, dtype=np.uint8, mode='r+', shape=(size,))
+        if rebuild:
+            self.bits = bits
+            cursor = self.conn.execute("SELECT source, record_id FROM seen")
+            while True:
+                keys = cursor.fetchmany(REBUILD_CHUNK_SIZE)
+                if not keys:
+                    break
+                self._add(np.array(keys, dtype=np.uint64))
+            bits.flush()
+            logging.debug(f"Rebuilt deduplication filter {bloom_path}")
+        return bits
+
+    def _positions(self, keys):
+        """
+        :param keys: array of (source id, EventRecordID) rows
+        :return: array of the filter bit positions of every key, one row per key
+        """
+        first = _mix(keys[:, 0] * _GOLDEN_GAMMA + keys[:, 1])
+        second = _mix(first ^ _GOLDEN_GAMMA) | _ONE
+        steps = np.arange(self.hash_count, dtype=np.uint64)
+        return (first[:, None] + steps[None, :] * second[:, None]) % np.uint64(self.bit_count)
+
+    def _add(self, keys):
+        positions = self._positions(keys).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                         np.left_shift(_ONE, positions & np.uint64(7)).astype(np.uint8))
+
+    def _source_id(self, host, log):
+        source = self.sources.get((host, log))
+        if source is None:
+            source = self.conn.execute("INSERT INTO sources (host, log) VALUES (?, ?)", (host, log)).lastrowid
+            self.sources[(host, log)] = source
+        return source
+
+    def filter(self, rows, keys):
+        """
+        Drop the rows of already seen events and remember the keys of the rest.
+        New keys become permanent on the next commit.
+        :param rows: output rows
+        :param keys: (host, log, EventRecordID) of every row. Rows without an EventRecordID are always kept.
+        :return: tuple of (list of rows of unseen events, list of their keys)
+        """
+        if not rows:
+            return rows, keys
+        key_ids = np.array([(self._source_id(host, log), record_id) for host, log, record_id in keys],
+                           dtype=np.uint64)
+        positions = self._positions(key_ids)
+        maybe_seen = np.all(self.bits[positions >> np.uint64(3)] & np.left_shift(_ONE, positions & np.uint64(7)),
+                            axis=1)
+        kept = []
+        kept_keys = []
+        new_keys = []
+        for row, key, (source, record_id), seen in zip(rows, keys, key_ids.tolist(), maybe_seen.tolist()):
+            if record_id:
+                if (source, record_id) in self.pending or seen and self.conn.execute(
+                        "SELECT 1 FROM seen WHERE source=? AND record_id=?", (source, record_id)).fetchone():
+                    self.duplicates += 1
+                    continue
+                self.pending.add((source, record_id))
+                new_keys.append((source, record_id))
+            kept.append(row)
+            kept_keys.append(key)
+        if new_keys:
+            self._add(np.array(new_keys, dtype=np.uint64))
+        return kept, kept_keys
+
+    def commit(self, held_keys=()):
+        """
+        Make the keys of written rows permanent. The filter is flushed first, so it always covers the committed keys.
+        :param held_keys: (host, log, EventRecordID) of rows that were not written yet, kept in memory until a later
+                          commit
+        """
+        held = {(self._source_id(host, log), record_id) for host, log, record_id in held_keys}
+        self.conn.executemany("INSERT OR IGNORE INTO seen (source, record_id) VALUES (?, ?)",
+                              [key for key in self.pending if key not in held])
+        self.pending &= held
+        self.bits.flush()
+        self.conn.commit()
+
+    def close(self):
+        if self.duplicates:
+            logging.info(f"Skipped {self.duplicates} already collected events")
+        self.bits.flush()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
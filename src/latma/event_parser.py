@@ -0,0 +1,113 @@
+import re
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+
+from lxml import etree
+
+KERBEROS = 'KERBEROS'
+NTLM = 'NTLM'
+NTLM_EVENT_ID = '8004'
+KERBEROS_EVENT_ID = '4648'
+TIMESTAMP_FORMAT = '%d/%m/%Y %H:%M'
+EVENT_NAMESPACES = {'e': 'http://schemas.microsoft.com/win/2004/08/events/event'}
+
+_XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=True)
+_EVENT_ID = etree.XPath("string(e:System/e:EventID)", namespaces=EVENT_NAMESPACES)
+_RECORD_ID = etree.XPath("string(e:System/e:EventRecordID)", namespaces=EVENT_NAMESPACES)
+_SYSTEM_TIME = etree.XPath("string(e:System/e:TimeCreated/@SystemTime)", namespaces=EVENT_NAMESPACES)
+_COMPUTER = etree.XPath("string(e:System/e:Computer)", namespaces=EVENT_NAMESPACES)
+_CHANNEL = etree.XPath("string(e:System/e:Channel)", namespaces=EVENT_NAMESPACES)
+_DATA = etree.XPath("e:EventData/e:Data", namespaces=EVENT_NAMESPACES)
+_RECORD_ID_REGEX = re.compile(r'<EventRecordID>(\d+)</EventRecordID>')
+
+
+class EventRecord(NamedTuple):
+    event_id: str
+    record_id: int
+    system_time: Optional[str]
+    computer: str
+    channel: str
+    data: dict
+
+
+def format_system_time(system_time):
+    """
+    Convert an event SystemTime attribute to the collector output timestamp format.
+    :param system_time: ISO formatted SystemTime, e.g. 2022-05-01T10:11:12.1234567Z
+    :return: timestamp string truncated to minutes, None if the event has no creation time.
+    """
+    if not system_time:
+        return None
+    return datetime.fromisoformat(system_time[:23]).astimezone(timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+def get_record_id(event_xml):
+    """
+    Extract the EventRecordID of a rendered event without parsing it.
+    :param event_xml: event xml string
+    :return: EventRecordID, None if the event has none.
+    """
+    record_id = _RECORD_ID_REGEX.search(event_xml)
+    return int(record_id.group(1)) if record_id else None
+
+
+def decode_event(event_xml) -> EventRecord:
+    """
+    Decode a rendered event xml using precompiled XPath expressions.
+    :param event_xml: event xml as rendered by EvtRender, str or bytes
+    :return: EventRecord with the event data fields keyed by their Name attribute.
+    """
+    if isinstance(event_xml, str):
+        event_xml = event_xml.encode('utf-8')
+    root = etree.fromstring(event_xml, _XML_PARSER)
+    record_id = _RECORD_ID(root)
+    data = {element.get('Name'): element.text or '' for element in _DATA(root)}
+    return EventRecord(_EVENT_ID(root), int(record_id) if record_id else 0, _SYSTEM_TIME(root) or None,
+                       _COMPUTER(root), _CHANNEL(root), data)
+
+
+def ntlm_row(event: EventRecord, domain):
+    """
+    Build an output row from an NTLM (8004) event.
+    :param event: decoded event
+    :param domain: domain appended to the NETBIOS names in the event
+    """
+    data = event.data
+    dest = f"{data.get('SChannelName', '')}@{domain}".lower()
+    user_name = data.get('UserName', '').lower()
+    source = f"{data.get('WorkstationName', '')}@{domain}".lower()
+    return [user_name, source, dest, "-", format_system_time(event.system_time), NTLM]
+
+
+def kerberos_row(event: EventRecord, domain=None):
+    """
+    Build an output row from an explicit credentials logon (4648) event.
+    :param event: decoded event
+    :param domain: unused, kept for a uniform row builder signature
+    """
+    data = event.data
+    dest = data.get('TargetServerName', '').lower()
+    user_name = data.get('TargetUserName', '').lower()
+    source = event.computer.lower()
+    spn = data.get('TargetInfo', '').lower()
+    return [user_name, source, dest, spn, format_system_time(event.system_time), KERBEROS]
+
+
+ROW_BUILDERS = {
+    NTLM_EVENT_ID: ntlm_row,
+    KERBEROS_EVENT_ID: kerberos_row,
+}
+
+
+def parse_event(event_xml, domain):
+    """
+    Decode a rendered event and convert it to an output row.
+    :param event_xml: event xml as rendered by EvtRender
+    :param domain: collecting user domain
+    :return: [username, source host, destination, spn, timestamp, auth type], None for unsupported events.
+    """
+    event = decode_event(event_xml)
+    row_builder = ROW_BUILDERS.get(event.event_id)
+    if row_builder is None:
+        return None
+    return row_builder(event, domain)
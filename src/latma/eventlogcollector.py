@@ -1,219 +1,201 @@
 import argparse
-import concurrent.futures
-import csv
-from datetime import datetime, timezone
-from queue import Queue
-from threading import Thread
-from time import sleep
-import pywintypes
-import win32evtlog
-from bs4 import BeautifulSoup
+from datetime import datetime
+import multiprocessing
+import sys
+from time import monotonic
+
+from latma.dedup import DEDUP_FILE_NAME, DedupIndex
+from latma.event_parser import KERBEROS, KERBEROS_EVENT_ID, NTLM, NTLM_EVENT_ID, get_record_id
+from latma.filters import build_filter
+from latma.hosts import HostCanonicalizer
+from latma.inventory import ComputerInventory
+from latma.metrics import PROGRESS_INTERVAL, ProgressReporter, metrics
+from latma.reachability import REACHABILITY_TTL
+from latma.scheduler import DEFAULT_TARGET_SESSIONS, CollectionScheduler
+from latma.shards import HostShard
+from latma.sinks import SINK_FORMATS, open_sink
+from latma.sources import EventQuery, EvtxFileEventSource, RpcEventSource
+from latma.state import STATE_FILE_NAME, StateStore
 from latma.utils import *
 import os
 
-EVENT_BULK_NUM = 1024
-DUMP_CHUNK_SIZE = 20
-OUTPUT_FILE_NAME = "logs.csv"
-KERBEROS = 'KERBEROS'
-NTLM = 'NTLM'
+OUTPUT_FILE_NAME = "logs"
 SUPPORTED_OS = 'windows'
+# counters of the periodic progress line
+PROGRESS_FIELDS = [('hosts done', 'hosts_completed_total'), ('events read', 'events_read_total'),
+                   ('events parsed', 'events_parsed_total'), ('rows written', 'rows_written_total')]
 
 
 class Collector:
-    def __init__(self, admin_credentials: Credentials, start_date, search_base_filter, threads, use_ldap):
+    priority = 0
+
+    def __init__(self, admin_credentials: Credentials, start_date, search_base_filter, threads, use_ldap, parsers=None,
+                 output_sink=None, state_store=None, source=None, inventory=None, host_canonicalizer=None,
+                 event_filter=None, shard=None):
         self.use_ldap = use_ldap
         self.start_date = start_date
+        self.evt_log_num = None
         self.evtx_path = None
         self.evtx_query = None
+        self.event_filter = event_filter
+        self.state_store = state_store
         self.type = None
-        self.csv_output_file = None
         self.workstation_list_size = 0
         self.credentials = admin_credentials
         self.thread_num = threads
-        self.csv_handle = self.init_csv_output_file()
+        self.parser_num = parsers
+        self.output_sink = output_sink
         self.workstation_list = []
-        self.is_done = False
-        self.authn_queue = Queue()
+        self.pipeline = None
         self.search_base_filter = search_base_filter
+        self.source = source or RpcEventSource(admin_credentials)
+        self.inventory = inventory
+        self.host_canonicalizer = host_canonicalizer
+        self.shard = shard
 
-    def init_csv_output_file(self):
-        """
-        initializes csv output file, adding a header if file doesn't exist.
-        :return: csv file handle.
+    def build_host_query(self, workstation, min_record_id=0) -> EventQuery:
         """
-        csv_buf_size = 1
-        file_exists = os.path.isfile(OUTPUT_FILE_NAME)
-        self.csv_output_file = open(OUTPUT_FILE_NAME, "a", csv_buf_size, newline='', encoding='utf-8')
-        csv_writer = csv.writer(self.csv_output_file)
-        if not file_exists:
-            csv_writer.writerow(
-                ["username", "source host", "destination", "spn", "timestamp", "auth type"])
-        return csv_writer
-
-    def connect_to_evtx(self, host):
+        Build the event query of a host, resuming after its last committed watermark if one exists.
+        :param workstation: target name, remote hostname fqdn string or exported log file
+        :param min_record_id: EventRecordID already read during this run, resume after it if above the watermark
+        :return: EventQuery
         """
-        Connect and authenticate a host to a remote event viewer.
-        :param host: NETBIOS name or ip
-        :return: rpc session handle
-        """
-        try:
-            handle = win32evtlog.EvtOpenSession(
-                Login=(host, self.credentials.username, self.credentials.domain, self.credentials.password,
-                       win32evtlog.EvtRpcLoginAuthDefault),
-                Timeout=0, Flags=0)
-            return handle
-        except Exception as e:
-            logging.exception(f"Unable to open session to {host}: ")
-
-    def query_evtx(self, session_handle, workstation):
+        watermark = self.state_store.get_watermark(workstation, self.evtx_path) if self.state_store else None
+        if watermark is not None and watermark[0] >= min_record_id:
+            min_record_id = watermark[0]
+            logging.debug(f"Resuming {workstation} after EventRecordID {watermark[0]} ({watermark[1]})")
+        event_filter = self.event_filter.for_host(workstation) if self.event_filter is not None else None
+        if not min_record_id and event_filter is self.event_filter:
+            return EventQuery(self.evtx_path, self.evt_log_num, self.evtx_query, self.start_date)
+        query = evtx_query_builder(self.evt_log_num, self.evtx_path, start_date=self.start_date,
+                                   min_record_id=min_record_id, event_filter=event_filter)
+        return EventQuery(self.evtx_path, self.evt_log_num, query, self.start_date, min_record_id)
+
+    def load_targets(self, ldap_filter, dc_only=False):
         """
-        Query event viewer according to the required filter.
-        :param workstation:
-        :param session_handle: RPC authenticated Session handle
-        :return: Handle to query results.
+        Set the workstation list from the event source. If the source has no targets of its own, take them from the
+        computer inventory, or stream them from LDAP when there is no inventory. A sharded collector keeps the targets
+        of its shard only.
+        :param ldap_filter: LDAP filter of the hosts holding the collected logs
+        :param dc_only: the LDAP filter matches domain controllers only
         """
-        try:
-            handle = win32evtlog.EvtQuery(self.evtx_path, win32evtlog.EvtQueryReverseDirection,
-                                          self.evtx_query, Session=session_handle)
-        except pywintypes.error as e:
-            logging.error(f"Unable to query {workstation}: {e.strerror}")
-            return None
-        return handle
+        targets = self.source.list_targets()
+        if targets is None and self.inventory is not None:
+            targets = self.inventory.workstations(dc_only, self.search_base_filter, SUPPORTED_OS)
+        if targets is None:
+            self.workstation_list = self.query_workstations(ldap_filter)
+            return
+        if self.shard is not None:
+            targets = [target for target in targets if self.shard.owns(self.source.target_name(target))]
+        self.workstation_list = targets
+        self.workstation_list_size = len(self.workstation_list)
 
     def query_workstations(self, ldap_filter):
         """
-        Retrieve Kerberos event logs algorithm.
+        Enumerate the supported workstations matching an LDAP filter. Hosts are yielded as LDAP result pages arrive,
+        so collection starts before the enumeration is done.
+        :param ldap_filter: LDAP filter of the hosts holding the collected logs
+        :return: generator of LDAP workstation entries
         """
         ldap_conn = Ldap(self.credentials.domain, self.credentials.username, self.credentials.password, self.use_ldap, self.credentials.ldap_domain)
+        ldap_filter = f"(&{ldap_filter}(dNSHostName=*)(operatingSystem=*{SUPPORTED_OS}*))"
 
         for workstation in ldap_conn.get_workstations(ldap_filter, self.search_base_filter):
             if workstation.get('raw_dn') and workstation['attributes']['dNSHostName'] and workstation['attributes'][
                 'operatingSystem']:
                 if SUPPORTED_OS in workstation['attributes'].get('operatingSystem').lower():
-                    self.workstation_list.append(workstation)
-        self.workstation_list_size = len(self.workstation_list)
-
-    def parse_events(self):
-        events = []
-        while True:
-            if self.authn_queue.empty():
-                if self.is_done:
-                    break
-                sleep(1)
-                continue
-            event = self.authn_queue.get()
-            system_time = None
-            tree = BeautifulSoup(event, 'xml')
-            data = tree.find_all("Data")
-            for time in tree.find_all("TimeCreated"):
-                system_time = datetime.fromisoformat(time['SystemTime'][:23]).astimezone(timezone.utc).strftime(
-                    '%d/%m/%Y %H:%M')
-            user_name, source, dest, spn, auth_type = self.parse_protocol(data, tree)
-            events.append([user_name, source, dest, spn, system_time, auth_type])
-            if len(events) == DUMP_CHUNK_SIZE:
-                self.csv_handle.writerows(events)
-                events = []
-            self.authn_queue.task_done()
-
-    def parse_protocol(self, data, tree=None):
-        """
-        Parse protocol specific event.
-        :param data: BS4 type sub tree "data"
-        :param tree: BS4 type tree, xml formatted
-        """
-        pass
+                    if self.host_canonicalizer is not None:
+                        self.host_canonicalizer.add_workstation(workstation)
+                    if self.shard is not None and not self.shard.owns(workstation['attributes']['dNSHostName']):
+                        continue
+                    self.workstation_list_size += 1
+                    yield workstation
 
     def get_evtx_logs(self):
         """
         Iterate over all remote hosts and get event logs using multithreading.
+        Fetched events are parsed by a pool of parser processes and written to the output file.
         """
-        logging.info(f"Collecting authentication logs type: {self.type} from {len(self.workstation_list)} Hosts ")
-        parser_thread = Thread(target=self.parse_events)
-        parser_thread.start()
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_num) as executor:
-            executor.map(self.get_single_workstation, self.workstation_list)
-        self.is_done = True
-        parser_thread.join()
+        if self.output_sink is None:
+            self.output_sink = open_sink(base_name=OUTPUT_FILE_NAME)
+        CollectionScheduler([self], self.thread_num, self.output_sink, parsers=self.parser_num,
+                            state_store=self.state_store, history_store=self.state_store,
+                            host_canonicalizer=self.host_canonicalizer).run()
 
-    def _collect_events(self, handle, workstation):
+    def describe_targets(self, description):
         """
-        Collect event logs using pywin32. Run over all logs in bulks of 1024 messages (maximum)
-        :param handle: handle to a remote host-  authenticated and queried event viewer .
+        :param description: name of the collected hosts
+        :return: printable amount of collection targets.
         """
-        offset = 0
-        while True:
-            try:
-                events = win32evtlog.EvtNext(handle, EVENT_BULK_NUM, -1, 0)
-            except pywintypes.error as e:
-                logging.error(f"Unable to collect events from {workstation}: {e.strerror}")
-                break
-            for event in events:
-                self.authn_queue.put(win32evtlog.EvtRender(event, 1))
-
-            offset += EVENT_BULK_NUM
-            win32evtlog.EvtSeek(handle, offset, win32evtlog.EvtSeekRelativeToFirst)
-            if not events:
-                return
-
-    def get_single_workstation(self, workstation):
+        if isinstance(self.workstation_list, list):
+            return f"{self.workstation_list_size} {description}"
+        return f"{description}, enumerated from LDAP during collection"
+
+    def get_single_workstation(self, workstation, deadline=None, min_record_id=0):
         """
-        Authenticate and query a remote host.
-        :param workstation: remote hostname fqdn string
-        :return:
+        Read the events of a single target and hand them to the parse stage.
+        :param workstation: collection target of the event source
+        :param deadline: monotonic time to stop reading at, the rest of the events can be read by a later call
+        :param min_record_id: EventRecordID already read from the target during this run
+        :return: tuple of (amount of events read, EventRecordID to resume after). The EventRecordID is None when all
+                 events were read.
         """
-        workstation = workstation['attributes']['dNSHostName']
-        logging.debug(f"Connecting to {workstation}")
-        if not test_connection(workstation):
-            return
-        session_handle = self.connect_to_evtx(workstation)
-        query_handle = self.query_evtx(session_handle, workstation)
-        if query_handle is None:
-            return
-
-        self._collect_events(query_handle, workstation)
+        workstation = self.source.target_name(workstation)
+        event_count = 0
+        batches = self.source.read(workstation, self.build_host_query(workstation, min_record_id))
+        try:
+            for batch in batches:
+                if not batch:
+                    continue
+                self.pipeline.put(batch, (workstation, self.evtx_path))
+                event_count += len(batch)
+                min_record_id = get_record_id(batch[-1]) or min_record_id
+                if deadline is not None and monotonic() > deadline:
+                    return event_count, min_record_id
+        finally:
+            batches.close()
+        return event_count, None
 
 
 class NTLMCollector(Collector):
-    def __init__(self, admin_credentials: Credentials, start_date, search_base_filter, threads, use_ldap):
-        super().__init__(admin_credentials, start_date, search_base_filter, threads, use_ldap)
-        evt_log_num = '8004'
+    # few, large domain controller logs go first so they overlap with the endpoints
+    priority = 0
+
+    def __init__(self, admin_credentials: Credentials, start_date, search_base_filter, threads, use_ldap, parsers=None,
+                 output_sink=None, state_store=None, source=None, inventory=None, host_canonicalizer=None,
+                 event_filter=None, shard=None):
+        super().__init__(admin_credentials, start_date, search_base_filter, threads, use_ldap, parsers, output_sink,
+                         state_store, source, inventory, host_canonicalizer, event_filter, shard)
+        self.evt_log_num = '8004'
         self.evtx_path = "Microsoft-Windows-NTLM/Operational"
+        self.event_filter = self.event_filter or build_filter(self.evt_log_num)
         if search_base_filter is not None:
             if input("NTLM reaches for domain controllers only. Do you want to limit ldap RDN for NTLM? (y/n)") != "y":
                 self.search_base_filter = None
-        self.evtx_query = evtx_query_builder(evt_log_num, self.evtx_path, start_date=start_date)
+        self.evtx_query = evtx_query_builder(self.evt_log_num, self.evtx_path, start_date=start_date,
+                                             event_filter=self.event_filter)
         self.type = NTLM
         ldap_dc_filter = "(&(objectCategory=computer)(|(userAccountControl:1.2.840.113556.1.4.803:=8192)(primaryGroupID=521)))"
-        self.query_workstations(ldap_dc_filter)
-
-    def parse_protocol(self, data, tree=None):
-        dest = f"{data[0].get_text()}@{self.credentials.domain}".lower()
-        user_name = data[1].get_text().lower()
-        source = f"{data[3].get_text()}@{self.credentials.domain}".lower()
-        spn = "-"
-        return user_name, source, dest, spn, self.type
+        self.load_targets(ldap_dc_filter, dc_only=True)
 
 
 class KerberosCollector(Collector):
-    def __init__(self, admin_credentials: Credentials, start_date, search_base_filter, threads, use_ldap):
-        super().__init__(admin_credentials, start_date, search_base_filter, threads, use_ldap)
-        evt_log_num = '4648'
-        supress_query = "*[EventData[Data[@Name='TargetServerName'] and (Data='localhost')]]"
+    priority = 1
+
+    def __init__(self, admin_credentials: Credentials, start_date, search_base_filter, threads, use_ldap, parsers=None,
+                 output_sink=None, state_store=None, source=None, inventory=None, host_canonicalizer=None,
+                 event_filter=None, shard=None):
+        super().__init__(admin_credentials, start_date, search_base_filter, threads, use_ldap, parsers, output_sink,
+                         state_store, source, inventory, host_canonicalizer, event_filter, shard)
+        self.evt_log_num = '4648'
+        self.event_filter = self.event_filter or build_filter(self.evt_log_num)
         self.search_base_filter = search_base_filter
         self.evtx_path = 'Security'
-        self.evtx_query = evtx_query_builder(evt_log_num, self.evtx_path, start_date=start_date,
-                                             suppress_query=supress_query)
+        self.evtx_query = evtx_query_builder(self.evt_log_num, self.evtx_path, start_date=start_date,
+                                             event_filter=self.event_filter)
         self.type = KERBEROS
         ldap_workstations_filter = "(&(objectCategory=Computer))"
-        self.query_workstations(ldap_workstations_filter)
-
-    def parse_protocol(self, data, tree=None):
-        dest = data[8].get_text().lower()
-        user_name = data[5].get_text().lower()
-        source = tree.find("Computer").get_text().lower()
-        spn = data[9].get_text().lower()
-        return user_name, source, dest, spn, self.type
+        self.load_targets(ldap_workstations_filter)
 
 
 def main():
@@ -230,6 +212,19 @@ def main():
                         help='Retrieve kerberos authentication logs from all computers in the domain')
     parser.add_argument('-threads', action='store', type=int,
                         help='Amount of working threads to use. Default is 5 threads', default=5)
+    parser.add_argument('-host_sessions', action='store', type=int, default=DEFAULT_TARGET_SESSIONS,
+                        help=f'Maximal amount of concurrent collection sessions against a single host. '
+                             f'Default is {DEFAULT_TARGET_SESSIONS}')
+    parser.add_argument('-parsers', action='store', type=int,
+                        help='Amount of event parsing processes to use. Default is the number of CPUs, '
+                             '0 parses in the collecting process', default=None)
+    parser.add_argument('-output_format', action='store', choices=list(SINK_FORMATS), default='csv',
+                        help='Output file format. Default is csv')
+    parser.add_argument('-output', action='store', default=None,
+                        help='Output file path. Default is logs with the output format extension')
+    parser.add_argument('-aggregate', action='store_true',
+                        help='Collapse identical authentications of the same minute into a single row with a count '
+                             'column. Default output path is logs_aggregated with the output format extension')
     parser.add_argument("-date", type=lambda s: datetime.strptime(s, '%m-%d-%Y'),
                         help="Starting date to collect event logs from. month-day-year format", default=None)
     parser.add_argument("-filter", action='store',
@@ -239,6 +234,64 @@ def main():
                              "Supports multiple OUs with a semicolon delimiter.\n"
                              "Example: OU=subunit,OU=unit;OU=anotherUnit,DC=domain,DC=com\n"
                              "Example: CN=container,OU=unit;OU=anotherUnit,DC=domain,DC=com")
+    parser.add_argument('-state', action='store', default=STATE_FILE_NAME,
+                        help=f'Collector state file, keeps the last collected event of every host so re-runs only '
+                             f'collect new events. Default is {STATE_FILE_NAME}')
+    parser.add_argument('-full', action='store_true',
+                        help='Ignore the stored watermarks and collect all available events')
+    parser.add_argument('-dedup_index', action='store', default=DEDUP_FILE_NAME,
+                        help=f'Deduplication index path, keeps the keys of all written events so events collected '
+                             f'twice are written once. Default is {DEDUP_FILE_NAME}')
+    parser.add_argument('-no_dedup', action='store_true',
+                        help='Write all collected events, even if a previous run already wrote them')
+    parser.add_argument('-host_timeout', action='store', type=int, default=None,
+                        help='Maximal seconds to spend fetching events from a single host. Remaining events are '
+                             'collected on the next run. Default is no limit')
+    parser.add_argument('-host_max_events', action='store', type=int, default=None,
+                        help='Maximal amount of events to fetch from a single host per run. Default is no limit')
+    parser.add_argument('-reachability_ttl', action='store', type=int, default=REACHABILITY_TTL,
+                        help=f'Seconds to reuse cached host reachability checks from the collector state. '
+                             f'Default is {REACHABILITY_TTL}, 0 checks all hosts again')
+    parser.add_argument('-no_inventory', action='store_true',
+                        help='Enumerate hosts directly from LDAP instead of the local computer inventory')
+    parser.add_argument('-refresh_inventory', action='store_true',
+                        help='Fetch all computer objects into the local computer inventory instead of only the '
+                             'objects changed since the last run')
+    parser.add_argument('-relevant_only', action='store_true',
+                        help='Collect only the authentications of the analyzer authentication graph, skipping self '
+                             'authentications and Kerberos services other than rpc, rpcss and termsrv. Only Kerberos '
+                             'logons of a host to its own names are suppressed by the event query. The service and '
+                             'self authentication rules run in the parsers after the events are fetched, so they '
+                             'shrink the output but not the events transferred from the hosts. The skipped '
+                             'authentications are not learned by the analyzer')
+    parser.add_argument('-exclude_accounts', action='store', default=None,
+                        help='Semicolon delimited account names whose authentications are not collected, filtered '
+                             'on the collected hosts')
+    parser.add_argument('-raw_hosts', action='store_true',
+                        help='Write host names as they appear in the events instead of their canonical NETBIOS names')
+    parser.add_argument('-no_dns', action='store_true',
+                        help='Keep IP addresses in the output instead of resolving them to host names with reverse DNS')
+    parser.add_argument('-evtx', action='store', nargs='+', default=None,
+                        help='Read exported .evtx or xml event log files, or directories of them, instead of '
+                             'collecting from remote hosts. Does not require LDAP or RPC access')
+    parser.add_argument('-shards', action='store', type=int, default=1,
+                        help='Amount of cooperating collector workers. Every worker collects the hosts of its shard, '
+                             'assigned by consistent hashing of their dNSHostName, and writes its own output, state '
+                             'and deduplication index, named after its shard. State files are named after the shard '
+                             'index only and hosts that move between shards keep their watermarks. Merge the outputs '
+                             'with: python -m latma.shards merge. Default is 1')
+    parser.add_argument('-shard', action='store', type=int, default=0,
+                        help='Shard of this worker, 0 to the amount of shards - 1. Default is 0')
+    parser.add_argument('-metrics_json', action='store', default=None,
+                        help='Write a json run report with the collection metrics, including the connect, query and '
+                             'fetch timings of every host, to this path')
+    parser.add_argument('-metrics_textfile', action='store', default=None,
+                        help='Write the collection metrics in the Prometheus text format to this path, refreshed '
+                             'with every progress line, e.g. for the node exporter textfile collector')
+    parser.add_argument('-progress_interval', action='store', type=int, default=PROGRESS_INTERVAL,
+                        help=f'Seconds between progress lines. Progress lines count hosts, events and rows, the '
+                             f'stage timings are recorded only with -metrics_json or -metrics_textfile. Default is '
+                             f'{PROGRESS_INTERVAL}, 0 disables them')
     parser.add_argument('-debug', action='store_true', help='Turn DEBUG output ON')
     parser.add_argument('-ldap', action='store_true', help='Use unsecured LDAP instead of LDAP/s.')
     parser.add_argument('-ldap_domain', action='store', help='Custom domain on ldap login credentials. If empty, '
@@ -260,13 +313,13 @@ def main():
     if not options.ntlm and not options.kerberos:
         logging.error("No authentication method was chosen.")
         sys.exit()
-    if password == '':
+    if password == '' and options.evtx is None:
         from getpass import getpass
 
         password = getpass("Password:")
 
     if options.ldap_domain is None:
-        options.ldap_domain = os.environ['userdomain']
+        options.ldap_domain = os.environ.get('userdomain')
     credentials = Credentials(username, password, domain, options.ldap_domain)
 
     ntlm_collector = None
@@ -276,35 +329,107 @@ def main():
         logging.error("Filter is not in the correct format. Please enter filter in a DistinguishedName format without trailing DC.")
         sys.exit(1)
 
-    print(f"Welcome to Silverfort Event log collector.")
-    if options.ntlm is True:
-        ntlm_collector = NTLMCollector(credentials, threads=options.threads, start_date=options.date,
-                                       search_base_filter=options.filter, use_ldap=options.ldap)
-        print(f"\t{ntlm_collector.workstation_list_size} Domain controllers (NTLM).")
-
-    if options.kerberos:
-        kerberos_collector = KerberosCollector(credentials, threads=options.threads, start_date=options.date,
-                                               search_base_filter=options.filter, use_ldap=options.ldap)
-        print(f"\t{kerberos_collector.workstation_list_size} Endpoints (Kerberos).")
-    if input("Do you wish to proceed? (y/N)").lower() != "y":
-        sys.exit()
-    logging.info("Collecting events...")
-    try:
-        ntlm_collector.get_evtx_logs()
-    except AttributeError:
-        pass
-    except Exception:
-        logging.exception("Error: ")
-        sys.exit()
+    shard = None
+    if options.shards > 1:
+        try:
+            shard = HostShard(options.shard, options.shards)
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
+        state_path = options.state
+        options.state = shard.state_path(state_path)
+        options.dedup_index = shard.state_path(options.dedup_index)
+        if options.output is not None:
+            options.output = shard.path(options.output)
+        if options.metrics_json is not None:
+            options.metrics_json = shard.path(options.metrics_json)
+        if options.metrics_textfile is not None:
+            options.metrics_textfile = shard.path(options.metrics_textfile)
 
-    try:
-        kerberos_collector.get_evtx_logs()
-    except AttributeError:
-        pass
-    except Exception:
-        logging.exception("Error: ")
-        sys.exit()
+    print(f"Welcome to Silverfort Event log collector.")
+    if shard is not None:
+        print(f"Collecting shard {shard.index} of {shard.count} shards.")
+    # progress lines need the counters only, timings and per-host details are recorded for the exported metrics
+    metrics.enabled = bool(options.metrics_json or options.metrics_textfile or options.progress_interval)
+    metrics.detailed = bool(options.metrics_json or options.metrics_textfile)
+    state_store = StateStore(options.state)
+    if shard is not None:
+        # hosts that moved to this shard resume from the state of the shard that collected them before
+        for sibling_path in shard.sibling_state_paths(state_path):
+            adopted = state_store.adopt(sibling_path, shard.owns)
+            if adopted:
+                logging.info(f"Adopted {adopted} watermarks of this shard's hosts from {sibling_path}")
+    watermark_store = None if options.full else state_store
+    dedup_index = None if options.no_dedup else DedupIndex(options.dedup_index)
+    inventory = None
+    if options.evtx is not None:
+        source = EvtxFileEventSource(options.evtx)
+    else:
+        source = RpcEventSource(credentials, time_budget=options.host_timeout, event_budget=options.host_max_events,
+                                state_store=state_store, reachability_ttl=options.reachability_ttl)
+        if not options.no_inventory:
+            inventory = ComputerInventory(state_store, domain)
+            try:
+                inventory.sync(credentials, options.ldap, full=options.refresh_inventory)
+            except ConnectionError as e:
+                logging.error(e)
+                sys.exit(1)
+    excluded_accounts = options.exclude_accounts.split(';') if options.exclude_accounts else ()
+    host_canonicalizer = None if options.raw_hosts else HostCanonicalizer(domain, inventory,
+                                                                          resolve_ips=not options.no_dns)
+    base_name = f"{OUTPUT_FILE_NAME}_{shard.suffix}" if shard is not None else OUTPUT_FILE_NAME
+    with open_sink(options.output_format, options.output, base_name=base_name,
+                   aggregate=options.aggregate) as output_sink:
+        if options.ntlm is True:
+            ntlm_collector = NTLMCollector(credentials, threads=options.threads, start_date=options.date,
+                                           search_base_filter=options.filter, use_ldap=options.ldap,
+                                           parsers=options.parsers, output_sink=output_sink,
+                                           state_store=watermark_store, source=source, inventory=inventory,
+                                           host_canonicalizer=host_canonicalizer,
+                                           event_filter=build_filter(NTLM_EVENT_ID, options.relevant_only,
+                                                                     excluded_accounts), shard=shard)
+            print(f"\t{ntlm_collector.describe_targets('Files' if options.evtx else 'Domain controllers')} (NTLM).")
+
+        if options.kerberos:
+            kerberos_collector = KerberosCollector(credentials, threads=options.threads, start_date=options.date,
+                                                   search_base_filter=options.filter, use_ldap=options.ldap,
+                                                   parsers=options.parsers, output_sink=output_sink,
+                                                   state_store=watermark_store, source=source, inventory=inventory,
+                                                   host_canonicalizer=host_canonicalizer,
+                                                   event_filter=build_filter(KERBEROS_EVENT_ID, options.relevant_only,
+                                                                             excluded_accounts), shard=shard)
+            print(f"\t{kerberos_collector.describe_targets('Files' if options.evtx else 'Endpoints')} (Kerberos).")
+        if input("Do you wish to proceed? (y/N)").lower() != "y":
+            sys.exit()
+        logging.info("Collecting events...")
+        collectors = [collector for collector in (ntlm_collector, kerberos_collector) if collector is not None]
+        progress = None
+        try:
+            scheduler = CollectionScheduler(collectors, options.threads, output_sink, parsers=options.parsers,
+                                            target_sessions=options.host_sessions, state_store=watermark_store,
+                                            history_store=state_store, dedup_index=dedup_index,
+                                            host_canonicalizer=host_canonicalizer)
+            if options.progress_interval:
+                progress = ProgressReporter(metrics, PROGRESS_FIELDS, interval=options.progress_interval,
+                                            samplers={'parse_queue_depth': scheduler.pipeline.queue.qsize,
+                                                      'pending_hosts': scheduler.queue.qsize},
+                                            textfile=options.metrics_textfile).start()
+            scheduler.run()
+        except Exception:
+            logging.exception("Error: ")
+            sys.exit()
+        finally:
+            if progress is not None:
+                progress.stop()
+            metrics.export(options.metrics_json, options.metrics_textfile)
+    source.close()
+    if host_canonicalizer is not None:
+        host_canonicalizer.close()
+    if dedup_index is not None:
+        dedup_index.close()
+    state_store.close()
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,170 @@
+from functools import lru_cache
+from typing import NamedTuple
+
+from latma.event_parser import KERBEROS_EVENT_ID, NTLM_EVENT_ID, EventRecord
+
+EQUALS = 'equals'
+PREFIX = 'prefix'
+SUFFIX = 'suffix'
+RELEVANT_SERVICES = ('rpc', 'rpcss', 'termsrv')
+LOOPBACK_HOSTS = ('localhost', '127.0.0.1', '::1')
+# EventData fields of the account of every supported event
+ACCOUNT_FIELDS = {NTLM_EVENT_ID: 'UserName', KERBEROS_EVENT_ID: 'TargetUserName'}
+
+
+@lru_cache(maxsize=None)
+def _lowered(values):
+    return tuple(value.lower() for value in values)
+
+
+def _literal(value):
+    """
+    :return: XPath string literal of a value, None if the value holds both quote characters. Event log XPath has no
+             concat() to build such a literal.
+    """
+    if "'" not in value:
+        return f"'{value}'"
+    if '"' not in value:
+        return f'"{value}"'
+    return None
+
+
+def host_names(host):
+    """
+    :param host: dNSHostName of a host
+    :return: tuple of the names an event may use for the host, its fqdn and NETBIOS name in their usual cases
+    """
+    netbios_name = host.split('.', 1)[0]
+    return tuple(dict.fromkeys((host, host.lower(), netbios_name.upper(), netbios_name.lower())))
+
+
+class FieldCondition(NamedTuple):
+    """
+    Condition on an EventData field, true when the field matches one of the values, case insensitive.
+    Event log XPath has no string functions, only EQUALS conditions can be compiled into the event query. PREFIX and
+    SUFFIX conditions are checked by the parsers only.
+    """
+    field: str
+    values: tuple
+    match: str = EQUALS
+
+    def test(self, data):
+        value = data.get(self.field, '').lower()
+        values = _lowered(self.values)
+        if self.match == PREFIX:
+            return value.startswith(values)
+        if self.match == SUFFIX:
+            return value.endswith(values)
+        return value in values
+
+    def xpath(self, partial=False):
+        """
+        :param partial: leave out the values that can't be expressed instead of the whole condition, for suppress
+                        conditions the parsers check again
+        :return: XPath of the condition, None if it can't be expressed
+        """
+        if self.match != EQUALS:
+            return None
+        literals = [_literal(value) for value in self.values]
+        if None in literals:
+            if not partial:
+                return None
+            literals = [literal for literal in literals if literal is not None]
+        if not literals:
+            return None
+        return '(' + ' or '.join(f"Data[@Name='{self.field}']={literal}" for literal in literals) + ')'
+
+
+class EventFilter(NamedTuple):
+    """
+    Declarative filter of the events of a log. An event is collected when it matches all select conditions, none of
+    the suppress conditions and, with suppress_self, authenticates to another host than its source.
+    The EQUALS conditions are compiled into the Select and Suppress clauses of the event query so the host drops
+    those events before they are sent, all conditions are checked again by the parsers, which also covers sources
+    that don't run queries such as exported files. Self authentications can be suppressed by the query only in logs
+    written by the source host that name the destination in destination_field, by the names of the collected host.
+    """
+    select: tuple = ()
+    suppress: tuple = ()
+    suppress_self: bool = False
+    destination_field: str = None
+
+    def select_xpath(self):
+        """
+        :return: EventData clause added to the Select path, None if no select condition can be expressed in XPath.
+        """
+        conditions = list(filter(None, (condition.xpath() for condition in self.select)))
+        return f"EventData[{' and '.join(conditions)}]" if conditions else None
+
+    def suppress_xpath(self):
+        """
+        :return: Suppress path, None if no suppress condition can be expressed in XPath.
+        """
+        conditions = list(filter(None, (condition.xpath(partial=True) for condition in self.suppress)))
+        return f"*[EventData[{' or '.join(conditions)}]]" if conditions else None
+
+    def for_host(self, host):
+        """
+        :param host: dNSHostName of the collected host
+        :return: EventFilter also suppressing the authentications of the host to its own names by the event query,
+                 the filter itself when it keeps self authentications or its log doesn't name the destination.
+        """
+        if not self.suppress_self or self.destination_field is None:
+            return self
+        return self.extend(suppress=[FieldCondition(self.destination_field, host_names(host))])
+
+    def accepts(self, event: EventRecord, row):
+        """
+        :param event: decoded event
+        :param row: output row built from the event
+        :return: True if the event should be written.
+        """
+        data = event.data
+        if not all(condition.test(data) for condition in self.select):
+            return False
+        if any(condition.test(data) for condition in self.suppress):
+            return False
+        return not (self.suppress_self and _host_label(row[1]) == _host_label(row[2]))
+
+    def extend(self, select=(), suppress=()):
+        """
+        :return: EventFilter with additional conditions.
+        """
+        return self._replace(select=self.select + tuple(select), suppress=self.suppress + tuple(suppress))
+
+
+def _host_label(host):
+    return host.split('@', 1)[0].split('.', 1)[0].lower()
+
+
+# filters applied by default, Kerberos logons of a host to itself carry no lateral movement
+DEFAULT_FILTERS = {
+    NTLM_EVENT_ID: EventFilter(),
+    KERBEROS_EVENT_ID: EventFilter(suppress=(FieldCondition('TargetServerName', LOOPBACK_HOSTS),)),
+}
+# filters keeping only the authentications the analyzer adds to the authentication graph, see detection.is_relevant.
+# The service prefix select and suppress_self can't be expressed in an event query, they run in the parsers and don't
+# reduce the events fetched over RPC
+RELEVANCE_FILTERS = {
+    NTLM_EVENT_ID: EventFilter(suppress_self=True),
+    KERBEROS_EVENT_ID: EventFilter(
+        select=(FieldCondition('TargetInfo', tuple(f"{service}/" for service in RELEVANT_SERVICES), PREFIX),),
+        suppress=(FieldCondition('TargetServerName', LOOPBACK_HOSTS),),
+        suppress_self=True, destination_field='TargetServerName'),
+}
+
+
+def build_filter(event_id, relevant_only=False, excluded_accounts=()):
+    """
+    Build the filter of a supported event.
+    :param event_id: NTLM_EVENT_ID or KERBEROS_EVENT_ID
+    :param relevant_only: keep only the authentications of the authentication graph, dropping self authentications
+                          and Kerberos services other than RELEVANT_SERVICES
+    :param excluded_accounts: account names to drop, e.g. noisy service accounts. Filtered by the event query.
+    :return: EventFilter
+    """
+    event_filter = (RELEVANCE_FILTERS if relevant_only else DEFAULT_FILTERS)[event_id]
+    if excluded_accounts:
+        event_filter = event_filter.extend(suppress=[FieldCondition(ACCOUNT_FIELDS[event_id],
+                                                                    tuple(excluded_accounts))])
+    return event_filter
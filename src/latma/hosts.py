@@ -0,0 +1,195 @@
+import ipaddress
+import logging
+import socket
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+DNS_CACHE_SIZE = 64 * 1024
+DNS_THREADS = 8
+NAME_CACHE_SIZE = 1000 * 1000
+# output columns holding host names
+HOST_COLUMNS = (1, 2)
+
+
+class HostCanonicalizer:
+    """
+    Maps the different names a machine appears under in the collected events to one canonical host name, the lower
+    case NETBIOS name the analyzer expects. NTLM events name hosts NAME@domain, Kerberos events by fqdn, IP address
+    or SPN host, and Azure AD sign-ins by device display name.
+    Fqdns are resolved through the computers known from the inventory or LDAP, IP addresses through reverse DNS with
+    a bounded cache. Every distinct raw name is canonicalized once, after that it costs a cache lookup. Both
+    caches are bounded and evict their least recently used entries.
+    Reverse DNS lookups run in a small thread pool, rows can be prefetched so their lookups run before the rows are
+    canonicalized.
+    """
+
+    def __init__(self, domain=None, inventory=None, resolve_ips=True, dns_cache_size=DNS_CACHE_SIZE,
+                 dns_threads=DNS_THREADS, name_cache_size=NAME_CACHE_SIZE):
+        """
+        :param domain: domain fqdn, fqdns under it that are not known computers are cut to their first label
+        :param inventory: ComputerInventory used to resolve fqdns, None uses the computers added from LDAP only
+        :param resolve_ips: resolve IP addresses to host names with reverse DNS
+        :param dns_cache_size: maximal amount of cached DNS answers
+        :param dns_threads: maximal amount of concurrent reverse DNS lookups
+        :param name_cache_size: maximal amount of cached canonical names
+        """
+        self.domain_suffix = f".{domain.lower()}" if domain else None
+        self.inventory = inventory
+        self.resolve_ips = resolve_ips
+        self.dns_cache_size = dns_cache_size
+        self.dns_threads = dns_threads
+        self.name_cache_size = name_cache_size
+        # dNSHostName to NETBIOS name of the known computers
+        self.computers = {}
+        # raw host name to canonical name, least recently used first
+        self.names = OrderedDict()
+        # IP address to the Future of its reverse lookup, least recently used first
+        self.lookups = OrderedDict()
+        # guards the changes of both caches, prefetch reads the names from another thread
+        self.lock = Lock()
+        self.dns_pool = None
+
+    def add_computer(self, name, dns_host_name):
+        """
+        Learn the names of a computer object, e.g. from an LDAP workstation entry.
+        """
+        if name and dns_host_name:
+            self.computers[dns_host_name.lower()] = name.lower()
+
+    def add_workstation(self, workstation):
+        """
+        Learn the names of an LDAP workstation entry.
+        """
+        attributes = workstation.get('attributes', {})
+        self.add_computer(attributes.get('name'), attributes.get('dNSHostName'))
+
+    def canonical(self, host):
+        """
+        :param host: host name as it appears in an event
+        :return: canonical host name
+        """
+        canonical = self.names.get(host)
+        if canonical is not None:
+            with self.lock:
+                if host in self.names:
+                    self.names.move_to_end(host)
+            return canonical
+        canonical = self._canonicalize(host)
+        with self.lock:
+            self.names[host] = canonical
+            if len(self.names) > self.name_cache_size:
+                self.names.popitem(last=False)
+        return canonical
+
+    def canonicalize_rows(self, rows, columns=HOST_COLUMNS):
+        """
+        Replace the host names of output rows with their canonical names, in place.
+        :param rows: output rows
+        :param columns: indexes of the host name columns
+        :return: the rows
+        """
+        for row in rows:
+            for column in columns:
+                row[column] = self.canonical(row[column])
+        return rows
+
+    def prefetch(self, rows, columns=HOST_COLUMNS):
+        """
+        Start the reverse DNS lookups of the IP addresses in output rows that were not canonicalized yet, without
+        waiting for them. Safe to call from another thread than the one canonicalizing the rows.
+        :param rows: output rows
+        :param columns: indexes of the host name columns
+        """
+        if not self.resolve_ips:
+            return
+        names = self.names
+        for host in {row[column] for row in rows for column in columns}:
+            if host not in names:
+                name = self._host_part(host)
+                if name and self._is_ip(name):
+                    self._lookup(name)
+
+    def close(self):
+        """
+        Stop the DNS lookup threads, abandoning the lookups still running.
+        """
+        if self.dns_pool is not None:
+            self.dns_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _lookup(self, address):
+        """
+        :return: Future of the host name of an IP address, None if it doesn't resolve.
+        """
+        with self.lock:
+            lookup = self.lookups.get(address)
+            if lookup is not None:
+                self.lookups.move_to_end(address)
+                return lookup
+            if self.dns_pool is None:
+                self.dns_pool = ThreadPoolExecutor(max_workers=self.dns_threads, thread_name_prefix="dns")
+            lookup = self.lookups[address] = self.dns_pool.submit(self._resolve, address)
+            if len(self.lookups) > self.dns_cache_size:
+                self.lookups.popitem(last=False)
+        return lookup
+
+    @staticmethod
+    def _host_part(host):
+        """
+        :return: lower case host part of a raw host name, without its service, port, domain or leading backslashes
+        """
+        name = host.strip().lower().lstrip('\\')
+        if '/' in name:
+            # SPN host, e.g. cifs/host.domain.com:445
+            name = name.split('/', 2)[1]
+        if name.count(':') == 1:
+            name = name.split(':', 1)[0]
+        if '@' in name:
+            # NTLM NAME@domain
+            name = name.split('@', 1)[0]
+        return name
+
+    def _canonicalize(self, host):
+        if not host:
+            return host
+        name = self._host_part(host)
+        if not name:
+            return host.lower()
+        if self._is_ip(name):
+            resolved = self._lookup(name).result() if self.resolve_ips else None
+            if resolved is None:
+                return name
+            name = resolved
+        if '.' in name:
+            return self._fqdn_name(name.rstrip('.'))
+        return name
+
+    def _fqdn_name(self, fqdn):
+        name = self.computers.get(fqdn)
+        if name is None and self.inventory is not None:
+            entry = self.inventory.lookup(fqdn)
+            if entry is not None and entry['attributes']['name']:
+                name = self.computers[fqdn] = entry['attributes']['name'].lower()
+        if name is not None:
+            return name
+        if self.domain_suffix is not None and fqdn.endswith(self.domain_suffix):
+            return fqdn.split('.', 1)[0]
+        return fqdn
+
+    @staticmethod
+    def _is_ip(name):
+        if not name[0].isdigit() and ':' not in name:
+            return False
+        try:
+            ipaddress.ip_address(name)
+        except ValueError:
+            return False
+        return True
+
+    @staticmethod
+    def _resolve(address):
+        try:
+            return socket.gethostbyaddr(address)[0].lower()
+        except (OSError, UnicodeError):
+            logging.debug(f"Unable to resolve {address}")
+            return None
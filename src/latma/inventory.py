@@ -0,0 +1,156 @@
+import logging
+from time import time
+
+from latma.utils import Ldap
+
+SERVER_TRUST_ACCOUNT = 8192
+RODC_PRIMARY_GROUP_ID = 521
+SHOW_DELETED_CONTROL = ('1.2.840.113556.1.4.417', True, None)
+INVENTORY_ATTRIBUTES = ["objectGUID", "name", "dNSHostName", "operatingSystem", "userAccountControl",
+                        "primaryGroupID", "uSNChanged"]
+_COMPUTER_COLUMNS = "dn, name, dns_host_name, operating_system"
+_LIKE_ESCAPE = '\\'
+
+
+def _like_literal(value):
+    """
+    Escape the LIKE wildcards of a value, to match it literally in a LIKE pattern with ESCAPE _LIKE_ESCAPE.
+    """
+    return value.replace(_LIKE_ESCAPE, _LIKE_ESCAPE * 2).replace('%', f'{_LIKE_ESCAPE}%').replace(
+        '_', f'{_LIKE_ESCAPE}_')
+
+
+def _to_entry(row):
+    """
+    Convert an inventory row to the LDAP search response entry format used by the collectors.
+    """
+    dn, name, dns_host_name, operating_system = row
+    return {'type': 'searchResEntry', 'dn': dn, 'raw_dn': dn.encode('utf-8'),
+            'attributes': {'name': name, 'dNSHostName': dns_host_name, 'operatingSystem': operating_system}}
+
+
+class ComputerInventory:
+    """
+    Local copy of the domain computer objects kept in the collector state.
+    The inventory is refreshed incrementally, fetching only objects whose uSNChanged is above the highest USN of the
+    previous sync on the same domain controller, including deleted objects.
+    """
+
+    def __init__(self, state_store, domain):
+        """
+        :param state_store: StateStore holding the inventory
+        :param domain: domain fqdn
+        """
+        self.state_store = state_store
+        self.conn = state_store.conn
+        self.lock = state_store.lock
+        self.domain = domain.lower()
+
+    def sync(self, credentials, use_ldap, full=False):
+        """
+        Fetch computer objects changed since the last sync.
+        USNs are local to each domain controller, so the sync binds to the domain controller of the previous sync and
+        falls back to a full sync when it is unavailable.
+        :param credentials: Credentials
+        :param use_ldap: use unsecured LDAP instead of LDAP/s
+        :param full: ignore the previous sync and fetch all computer objects
+        """
+        with self.lock:
+            last_sync = self.conn.execute("SELECT server, highest_usn FROM inventory_sync WHERE domain=?",
+                                          (self.domain,)).fetchone()
+        if full or last_sync is None:
+            server, highest_usn = None, 0
+        else:
+            server, highest_usn = last_sync
+        try:
+            ldap_conn = Ldap(credentials.domain, credentials.username, credentials.password, use_ldap,
+                             credentials.ldap_domain, host=server)
+        except ConnectionError:
+            if server is None:
+                raise
+            logging.warning(f"Unable to reach {server}, running a full inventory sync")
+            server, highest_usn = None, 0
+            ldap_conn = Ldap(credentials.domain, credentials.username, credentials.password, use_ldap,
+                             credentials.ldap_domain)
+        sync_server = ldap_conn.get_root_dse_attribute('dnsHostName')
+        sync_usn = int(ldap_conn.get_root_dse_attribute('highestCommittedUSN') or 0)
+        if server is not None and sync_server != server:
+            highest_usn = 0
+        logging.info(f"Syncing computer inventory from {sync_server} after USN {highest_usn}")
+
+        start = time()
+        changed = self._fetch(ldap_conn, f"(&(objectCategory=computer)(uSNChanged>={highest_usn + 1}))")
+        deleted = []
+        if highest_usn:
+            deleted_filter = f"(&(objectClass=computer)(isDeleted=TRUE)(uSNChanged>={highest_usn + 1}))"
+            deleted = [guid for guid, *_ in self._fetch(ldap_conn, deleted_filter, [SHOW_DELETED_CONTROL])]
+        with self.lock, self.conn:
+            if not highest_usn:
+                self.conn.execute("DELETE FROM computers WHERE domain=?", (self.domain,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO computers (guid, domain, dn, name, dns_host_name, operating_system, is_dc, "
+                "usn_changed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(guid, self.domain, dn, name, dns_host_name, operating_system, is_dc, usn)
+                 for guid, dn, name, dns_host_name, operating_system, is_dc, usn in changed])
+            self.conn.executemany("DELETE FROM computers WHERE guid=?", [(guid,) for guid in deleted])
+            self.conn.execute("INSERT OR REPLACE INTO inventory_sync (domain, server, highest_usn, synced) "
+                              "VALUES (?, ?, ?, ?)", (self.domain, sync_server or '', sync_usn, time()))
+        logging.info(f"Computer inventory synced in {time() - start:.1f}s: {len(changed)} changed, "
+                     f"{len(deleted)} deleted, {self.size()} computers")
+
+    def _fetch(self, ldap_conn, search_filter, controls=None):
+        computers = []
+        for entry in ldap_conn.get_workstations(search_filter, attributes=INVENTORY_ATTRIBUTES, controls=controls):
+            attributes = entry['attributes']
+            is_dc = bool((attributes.get('userAccountControl') or 0) & SERVER_TRUST_ACCOUNT) or \
+                attributes.get('primaryGroupID') == RODC_PRIMARY_GROUP_ID
+            computers.append((str(attributes['objectGUID']), entry['dn'], attributes.get('name') or None,
+                              attributes.get('dNSHostName') or None, attributes.get('operatingSystem') or None,
+                              int(is_dc), int(attributes.get('uSNChanged') or 0)))
+        return computers
+
+    def size(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM computers WHERE domain=?", (self.domain,)).fetchone()[0]
+
+    def workstations(self, dc_only=False, search_bases=None, operating_system=None):
+        """
+        Get computers from the inventory, in the LDAP search response entry format.
+        :param dc_only: only domain controllers, including read only domain controllers
+        :param search_bases: semicolon delimited DNs, only computers under these bases are returned
+        :param operating_system: only computers with this string in their operating system
+        :return: list of workstation entries
+        """
+        query = f"SELECT {_COMPUTER_COLUMNS} FROM computers WHERE domain=? AND dns_host_name IS NOT NULL"
+        params = [self.domain]
+        if dc_only:
+            query += " AND is_dc=1"
+        if operating_system:
+            query += f" AND operating_system LIKE ? ESCAPE '{_LIKE_ESCAPE}'"
+            params.append(f"%{_like_literal(operating_system)}%")
+        if search_bases:
+            bases = search_bases.split(';')
+            query += " AND (" + " OR ".join([f"dn LIKE ? ESCAPE '{_LIKE_ESCAPE}' OR dn LIKE ? ESCAPE "
+                                             f"'{_LIKE_ESCAPE}'"] * len(bases)) + ")"
+            for base in bases:
+                base = _like_literal(base)
+                params.extend([f"%,{base},%", f"%,{base}"])
+        with self.lock:
+            return [_to_entry(row) for row in self.conn.execute(query, params)]
+
+    def lookup(self, host):
+        """
+        Find a computer by its DN, dNSHostName or NETBIOS name.
+        :param host: DN, fqdn or NETBIOS name, case insensitive
+        :return: workstation entry, None if unknown.
+        """
+        if '=' in host:
+            column = 'dn'
+        elif '.' in host:
+            column = 'dns_host_name'
+        else:
+            column = 'name'
+        with self.lock:
+            row = self.conn.execute(f"SELECT {_COMPUTER_COLUMNS} FROM computers WHERE {column}=? COLLATE NOCASE",
+                                    (host,)).fetchone()
+        return _to_entry(row) if row else None
@@ -0,0 +1,285 @@
+import json
+import logging
+import os
+from collections import defaultdict
+from threading import Event, Lock, Thread
+from time import monotonic, time
+
+PROGRESS_INTERVAL = 60
+METRIC_PREFIX = 'latma_'
+MAX_SAMPLES = 4096
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, prometheus=False):
+    if prometheus:
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in label_key)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(label_key, escaped)) + '}' \
+            if label_key else ''
+    return ','.join(f"{name}={value}" for name, value in label_key)
+
+
+def _write_atomically(path, content):
+    with open(path + '.tmp', 'w', encoding='utf-8') as output_file:
+        output_file.write(content)
+    os.replace(path + '.tmp', path)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.name, monotonic() - self.start, **self.labels)
+
+
+class Metrics:
+    """
+    Run metrics registry: counters, gauges, summaries of durations, per-host details and gauge samples over time.
+    Metrics are recorded per batch or per request, never per event. While disabled every call returns right away.
+    Without details only counters and gauges are recorded, enough for progress lines.
+    """
+
+    def __init__(self, enabled=False, detailed=True):
+        """
+        :param enabled: record metrics
+        :param detailed: record summaries, per-host details and samples as well as counters and gauges
+        """
+        self.enabled = enabled
+        self.detailed = detailed
+        self.lock = Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        # (name, labels) to [count, sum, max]
+        self.summaries = {}
+        # (log, host) to {field: value}
+        self.hosts = defaultdict(lambda: defaultdict(float))
+        # name to [(seconds since start, value)]
+        self.samples = defaultdict(list)
+        self.started = time()
+        self.start = monotonic()
+
+    def reset(self):
+        """
+        Drop all recorded metrics and restart the run clock.
+        """
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.summaries.clear()
+            self.hosts.clear()
+            self.samples.clear()
+            self.started = time()
+            self.start = monotonic()
+
+    def increment(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[(name, _label_key(labels))] += value
+
+    def set_gauge(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value, usually a duration in seconds, to a summary.
+        """
+        if not self.enabled or not self.detailed:
+            return
+        key = (name, _label_key(labels))
+        with self.lock:
+            summary = self.summaries.get(key)
+            if summary is None:
+                self.summaries[key] = [1, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = max(summary[2], value)
+
+    def timer(self, name, **labels):
+        """
+        :return: context manager observing its duration into a summary.
+        """
+        return _Timer(self, name, labels) if self.enabled and self.detailed else _NULL_TIMER
+
+    def record_host(self, log, host, **fields):
+        """
+        Add up per-host details, e.g. connect seconds or events, reported in the json report only.
+        """
+        if not self.enabled or not self.detailed:
+            return
+        with self.lock:
+            details = self.hosts[(log, host)]
+            for field, value in fields.items():
+                details[field] += value
+
+    def sample(self, name, value):
+        """
+        Record the value of a series at the current time. Once a series is full every other sample is dropped, so
+        samples cover the whole run at a coarser resolution.
+        """
+        if not self.enabled or not self.detailed:
+            return
+        with self.lock:
+            series = self.samples[name]
+            series.append((round(monotonic() - self.start, 1), value))
+            if len(series) > MAX_SAMPLES:
+                del series[::2]
+
+    def total(self, name):
+        """
+        :return: sum of a counter over all its labels.
+        """
+        with self.lock:
+            return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    def report(self):
+        """
+        :return: json serializable dict of all metrics.
+        """
+        with self.lock:
+            report = {'started': self.started, 'duration': monotonic() - self.start,
+                      'counters': defaultdict(dict), 'gauges': defaultdict(dict), 'summaries': defaultdict(dict)}
+            for (name, labels), value in self.counters.items():
+                report['counters'][name][_format_labels(labels)] = value
+            for (name, labels), value in self.gauges.items():
+                report['gauges'][name][_format_labels(labels)] = value
+            for (name, labels), (count, total, maximum) in self.summaries.items():
+                report['summaries'][name][_format_labels(labels)] = {
+                    'count': count, 'sum': total, 'max': maximum, 'mean': total / count}
+            report['hosts'] = [{'log': log, 'host': host, **details} for (log, host), details in self.hosts.items()]
+            report['samples'] = {name: list(series) for name, series in self.samples.items()}
+        return report
+
+    def export(self, json_path=None, textfile=None):
+        """
+        Write the json report and the Prometheus textfile, either path may be None.
+        """
+        if json_path:
+            self.write_json(json_path)
+        if textfile:
+            self.write_prometheus(textfile)
+
+    def write_json(self, path):
+        _write_atomically(path, json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path):
+        """
+        Write all metrics but the per-host details in the Prometheus text format, e.g. for the node exporter
+        textfile collector. The file is replaced atomically.
+        """
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in typed:
+                        lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+                        typed.add(name)
+                    lines.append(f"{METRIC_PREFIX}{name}{_format_labels(labels, True)} {value}")
+            typed = set()
+            for (name, labels), (count, total, _) in sorted(self.summaries.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {METRIC_PREFIX}{name} summary")
+                    typed.add(name)
+                label_text = _format_labels(labels, True)
+                lines.append(f"{METRIC_PREFIX}{name}_count{label_text} {count}")
+                lines.append(f"{METRIC_PREFIX}{name}_sum{label_text} {total}")
+            typed = set()
+            for (name, labels), (_, _, maximum) in sorted(self.summaries.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {METRIC_PREFIX}{name}_max gauge")
+                    typed.add(name)
+                lines.append(f"{METRIC_PREFIX}{name}_max{_format_labels(labels, True)} {maximum}")
+        lines.append(f"{METRIC_PREFIX}run_start_time_seconds {self.started}")
+        _write_atomically(path, '\n'.join(lines) + '\n')
+
+
+# registry of the running collector, enabled by its command line options
+metrics = Metrics()
+
+
+class ProgressReporter:
+    """
+    Periodically samples gauges, logs a progress line and refreshes the Prometheus textfile while a run is going.
+    """
+
+    def __init__(self, run_metrics, fields, interval=PROGRESS_INTERVAL, samplers=None, textfile=None):
+        """
+        :param run_metrics: Metrics of the run
+        :param fields: list of (title, counter name) shown in the progress line with their rate since the last line
+        :param interval: seconds between progress lines
+        :param samplers: dict of gauge name to a callable returning its current value, e.g. a queue depth
+        :param textfile: Prometheus textfile path refreshed on every progress line, None disables it
+        """
+        self.metrics = run_metrics
+        self.fields = fields
+        self.interval = interval
+        self.samplers = samplers or {}
+        self.textfile = textfile
+        self.last_totals = {}
+        self.last_time = monotonic()
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name="progress-reporter", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self._report()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self._report()
+            except Exception:
+                logging.exception("Unable to report progress: ")
+
+    def _report(self):
+        now = monotonic()
+        elapsed = max(now - self.last_time, 1e-9)
+        self.last_time = now
+        parts = []
+        for title, name in self.fields:
+            total = self.metrics.total(name)
+            rate = (total - self.last_totals.get(name, 0)) / elapsed
+            self.last_totals[name] = total
+            self.metrics.sample(f"{name}_per_second", rate)
+            parts.append(f"{total:.0f} {title} ({rate:.0f}/s)")
+        for name, sampler in self.samplers.items():
+            value = sampler()
+            self.metrics.set_gauge(name, value)
+            self.metrics.sample(name, value)
+            parts.append(f"{name.replace('_', ' ')} {value}")
+        logging.info(f"Progress after {now - self.metrics.start:.0f}s: {', '.join(parts)}")
+        if self.textfile:
+            self.metrics.write_prometheus(self.textfile)
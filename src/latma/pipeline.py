@@ -0,0 +1,218 @@
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+from threading import Thread
+from time import monotonic
+
+from lxml import etree
+
+from latma.event_parser import ROW_BUILDERS, decode_event
+from latma.metrics import metrics
+from latma.sinks import OUTPUT_HEADER, TIMESTAMP_COLUMN
+
+DEFAULT_QUEUE_SIZE = 32
+IN_FLIGHT_PER_PROCESS = 2
+CHECKPOINT_INTERVAL = 10
+_SENTINEL = None
+_TIMESTAMP_INDEX = OUTPUT_HEADER.index(TIMESTAMP_COLUMN)
+
+
+def parse_batch(events, domain, event_filters=None):
+    """
+    Parse a batch of rendered events into output rows. Runs inside a parser process.
+    :param events: list of event xml strings
+    :param domain: collecting user domain
+    :param event_filters: dict of EventID to EventFilter, events rejected by the filter of their EventID are dropped
+    :return: tuple of (output rows, (host, log, EventRecordID) of every row, highest EventRecordID, its SystemTime)
+    """
+    rows = []
+    keys = []
+    last_record_id = 0
+    last_system_time = None
+    for event_xml in events:
+        try:
+            event = decode_event(event_xml)
+        except etree.XMLSyntaxError as e:
+            logging.warning(f"Skipping malformed event: {e}")
+            continue
+        if event.record_id > last_record_id:
+            last_record_id = event.record_id
+            last_system_time = event.system_time
+        row_builder = ROW_BUILDERS.get(event.event_id)
+        if row_builder is not None:
+            row = row_builder(event, domain)
+            event_filter = event_filters.get(event.event_id) if event_filters else None
+            if event_filter is not None and not event_filter.accepts(event, row):
+                continue
+            rows.append(row)
+            keys.append((event.computer.lower(), event.channel, event.record_id))
+    return rows, keys, last_record_id, last_system_time
+
+
+class ParsePipeline:
+    """
+    Parse stage between the fetching threads and the output file.
+    Fetchers put batches of rendered events into a bounded queue and block while it is full, a dispatcher thread
+    fans the batches out to a pool of parser processes and writes the parsed rows in submission order.
+    """
+
+    def __init__(self, domain, writer, processes=None, queue_size=DEFAULT_QUEUE_SIZE, on_checkpoint=None,
+                 dedup_index=None, host_canonicalizer=None, event_filters=None):
+        """
+        :param domain: collecting user domain
+        :param writer: OutputSink, receives the parsed rows
+        :param processes: amount of parser processes, 0 parses in the dispatcher thread. Default is the cpu count.
+        :param queue_size: maximal amount of batches waiting to be parsed
+        :param on_checkpoint: called with a dict of tag to (EventRecordID, SystemTime) of the last written event,
+                              after the writer was flushed. Events the writer holds back are not reported until a
+                              later checkpoint writes them.
+        :param dedup_index: DedupIndex dropping already collected events, committed on every checkpoint
+        :param host_canonicalizer: HostCanonicalizer replacing the host names of written rows, None writes them as they
+                                   appear in the events
+        :param event_filters: dict of EventID to the EventFilter of its events
+        """
+        self.domain = domain
+        self.writer = writer
+        self.processes = os.cpu_count() if processes is None else processes
+        self.queue = Queue(maxsize=queue_size)
+        self.failed = False
+        self.on_checkpoint = on_checkpoint
+        self.dedup_index = dedup_index
+        self.host_canonicalizer = host_canonicalizer
+        self.event_filters = event_filters
+        # (tag, watermark, row timestamps, row keys) of the batches written since the last checkpoint, and of
+        # earlier batches with rows the writer held back
+        self.written = []
+        self.last_checkpoint = monotonic()
+        self._dispatcher = Thread(target=self._dispatch, name="parse-dispatcher")
+
+    def start(self):
+        self._dispatcher.start()
+
+    def put(self, batch, tag=None):
+        """
+        Hand a batch of rendered events to the parse stage. Blocks while the parsers are behind.
+        :param batch: list of event xml strings
+        :param tag: hashable source of the batch, e.g. (host, log). Tagged batches are reported on checkpoints.
+        """
+        if batch:
+            metrics.increment('events_read_total', len(batch))
+            with metrics.timer('queue_put_wait_seconds'):
+                self.queue.put((batch, tag))
+
+    def close(self):
+        """
+        Signal that no more batches will be put, and wait for all queued batches to be parsed and written.
+        """
+        self.queue.put(_SENTINEL)
+        self._dispatcher.join()
+
+    def _dispatch(self):
+        if self.processes == 0:
+            self._dispatch_inline()
+            return
+        pending = deque()
+        max_in_flight = self.processes * IN_FLIGHT_PER_PROCESS
+        with ProcessPoolExecutor(max_workers=self.processes) as pool:
+            while True:
+                item = self.queue.get()
+                if item is _SENTINEL:
+                    break
+                if self.failed:
+                    continue
+                batch, tag = item
+                future = pool.submit(parse_batch, batch, self.domain, self.event_filters)
+                if self.host_canonicalizer is not None:
+                    # host names resolve while earlier batches are written
+                    future.add_done_callback(self._prefetch_hosts)
+                pending.append((future, tag, len(batch)))
+                while len(pending) >= max_in_flight:
+                    future, tag, event_count = pending.popleft()
+                    self._write(future.result, tag, event_count)
+            while pending:
+                future, tag, event_count = pending.popleft()
+                self._write(future.result, tag, event_count)
+        self._checkpoint(final=True)
+
+    def _dispatch_inline(self):
+        while True:
+            item = self.queue.get()
+            if item is _SENTINEL:
+                break
+            if not self.failed:
+                batch, tag = item
+                self._write(lambda: parse_batch(batch, self.domain, self.event_filters), tag, len(batch))
+        self._checkpoint(final=True)
+
+    def _prefetch_hosts(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.host_canonicalizer.prefetch(future.result()[0])
+
+    def _write(self, get_result, tag, event_count):
+        """
+        Write parsed rows. On failure the pipeline keeps draining the queue so fetchers are never blocked forever.
+        :param get_result: callable returning the parse_batch result
+        :param tag: source of the batch
+        :param event_count: amount of events in the batch
+        """
+        if self.failed:
+            return
+        try:
+            with metrics.timer('parse_wait_seconds'):
+                rows, keys, last_record_id, last_system_time = get_result()
+            metrics.increment('events_parsed_total', event_count)
+            parsed_rows = len(rows)
+            if self.dedup_index is not None:
+                rows, keys = self.dedup_index.filter(rows, keys)
+                metrics.increment('rows_deduplicated_total', parsed_rows - len(rows))
+            if self.host_canonicalizer is not None:
+                self.host_canonicalizer.prefetch(rows)
+                self.host_canonicalizer.canonicalize_rows(rows)
+            with metrics.timer('sink_write_seconds'):
+                self.writer.writerows(rows)
+            metrics.increment('rows_written_total', len(rows))
+            if self.on_checkpoint is not None or self.dedup_index is not None:
+                watermark = (last_record_id, last_system_time) if tag is not None and last_record_id else None
+                self.written.append((tag, watermark, [row[_TIMESTAMP_INDEX] for row in rows], keys))
+            if monotonic() - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+                self._checkpoint()
+        except Exception:
+            logging.exception("Parse stage failed, dropping the remaining events: ")
+            self.failed = True
+
+    def _checkpoint(self, final=False):
+        """
+        Flush the writer, commit the deduplication index and report the last written event of every tag.
+        A tag is reported up to its last batch before a batch with rows the writer held back.
+        :param final: no more rows are written, flush all rows the writer holds
+        """
+        self.last_checkpoint = monotonic()
+        if self.failed or (self.on_checkpoint is None and self.dedup_index is None):
+            return
+        with metrics.timer('checkpoint_seconds'):
+            if final:
+                self.writer.flush()
+                held = set()
+            else:
+                held = self.writer.checkpoint()
+            watermarks = {}
+            held_tags = set()
+            held_keys = []
+            written = []
+            for tag, watermark, timestamps, keys in self.written:
+                held_rows = [(timestamp, key) for timestamp, key in zip(timestamps, keys) if timestamp in held]
+                if held_rows or tag is not None and tag in held_tags:
+                    held_keys.extend(key for _, key in held_rows)
+                    written.append((tag, watermark, [timestamp for timestamp, _ in held_rows],
+                                    [key for _, key in held_rows]))
+                    if tag is not None:
+                        held_tags.add(tag)
+                elif watermark is not None:
+                    watermarks[tag] = watermark
+            self.written = written
+            if self.dedup_index is not None:
+                self.dedup_index.commit(held_keys)
+            if self.on_checkpoint is not None and watermarks:
+                self.on_checkpoint(watermarks)
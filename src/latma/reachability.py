@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from latma.utils import resolve_evtx_endpoint
+
+RPC_PORT = 135
+CONNECT_TIMEOUT = 3
+REACHABILITY_TTL = 15 * 60
+MAX_CONCURRENT_CONNECTS = 1000
+MAX_ENDPOINT_LOOKUPS = 64
+
+
+async def _probe(host, port, timeout=CONNECT_TIMEOUT):
+    """
+    Check a tcp port is open.
+    :return: True if a connection was established within the timeout.
+    """
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def _check_host(host, connects, lookups, executor):
+    """
+    Probe the endpoint mapper of a host, resolve its event log endpoint and probe the endpoint.
+    :return: tuple of host and its event log endpoint port, None if unreachable.
+    """
+    async with connects:
+        if not await _probe(host, RPC_PORT):
+            logging.debug(f"{host} is unreachable")
+            return host, None
+    async with lookups:
+        endpoint = await asyncio.get_running_loop().run_in_executor(executor, resolve_evtx_endpoint, host)
+    if endpoint is None:
+        return host, None
+    async with connects:
+        if not await _probe(host, endpoint):
+            logging.error(f"{host} is up, RPC is unavailable.")
+            return host, None
+    return host, endpoint
+
+
+async def _sweep(hosts, max_connects, max_lookups):
+    connects = asyncio.Semaphore(max_connects)
+    lookups = asyncio.Semaphore(max_lookups)
+    with ThreadPoolExecutor(max_workers=max_lookups) as executor:
+        results = await asyncio.gather(*(_check_host(host, connects, lookups, executor) for host in hosts))
+    return dict(results)
+
+
+def sweep(hosts, state_store=None, ttl=REACHABILITY_TTL, max_connects=MAX_CONCURRENT_CONNECTS,
+          max_lookups=MAX_ENDPOINT_LOOKUPS):
+    """
+    Concurrently check which hosts expose the remote event log RPC endpoint.
+    Hosts checked within the ttl are taken from the state store and new results are stored in it.
+    :param hosts: list of hostnames
+    :param state_store: StateStore caching previous checks, None disables caching
+    :param ttl: seconds a cached check is valid, 0 disables caching
+    :param max_connects: maximal amount of concurrent tcp connection attempts
+    :param max_lookups: maximal amount of concurrent endpoint mapper lookups
+    :return: dict of reachable host to its event log endpoint port
+    """
+    cached = state_store.get_reachability(ttl) if state_store is not None and ttl else {}
+    endpoints = {host: cached[host] for host in hosts if host in cached}
+    unchecked = [host for host in hosts if host not in endpoints]
+    if unchecked:
+        results = asyncio.run(_sweep(unchecked, max_connects, max_lookups))
+        if state_store is not None:
+            state_store.set_reachability(results)
+        endpoints.update(results)
+    reachable = {host: endpoint for host, endpoint in endpoints.items() if endpoint is not None}
+    logging.info(f"{len(reachable)} of {len(hosts)} hosts are reachable ({len(hosts) - len(unchecked)} cached)")
+    return reachable
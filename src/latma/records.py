@@ -0,0 +1,296 @@
+import argparse
+import csv
+import json
+import logging
+import os
+from array import array
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from latma.event_parser import TIMESTAMP_FORMAT
+from latma.sinks import COUNT_COLUMN, TIMESTAMP_COLUMN
+
+META_FILE_NAME = 'meta.json'
+FORMAT_VERSION = 1
+ISO_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+NO_TIMESTAMP = np.iinfo(np.int64).min
+IMPORT_CHUNK_SIZE = 100 * 1000
+# column kinds: interned strings stored as codes into a dictionary, epoch seconds and plain integers
+DICTIONARY = 'dictionary'
+TIMESTAMP = 'timestamp'
+INTEGER = 'integer'
+_DTYPES = {DICTIONARY: np.dtype('<u4'), TIMESTAMP: np.dtype('<i8'), INTEGER: np.dtype('<i8')}
+_TYPECODES = {DICTIONARY: 'I', TIMESTAMP: 'q', INTEGER: 'q'}
+_EPOCH = datetime(1970, 1, 1)
+
+
+@lru_cache(maxsize=64 * 1024)
+def _parse_minute(timestamp):
+    return int((datetime.strptime(timestamp, TIMESTAMP_FORMAT) - _EPOCH).total_seconds())
+
+
+def parse_timestamp(timestamp):
+    """
+    Convert an output timestamp to epoch seconds.
+    :param timestamp: collector output timestamp, e.g. 01/05/2022 10:11, or a graph createdDateTime, e.g.
+                      2022-05-01T10:11:12Z
+    :return: seconds since 01/01/1970 00:00 UTC, NO_TIMESTAMP for an empty timestamp
+    """
+    if not timestamp:
+        return NO_TIMESTAMP
+    if 'T' in timestamp:
+        return int((datetime.fromisoformat(timestamp[:19]) - _EPOCH).total_seconds())
+    return _parse_minute(timestamp)
+
+
+@lru_cache(maxsize=64 * 1024)
+def _format_minute(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+def format_timestamp(seconds, timestamp_format=TIMESTAMP_FORMAT):
+    """
+    Convert epoch seconds back to an output timestamp.
+    """
+    if seconds == NO_TIMESTAMP:
+        return ''
+    if timestamp_format == TIMESTAMP_FORMAT:
+        return _format_minute(seconds)
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime(timestamp_format)
+
+
+def _column_path(path, index):
+    return os.path.join(path, f"{index}.bin")
+
+
+def _read_meta(path):
+    with open(os.path.join(path, META_FILE_NAME), encoding='utf-8') as meta_file:
+        meta = json.load(meta_file)
+    if meta['version'] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported record store version {meta['version']} in {path}")
+    return meta
+
+
+class RecordWriter:
+    """
+    Appends rows to an on-disk record store. A store is a directory holding a little-endian binary file per column
+    and a meta.json with the header, the column kinds, the row count and the string dictionaries. Strings are interned
+    into per column dictionaries and stored as uint32 codes, timestamps as int64 epoch seconds.
+    Column files are appended first and meta.json is replaced atomically after them, so a crash never leaves rows the
+    meta doesn't describe, extra bytes of an interrupted flush are truncated on the next open.
+    """
+
+    def __init__(self, path, header, timestamp_column=TIMESTAMP_COLUMN, integer_columns=(COUNT_COLUMN,)):
+        """
+        :param path: store directory, appended to if it exists
+        :param header: column names
+        :param timestamp_column: column stored as epoch seconds, if it is in the header
+        :param integer_columns: columns stored as integers
+        """
+        self.path = path
+        if os.path.exists(os.path.join(path, META_FILE_NAME)):
+            self.meta = _read_meta(path)
+            if [column['name'] for column in self.meta['columns']] != list(header):
+                raise ValueError(f"Record store {path} has another header: {self.meta['columns']}")
+            for index, column in enumerate(self.meta['columns']):
+                with open(_column_path(path, index), 'ab') as column_file:
+                    column_file.truncate(self.meta['rows'] * _DTYPES[column['kind']].itemsize)
+        else:
+            os.makedirs(path, exist_ok=True)
+            columns = []
+            for name in header:
+                kind = TIMESTAMP if name == timestamp_column else INTEGER if name in integer_columns else DICTIONARY
+                columns.append({'name': name, 'kind': kind, 'values': [] if kind == DICTIONARY else None})
+            self.meta = {'version': FORMAT_VERSION, 'rows': 0, 'timestamp_format': None, 'columns': columns}
+        self.kinds = [column['kind'] for column in self.meta['columns']]
+        self.codes = [{value: code for code, value in enumerate(column['values'])} if column['values'] is not None
+                      else None for column in self.meta['columns']]
+        self.buffers = [array(_TYPECODES[kind]) for kind in self.kinds]
+        self.rows = 0
+
+    def _intern(self, index, value):
+        codes = self.codes[index]
+        code = codes[value] = len(codes)
+        self.meta['columns'][index]['values'].append(value)
+        return code
+
+    def writerows(self, rows):
+        if not rows:
+            return
+        for index, (kind, values) in enumerate(zip(self.kinds, zip(*rows))):
+            buffer = self.buffers[index]
+            if kind == DICTIONARY:
+                codes = self.codes[index]
+                encoded = list(map(codes.get, values))
+                if None in encoded:
+                    # new values, or missing ones stored as empty strings
+                    encoded = [codes[value] if value in codes else self._intern(index, value)
+                               for value in (value if value is not None else '' for value in values)]
+                buffer.extend(encoded)
+            elif kind == TIMESTAMP:
+                if self.meta['timestamp_format'] is None:
+                    first = next((value for value in values if value), None)
+                    if first is not None:
+                        self.meta['timestamp_format'] = ISO_TIMESTAMP_FORMAT if 'T' in first else TIMESTAMP_FORMAT
+                buffer.extend(map(parse_timestamp, values))
+            else:
+                buffer.extend(int(value) if value not in (None, '') else 0 for value in values)
+        self.rows += len(rows)
+
+    def flush(self):
+        if self.rows:
+            for index, buffer in enumerate(self.buffers):
+                with open(_column_path(self.path, index), 'ab') as column_file:
+                    column_file.write(buffer.tobytes())
+                del buffer[:]
+            self.meta['rows'] += self.rows
+            self.rows = 0
+        meta_path = os.path.join(self.path, META_FILE_NAME)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as meta_file:
+            json.dump(self.meta, meta_file)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def close(self):
+        self.flush()
+
+
+class RecordStore:
+    """
+    Read-only view of a record store. Column files are memory mapped, so opening a store costs the dictionaries only
+    and columns are paged in when they are used.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = _read_meta(path)
+        self.header = [column['name'] for column in self.meta['columns']]
+        self.timestamp_format = self.meta['timestamp_format'] or TIMESTAMP_FORMAT
+        self.columns = {}
+        for index, column in enumerate(self.meta['columns']):
+            dtype = _DTYPES[column['kind']]
+            if self.meta['rows']:
+                self.columns[column['name']] = np.memmap(_column_path(path, index), dtype=dtype, mode='r',
+                                                         shape=(self.meta['rows'],))
+            else:
+                self.columns[column['name']] = np.empty(0, dtype=dtype)
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def kind(self, name):
+        return self.meta['columns'][self.header.index(name)]['kind']
+
+    def column(self, name):
+        """
+        :return: array of the dictionary codes, epoch seconds or integers of a column
+        """
+        return self.columns[name]
+
+    def values(self, name):
+        """
+        :return: list of the dictionary of a string column, indexed by code
+        """
+        return self.meta['columns'][self.header.index(name)]['values']
+
+    def to_frame(self, columns=None):
+        """
+        Build a pandas frame without decoding the strings, string columns become categoricals over the dictionaries
+        and the timestamp column datetimes.
+        :param columns: column names, default is all columns
+        """
+        frame = {}
+        for name in columns or self.header:
+            kind = self.kind(name)
+            if kind == DICTIONARY:
+                frame[name] = pd.Categorical.from_codes(self.column(name).astype(np.int32), self.values(name))
+            elif kind == TIMESTAMP:
+                seconds = self.column(name)
+                # NO_TIMESTAMP is the pandas NaT value, other seconds are converted to nanoseconds
+                frame[name] = pd.to_datetime(np.where(seconds == NO_TIMESTAMP, NO_TIMESTAMP, seconds * 1000 ** 3))
+            else:
+                frame[name] = np.asarray(self.column(name))
+        return pd.DataFrame(frame)
+
+    def iter_rows(self, chunk_size=IMPORT_CHUNK_SIZE):
+        """
+        :return: generator of decoded rows, as the collector writes them to csv
+        """
+        decoders = []
+        for name in self.header:
+            kind = self.kind(name)
+            if kind == DICTIONARY:
+                values = self.values(name)
+                decoders.append((self.column(name), values.__getitem__))
+            elif kind == TIMESTAMP:
+                decoders.append((self.column(name), lambda seconds: format_timestamp(seconds, self.timestamp_format)))
+            else:
+                decoders.append((self.column(name), None))
+        for start in range(0, len(self), chunk_size):
+            columns = []
+            for data, decode in decoders:
+                chunk = data[start:start + chunk_size].tolist()
+                columns.append(list(map(decode, chunk)) if decode is not None else chunk)
+            yield from map(list, zip(*columns))
+
+
+def import_csv(csv_path, store_path):
+    """
+    Append the rows of a collector csv output to a record store.
+    :return: amount of rows imported
+    """
+    rows_imported = 0
+    with open(csv_path, newline='', encoding='utf-8') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader, None)
+        if header is None:
+            return 0
+        writer = RecordWriter(store_path, header)
+        chunk = []
+        for row in reader:
+            if not row:
+                continue
+            chunk.append(row)
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                writer.writerows(chunk)
+                rows_imported += len(chunk)
+                chunk = []
+        writer.writerows(chunk)
+        rows_imported += len(chunk)
+        writer.close()
+    return rows_imported
+
+
+def export_csv(store_path, csv_path):
+    """
+    Write the rows of a record store to a csv file in the collector output format.
+    :return: amount of rows exported
+    """
+    store = RecordStore(store_path)
+    with open(csv_path, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(store.header)
+        writer.writerows(store.iter_rows())
+    return len(store)
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True, description="Convert collector output between csv and the "
+                                                                "record store format")
+    parser.add_argument('command', choices=['import', 'export'],
+                        help='import a csv file into a record store, or export a record store to a csv file')
+    parser.add_argument('source', help='csv file to import or record store to export')
+    parser.add_argument('destination', help='record store to append to or csv file to write')
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if options.command == 'import':
+        rows = import_csv(options.source, options.destination)
+    else:
+        rows = export_csv(options.source, options.destination)
+    logging.info(f"{options.command.capitalize()}ed {rows} rows from {options.source} to {options.destination}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import logging
+from collections import defaultdict, deque
+from itertools import count
+from queue import PriorityQueue
+from threading import Condition, Lock, Thread
+from time import monotonic
+from typing import NamedTuple
+
+from latma.metrics import metrics
+from latma.pipeline import ParsePipeline
+
+DEFAULT_TARGET_SESSIONS = 1
+STRAGGLER_FACTOR = 3
+STRAGGLER_MIN_DURATION = 60
+# queue ranks, first jobs in their expected duration order, then straggler retries, then worker shutdown
+_FIRST_RUN = 0
+_RETRY = 1
+_SHUTDOWN = 2
+
+
+class _Job(NamedTuple):
+    collector: object
+    target: object
+    min_record_id: int = 0
+    events: int = 0
+    elapsed: float = 0
+    resumed: bool = False
+
+
+class CollectionScheduler:
+    """
+    Runs the host jobs of several collectors on one prioritized work queue, with a global limit of concurrent jobs,
+    a limit of concurrent sessions per target host, and one parse pipeline and output sink shared by all collectors.
+    Hosts are ordered longest first by the fetch duration of their previous collection, so the largest hosts don't
+    start at the end of the run. A host running well past its previous duration is a straggler, it is stopped and
+    resumed after all other hosts.
+    """
+
+    def __init__(self, collectors, threads, output_sink, parsers=None, target_sessions=DEFAULT_TARGET_SESSIONS,
+                 state_store=None, history_store=None, straggler_factor=STRAGGLER_FACTOR, dedup_index=None,
+                 host_canonicalizer=None):
+        """
+        :param collectors: list of Collector, jobs of collectors with a lower priority value run first
+        :param threads: maximal amount of concurrent host jobs
+        :param output_sink: OutputSink receiving the rows of all collectors
+        :param parsers: amount of event parsing processes, default is the cpu count
+        :param target_sessions: maximal amount of concurrent jobs against the same target host
+        :param state_store: StateStore receiving watermark checkpoints, None disables watermarks
+        :param history_store: StateStore keeping the host collection durations, None keeps LDAP order
+        :param straggler_factor: a host is a straggler once it runs this many times its previous duration, 0 disables
+                                 straggler detection
+        :param dedup_index: DedupIndex dropping events collected by previous runs or other targets, None writes all
+        :param host_canonicalizer: HostCanonicalizer of the written host names, None writes them as they are in events
+        """
+        self.collectors = collectors
+        self.threads = threads
+        self.output_sink = output_sink
+        self.target_sessions = target_sessions
+        self.history_store = history_store
+        self.straggler_factor = straggler_factor
+        self.history = {}
+        self.completed = defaultdict(dict)
+        on_checkpoint = state_store.set_watermarks if state_store else None
+        self.pipeline = ParsePipeline(collectors[0].credentials.domain, output_sink, processes=parsers,
+                                      on_checkpoint=on_checkpoint, dedup_index=dedup_index,
+                                      host_canonicalizer=host_canonicalizer,
+                                      event_filters={collector.evt_log_num: collector.event_filter
+                                                     for collector in collectors})
+        self.queue = PriorityQueue()
+        self.sequence = count()
+        self.lock = Lock()
+        self.idle = Condition(self.lock)
+        self.outstanding = 0
+        self.active_sessions = defaultdict(int)
+        self.deferred = defaultdict(deque)
+
+    def run(self):
+        """
+        Collect from all targets of all collectors and wait for the collected events to be written.
+        """
+        for collector in self.collectors:
+            collector.pipeline = self.pipeline
+            if self.history_store is not None:
+                self.history[collector.evtx_path] = self.history_store.get_host_history(collector.evtx_path)
+            logging.info(f"Collecting authentication logs type: {collector.type}")
+        self.pipeline.start()
+        workers = [Thread(target=self._work, name=f"collector-{i}") for i in range(self.threads)]
+        try:
+            for worker in workers:
+                worker.start()
+            producers = [Thread(target=self._produce, args=(collector,), name=f"producer-{collector.type}")
+                         for collector in self.collectors]
+            for producer in producers:
+                producer.start()
+            for producer in producers:
+                producer.join()
+            with self.idle:
+                self.idle.wait_for(lambda: self.outstanding == 0)
+        finally:
+            for _ in workers:
+                self.queue.put(((_SHUTDOWN,), next(self.sequence), None))
+            for worker in workers:
+                worker.join()
+            self.pipeline.close()
+            self.output_sink.flush()
+            if self.history_store is not None:
+                for log, history in self.completed.items():
+                    self.history_store.set_host_history(log, history)
+        for collector in self.collectors:
+            logging.info(f"Done collecting authentication logs type: {collector.type} "
+                         f"from {collector.workstation_list_size} Hosts")
+
+    def _expected_duration(self, collector, target_name):
+        """
+        :return: fetch duration of the previous collection of a host, None if it was never collected.
+        """
+        previous = self.history.get(collector.evtx_path, {}).get(target_name)
+        return previous[1] if previous else None
+
+    def _produce(self, collector):
+        # hosts without history are assumed to take as long as an average host of the same log
+        durations = [duration for _, duration in self.history.get(collector.evtx_path, {}).values()]
+        default_duration = sum(durations) / len(durations) if durations else 0
+        try:
+            for target in collector.source.preflight(collector.workstation_list):
+                with self.lock:
+                    self.outstanding += 1
+                metrics.increment('hosts_queued_total', log=collector.evtx_path)
+                expected = self._expected_duration(collector, collector.source.target_name(target))
+                rank = (_FIRST_RUN, -(expected if expected is not None else default_duration), collector.priority)
+                self.queue.put((rank, next(self.sequence), _Job(collector, target)))
+        except Exception:
+            logging.exception(f"Unable to enumerate {collector.type} targets: ")
+
+    def _deadline(self, job, target_name, start):
+        """
+        :return: monotonic time a job becomes a straggler, None if it may run until done.
+        """
+        if not self.straggler_factor or job.resumed:
+            return None
+        expected = self._expected_duration(job.collector, target_name)
+        if expected is None:
+            return None
+        return start + max(expected * self.straggler_factor, STRAGGLER_MIN_DURATION)
+
+    def _work(self):
+        while True:
+            rank, _, job = self.queue.get()
+            if job is None:
+                return
+            target_name = job.collector.source.target_name(job.target)
+            target_key = target_name.lower()
+            with self.lock:
+                if self.active_sessions[target_key] >= self.target_sessions:
+                    self.deferred[target_key].append((rank, job))
+                    continue
+                self.active_sessions[target_key] += 1
+            retry = None
+            try:
+                start = monotonic()
+                events, resume_record_id = job.collector.get_single_workstation(
+                    job.target, self._deadline(job, target_name, start), job.min_record_id)
+                events += job.events
+                elapsed = monotonic() - start + job.elapsed
+                if resume_record_id is None:
+                    self.completed[job.collector.evtx_path][target_name] = (events, elapsed)
+                    metrics.increment('hosts_completed_total', log=job.collector.evtx_path)
+                    metrics.observe('host_fetch_seconds', elapsed, log=job.collector.evtx_path)
+                else:
+                    metrics.increment('stragglers_total', log=job.collector.evtx_path)
+                    logging.warning(f"{target_name} is a straggler, collected {events} events in {elapsed:.0f}s "
+                                    f"(previously {self._expected_duration(job.collector, target_name):.0f}s), "
+                                    f"it will be resumed after the other hosts")
+                    retry = (_RETRY,), job._replace(min_record_id=resume_record_id, events=events,
+                                                       elapsed=elapsed, resumed=True)
+            except Exception:
+                metrics.increment('hosts_failed_total', log=job.collector.evtx_path)
+                logging.exception(f"Unable to collect {job.collector.type} events from {target_name}: ")
+            finally:
+                self._release(target_key, retry)
+
+    def _release(self, target_key, retry=None):
+        """
+        Free a session of a target, requeue a job deferred by the session limit and mark the finished job as done.
+        :param retry: tuple of rank and job, resuming an unfinished job
+        """
+        with self.lock:
+            self.active_sessions[target_key] -= 1
+            if retry is not None:
+                self.deferred[target_key].append(retry)
+            if self.deferred[target_key]:
+                rank, job = self.deferred[target_key].popleft()
+                self.queue.put((rank, next(self.sequence), job))
+            if not self.deferred[target_key] and not self.active_sessions[target_key]:
+                del self.deferred[target_key]
+                del self.active_sessions[target_key]
+            if retry is None:
+                self.outstanding -= 1
+            if self.outstanding == 0:
+                self.idle.notify_all()
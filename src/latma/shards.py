@@ -0,0 +1,255 @@
+import argparse
+import csv
+import glob
+import gzip
+import hashlib
+import heapq
+import logging
+import os
+import tempfile
+from bisect import bisect_right
+from itertools import groupby, islice
+
+from latma.sinks import COUNT_COLUMN, SINK_FORMATS, TIMESTAMP_COLUMN, open_sink, sortable_timestamp
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+VIRTUAL_NODES = 128
+MERGE_RUN_SIZE = 200 * 1000
+MERGE_FAN_IN = 64
+MERGE_WRITE_SIZE = 10 * 1000
+MERGED_FILE_NAME = 'logs_merged'
+
+
+def _hash(key):
+    # stable across processes and machines, unlike hash()
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of host names to shards. Every shard owns many points of a hash ring and a host belongs to the
+    shard of the first point after its hash, so adding a shard moves only the hosts the new shard takes over.
+    """
+
+    def __init__(self, shard_count, virtual_nodes=VIRTUAL_NODES):
+        """
+        :param shard_count: amount of shards
+        :param virtual_nodes: points of every shard on the ring, more points balance the shards better
+        """
+        self.shard_count = shard_count
+        points = sorted((_hash(f"shard-{shard}#{node}"), shard) for shard in range(shard_count)
+                        for node in range(virtual_nodes))
+        self.points = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard(self, key):
+        """
+        :param key: host name, e.g. a dNSHostName, case insensitive
+        :return: index of the shard owning the key
+        """
+        return self.shards[bisect_right(self.points, _hash(key.lower())) % len(self.points)]
+
+
+class HostShard:
+    """
+    The share of the collection targets of one of several cooperating collector workers.
+    """
+
+    def __init__(self, index, count, virtual_nodes=VIRTUAL_NODES):
+        """
+        :param index: shard of this worker, 0 to count - 1
+        :param count: amount of workers
+        """
+        if not 0 <= index < count:
+            raise ValueError(f"Shard {index} is out of range for {count} shards")
+        self.index = index
+        self.count = count
+        self.ring = HashRing(count, virtual_nodes)
+
+    def owns(self, host):
+        return self.ring.shard(host) == self.index
+
+    @property
+    def suffix(self):
+        return f"shard{self.index}of{self.count}"
+
+    def path(self, path):
+        """
+        :return: the path of a per-worker output file, with the shard before its extension, e.g. logs_shard0of4.csv
+        """
+        root, extension = os.path.splitext(path)
+        return f"{root}_{self.suffix}{extension}"
+
+    def state_path(self, path):
+        """
+        :return: the path of a per-worker state file, keyed by the shard index only so a worker keeps its state when
+                 the amount of shards changes, e.g. collector_state_shard0.db
+        """
+        root, extension = os.path.splitext(path)
+        return f"{root}_shard{self.index}{extension}"
+
+    def sibling_state_paths(self, path):
+        """
+        :return: list of the existing state files of the other shards, of any amount of shards
+        """
+        root, extension = os.path.splitext(path)
+        own_path = self.state_path(path)
+        return [sibling for sibling in sorted(glob.glob(f"{glob.escape(root)}_shard*{glob.escape(extension)}"))
+                if sibling != own_path]
+
+
+def read_output(path):
+    """
+    Read a collector output file of any output format.
+    :param path: csv, csv.gz, parquet file or record store
+    :return: tuple of (header, generator of rows as lists of strings)
+    """
+    if os.path.isdir(path):
+        from latma.records import RecordStore
+
+        store = RecordStore(path)
+        return store.header, ([str(value) for value in row] for row in store.iter_rows())
+    if path.endswith(SINK_FORMATS['parquet'].extension):
+        if pyarrow is None:
+            raise RuntimeError("Reading parquet output requires pyarrow, install it with: pip install pyarrow")
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        rows = ([str(value) if value is not None else '' for value in row]
+                for batch in parquet_file.iter_batches(MERGE_WRITE_SIZE)
+                for row in zip(*(column.to_pylist() for column in batch.columns)))
+        return parquet_file.schema_arrow.names, rows
+    output_file = gzip.open(path, 'rt', newline='', encoding='utf-8') if path.endswith('.gz') else \
+        open(path, newline='', encoding='utf-8')
+    reader = csv.reader(output_file)
+    header = next(reader, None)
+
+    def rows():
+        with output_file:
+            yield from (row for row in reader if row)
+
+    return header, rows()
+
+
+def _write_run(rows, temp_dir):
+    run_file = tempfile.NamedTemporaryFile('w', newline='', encoding='utf-8', dir=temp_dir, suffix='.csv',
+                                           delete=False)
+    with run_file:
+        csv.writer(run_file).writerows(rows)
+    return run_file.name
+
+
+def _read_run(path):
+    with open(path, newline='', encoding='utf-8') as run_file:
+        yield from csv.reader(run_file)
+    os.remove(path)
+
+
+def merge_outputs(paths, output_path=None, output_format='csv', run_size=MERGE_RUN_SIZE, fan_in=MERGE_FAN_IN,
+                  temp_dir=None):
+    """
+    Merge the outputs of sharded collector workers into one time-sorted output with an external k-way merge. Inputs
+    are cut into sorted runs of run_size rows on disk, runs are merged fan_in at a time until one pass can merge them
+    all, so memory holds one run while sorting and one row per run while merging.
+    Rows written by several inputs, e.g. hosts collected by two workers after the shards changed, are written once:
+    every distinct row is written as many times as the input holding most of it has it. Counts of aggregated outputs
+    are merged the same way.
+    :param paths: shard output paths, all with the same header
+    :param output_path: merged output path, default is logs_merged with the output format extension
+    :param output_format: one of SINK_FORMATS
+    :param run_size: rows sorted in memory at a time
+    :param fan_in: maximal amount of runs merged at once
+    :param temp_dir: directory of the sorted runs, default is the system temporary directory
+    :return: amount of rows written
+    """
+    header = None
+    runs = []
+    with tempfile.TemporaryDirectory(prefix='latma-merge-', dir=temp_dir) as run_dir:
+        for source, path in enumerate(paths):
+            input_header, rows = read_output(path)
+            if input_header is None:
+                continue
+            if header is None:
+                header = input_header
+                timestamp_index = header.index(TIMESTAMP_COLUMN)
+                count_index = header.index(COUNT_COLUMN) if COUNT_COLUMN in header else None
+            elif input_header != header:
+                raise ValueError(f"{path} has another header than {paths[0]}: {input_header}")
+            input_runs = len(runs)
+            while True:
+                # run rows are sort timestamp, the row without its count, the count and the input
+                run = [[sortable_timestamp(row[timestamp_index]),
+                        *(value for index, value in enumerate(row) if index != count_index),
+                        row[count_index] if count_index is not None else '1', str(source)]
+                       for row in islice(rows, run_size)]
+                if not run:
+                    break
+                run.sort()
+                runs.append(_write_run(run, run_dir))
+            logging.info(f"Sorted {path} into {len(runs) - input_runs} runs")
+        if header is None:
+            raise ValueError("No output to merge")
+
+        while len(runs) > fan_in:
+            runs = [runs[start:start + fan_in] for start in range(0, len(runs), fan_in)]
+            runs = [_write_run(heapq.merge(*map(_read_run, group)), run_dir) if len(group) > 1 else group[0]
+                    for group in runs]
+
+        rows_written = 0
+        with open_sink(output_format, output_path, header=header, base_name=MERGED_FILE_NAME) as output_sink:
+            batch = []
+            for key, group in groupby(heapq.merge(*map(_read_run, runs)), key=lambda run_row: run_row[:-2]):
+                counts = {}
+                for run_row in group:
+                    counts[run_row[-1]] = counts.get(run_row[-1], 0) + int(run_row[-2])
+                count = max(counts.values())
+                row = key[1:]
+                if count_index is not None:
+                    row.insert(count_index, count)
+                    batch.append(row)
+                else:
+                    batch.extend([row] * count)
+                if len(batch) >= MERGE_WRITE_SIZE:
+                    output_sink.writerows(batch)
+                    rows_written += len(batch)
+                    batch = []
+            output_sink.writerows(batch)
+            rows_written += len(batch)
+    return rows_written
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True, description="Tools for collecting with several cooperating "
+                                                                "collector workers")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    merge_parser = subparsers.add_parser('merge', help='merge the shard outputs of the workers into one time-sorted, '
+                                                       'deduplicated output')
+    merge_parser.add_argument('inputs', nargs='+', help='shard outputs: csv, csv.gz, parquet files or record stores')
+    merge_parser.add_argument('-output', default=None,
+                              help=f'merged output path. Default is {MERGED_FILE_NAME} with the format extension')
+    merge_parser.add_argument('-output_format', choices=list(SINK_FORMATS), default='csv',
+                              help='merged output format. Default is csv')
+    merge_parser.add_argument('-run_size', type=int, default=MERGE_RUN_SIZE,
+                              help=f'rows sorted in memory at a time. Default is {MERGE_RUN_SIZE}')
+    merge_parser.add_argument('-temp_dir', default=None,
+                              help='directory of the sorted runs. Default is the system temporary directory')
+    assign_parser = subparsers.add_parser('assign', help='print the shard of every host')
+    assign_parser.add_argument('shards', type=int, help='amount of workers')
+    assign_parser.add_argument('hosts', nargs='+', help='dNSHostName of the hosts')
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if options.command == 'merge':
+        rows = merge_outputs(options.inputs, options.output, options.output_format, options.run_size,
+                             temp_dir=options.temp_dir)
+        logging.info(f"Merged {len(options.inputs)} outputs into {rows} rows")
+    else:
+        ring = HashRing(options.shards)
+        for host in options.hosts:
+            print(f"{host}\t{ring.shard(host)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+import csv
+import glob
+import gzip
+import heapq
+import logging
+import os
+from collections import OrderedDict
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+OUTPUT_HEADER = ["username", "source host", "destination", "spn", "timestamp", "auth type"]
+TIMESTAMP_COLUMN = "timestamp"
+COUNT_COLUMN = "count"
+AGGREGATE_MAX_KEYS = 1000 * 1000
+CSV_BUFFER_SIZE = 1024 * 1024
+GZIP_COMPRESS_LEVEL = 6
+PARQUET_ROW_GROUP_SIZE = 128 * 1024
+PARQUET_MAX_FILE_SIZE = 512 * 1024 * 1024
+
+
+def sortable_timestamp(timestamp):
+    """
+    Convert an output timestamp to a string that sorts in time order, e.g. 01/05/2022 10:11 to 2022-05-01T10:11.
+    Graph createdDateTime timestamps sort as they are.
+    """
+    if len(timestamp) == 16 and timestamp[2] == '/':
+        return f"{timestamp[6:10]}-{timestamp[3:5]}-{timestamp[0:2]}T{timestamp[11:]}"
+    return timestamp
+
+
+class OutputSink:
+    """
+    Destination of collected authentication rows. Exposes the csv writer writerows interface.
+    """
+    extension = ''
+
+    def __init__(self, path, header=None):
+        self.path = path
+        self.header = header or OUTPUT_HEADER
+
+    def writerows(self, rows):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def checkpoint(self):
+        """
+        Flush the written rows while more rows are still coming. A sink may hold back rows that more rows may add to.
+        :return: set of the timestamps of the rows held back, they are written by a later checkpoint or flush
+        """
+        self.flush()
+        return set()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CsvSink(OutputSink):
+    """
+    Comma delimited output file with a large write buffer, appends to an existing file.
+    """
+    extension = '.csv'
+
+    def __init__(self, path, header=None, buffer_size=CSV_BUFFER_SIZE):
+        super().__init__(path, header)
+        file_exists = os.path.isfile(path)
+        self.file = self._open(buffer_size)
+        self.writer = csv.writer(self.file)
+        if not file_exists:
+            self.writer.writerow(self.header)
+
+    def _open(self, buffer_size):
+        return open(self.path, "a", buffer_size, newline='', encoding='utf-8')
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class GzipCsvSink(CsvSink):
+    """
+    Gzip compressed csv output file. Appending to an existing file adds a new gzip member.
+    """
+    extension = '.csv.gz'
+
+    def _open(self, buffer_size):
+        return gzip.open(self.path, "at", compresslevel=GZIP_COMPRESS_LEVEL, newline='', encoding='utf-8')
+
+
+class ParquetSink(OutputSink):
+    """
+    Columnar parquet output. Rows are buffered into row groups and a new numbered file is started once the current
+    file exceeds max_file_size, e.g. logs.00000.parquet, logs.00001.parquet.
+    """
+    extension = '.parquet'
+
+    def __init__(self, path, header=None, row_group_size=PARQUET_ROW_GROUP_SIZE, max_file_size=PARQUET_MAX_FILE_SIZE):
+        if pyarrow is None:
+            raise RuntimeError("Parquet output requires pyarrow, install it with: pip install pyarrow")
+        super().__init__(path, header)
+        self.row_group_size = row_group_size
+        self.max_file_size = max_file_size
+        self.schema = pyarrow.schema([(column, pyarrow.int64() if column == COUNT_COLUMN else pyarrow.string())
+                                      for column in self.header])
+        self.base_path = path[:-len(self.extension)] if path.endswith(self.extension) else path
+        self.file_index = len(glob.glob(glob.escape(self.base_path) + '.*' + self.extension))
+        self.file_writer = None
+        self.file_path = None
+        self.rows = []
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        while len(self.rows) >= self.row_group_size:
+            self._write_row_group(self.row_group_size)
+
+    def flush(self):
+        self._write_row_group(len(self.rows))
+
+    def close(self):
+        self.flush()
+        self._close_file()
+
+    def _write_row_group(self, size):
+        if not size:
+            return
+        group, self.rows = self.rows[:size], self.rows[size:]
+        if self.file_writer is None:
+            self.file_path = f"{self.base_path}.{self.file_index:05d}{self.extension}"
+            self.file_index += 1
+            self.file_writer = pyarrow.parquet.ParquetWriter(self.file_path, self.schema, compression='zstd')
+        columns = [[row[i] for row in group] for i in range(len(self.header))]
+        self.file_writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema), row_group_size=size)
+        if os.path.getsize(self.file_path) >= self.max_file_size:
+            self._close_file()
+
+    def _close_file(self):
+        if self.file_writer is not None:
+            self.file_writer.close()
+            logging.debug(f"Closed output file {self.file_path}")
+            self.file_writer = None
+
+
+class AggregatingSink(OutputSink):
+    """
+    Collapses identical rows of the same timestamp into a single row with an added count column, in front of another
+    sink. Rows are counted in a bucket per timestamp. Once more than max_keys distinct rows are held, the buckets that
+    were written to least recently are considered closed and written out. A checkpoint writes the buckets older than
+    the newest complete minute, the newest minutes may still get rows. A flush writes all buckets, so rows written
+    across flushes may repeat a row with partial counts, the counts of identical rows add up.
+    """
+
+    def __init__(self, sink, max_keys=AGGREGATE_MAX_KEYS):
+        """
+        :param sink: OutputSink receiving the aggregated rows, opened with a header ending with the count column
+        :param max_keys: maximal amount of distinct rows held in memory
+        """
+        super().__init__(sink.path, sink.header[:-1])
+        self.sink = sink
+        self.max_keys = max_keys
+        self.timestamp_index = self.header.index(TIMESTAMP_COLUMN)
+        self.buckets = OrderedDict()
+        self.key_count = 0
+        self.rows_in = 0
+        self.rows_out = 0
+
+    def writerows(self, rows):
+        last_timestamp = bucket = None
+        for row in rows:
+            timestamp = row[self.timestamp_index]
+            if timestamp != last_timestamp:
+                bucket = self.buckets.get(timestamp)
+                if bucket is None:
+                    bucket = self.buckets[timestamp] = {}
+                else:
+                    self.buckets.move_to_end(timestamp)
+                last_timestamp = timestamp
+            key = tuple(row)
+            count = bucket.get(key)
+            if count is None:
+                self.key_count += 1
+                bucket[key] = 1
+            else:
+                bucket[key] = count + 1
+        self.rows_in += len(rows)
+        while self.key_count > self.max_keys:
+            self._close_bucket()
+
+    def _close_bucket(self, timestamp=None):
+        """
+        Write out a bucket, the least recently written one by default.
+        """
+        bucket = self.buckets.popitem(last=False)[1] if timestamp is None else self.buckets.pop(timestamp)
+        self.key_count -= len(bucket)
+        self.rows_out += len(bucket)
+        self.sink.writerows([[*key, count] for key, count in bucket.items()])
+
+    def flush(self):
+        while self.buckets:
+            self._close_bucket()
+        self.sink.flush()
+
+    def checkpoint(self):
+        # the newest minute is still filling up, rows of the minute before it may still arrive from slower hosts
+        order = {timestamp: sortable_timestamp(timestamp or '') for timestamp in self.buckets}
+        newest = heapq.nlargest(2, order.values())
+        if len(newest) == 2:
+            for timestamp in [timestamp for timestamp, key in order.items() if key < newest[1]]:
+                self._close_bucket(timestamp)
+        self.sink.flush()
+        return set(self.buckets)
+
+    def close(self):
+        self.flush()
+        self.sink.close()
+        if self.rows_in:
+            logging.info(f"Aggregated {self.rows_in} rows into {self.rows_out} rows")
+
+
+class RecordStoreSink(OutputSink):
+    """
+    Dictionary encoded columnar record store, see latma.records. Appends to an existing store.
+    """
+    extension = '.records'
+
+    def __init__(self, path, header=None):
+        # imported here, latma.records depends on the column names of this module
+        from latma.records import RecordWriter
+        super().__init__(path, header)
+        self.writer = RecordWriter(path, self.header)
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+SINK_FORMATS = {
+    'csv': CsvSink,
+    'csv.gz': GzipCsvSink,
+    'parquet': ParquetSink,
+    'records': RecordStoreSink,
+}
+
+
+def open_sink(output_format='csv', path=None, header=None, base_name="logs", aggregate=False) -> OutputSink:
+    """
+    Open an output sink.
+    :param output_format: one of SINK_FORMATS
+    :param path: output file path, defaults to base_name with the format extension
+    :param header: column names, defaults to the collector output header
+    :param base_name: default file name without extension
+    :param aggregate: collapse identical rows of the same timestamp into one row with a count column. The default
+                      path becomes base_name_aggregated, so aggregated rows are never appended to a plain output file.
+    :return: OutputSink
+    """
+    sink_class = SINK_FORMATS[output_format]
+    if aggregate:
+        base_name += "_aggregated"
+    if path is None:
+        path = base_name + sink_class.extension
+    if aggregate:
+        return AggregatingSink(sink_class(path, (header or OUTPUT_HEADER) + [COUNT_COLUMN]))
+    return sink_class(path, header)
@@ -0,0 +1,372 @@
+import logging
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from time import monotonic
+from typing import NamedTuple, Optional
+
+from lxml import etree
+
+from latma.event_parser import EVENT_NAMESPACES, get_record_id
+from latma.metrics import metrics
+from latma.reachability import REACHABILITY_TTL, sweep
+from latma.utils import test_connection
+
+try:
+    import pywintypes
+    import win32evtlog
+except ImportError:
+    pywintypes = None
+    win32evtlog = None
+
+try:
+    from Evtx.Evtx import Evtx
+except ImportError:
+    Evtx = None
+
+EVENT_BULK_MIN = 64
+EVENT_BULK_START = 256
+EVENT_BULK_MAX = 1024
+TARGET_PAGE_LATENCY = 2
+ERROR_TIMEOUT = 1460
+PREFLIGHT_CHUNK_SIZE = 1000
+EVTX_EXTENSION = '.evtx'
+XML_EXTENSION = '.xml'
+XML_READ_SIZE = 1024 * 1024
+EVTX_CHUNKS_PER_TASK = 32
+EVTX_TASKS_IN_FLIGHT = 2
+_EVENT_TAG = f"{{{EVENT_NAMESPACES['e']}}}Event"
+_SYSTEM_TIME_REGEX = re.compile(r'SystemTime="([^"]+)"')
+_XML_DECLARATION_REGEX = re.compile(rb'^\s*(?:\xef\xbb\xbf)?<\?xml[^>]*\?>')
+
+
+class EventQuery(NamedTuple):
+    log: str
+    event_id: str
+    xml: str
+    start_date: Optional[object] = None
+    min_record_id: int = 0
+
+
+def _event_id_regex(event_id):
+    return re.compile(f"<EventID[^>]*>{event_id}</EventID>")
+
+
+def _matches(event_xml, event_id_regex, query: EventQuery):
+    """
+    Apply the filter of an event query to an exported event, since offline logs can't be queried with XPath.
+    """
+    if not event_id_regex.search(event_xml):
+        return False
+    if query.min_record_id:
+        record_id = get_record_id(event_xml)
+        if record_id is None or record_id <= query.min_record_id:
+            return False
+    if query.start_date is not None:
+        system_time = _SYSTEM_TIME_REGEX.search(event_xml)
+        if system_time is None or system_time.group(1) < query.start_date.isoformat():
+            return False
+    return True
+
+
+class EventSource:
+    """
+    Source of rendered event xml for the collection pipeline.
+    """
+
+    def list_targets(self):
+        """
+        :return: collection targets, None if targets should be enumerated from LDAP.
+        """
+        return None
+
+    def target_name(self, target):
+        """
+        :param target: collection target
+        :return: unique target name, used to key watermarks.
+        """
+        return target
+
+    def preflight(self, targets):
+        """
+        Check which targets can be read before collection starts.
+        :param targets: iterable of collection targets
+        :return: iterable of targets to collect from
+        """
+        return targets
+
+    def read(self, target_name, query: EventQuery):
+        """
+        Read the events of a single target.
+        :param target_name: target name
+        :param query: events to read
+        :return: generator of event xml batches
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class RpcEventSource(EventSource):
+    """
+    Reads events from remote hosts over MS-EVEN6 RPC using pywin32. Available on windows only.
+    """
+
+    def __init__(self, credentials, time_budget=None, event_budget=None, state_store=None,
+                 reachability_ttl=REACHABILITY_TTL):
+        """
+        :param credentials: Credentials of a user with remote event viewer permissions
+        :param time_budget: maximal seconds spent fetching the events of a single host, None for no limit
+        :param event_budget: maximal amount of events fetched from a single host per run, None for no limit
+        :param state_store: StateStore caching host reachability between runs
+        :param reachability_ttl: seconds a cached reachability check is valid
+        """
+        if win32evtlog is None:
+            raise RuntimeError("Remote event log collection requires pywin32 and must run on windows")
+        self.credentials = credentials
+        self.time_budget = time_budget
+        self.event_budget = event_budget
+        self.state_store = state_store
+        self.reachability_ttl = reachability_ttl
+        self.endpoints = {}
+
+    def target_name(self, workstation):
+        return workstation['attributes']['dNSHostName']
+
+    def preflight(self, workstations):
+        """
+        Sweep hosts concurrently, a chunk at a time as they are enumerated, and keep only those exposing the remote
+        event log endpoint, so fetch workers never wait on unreachable hosts.
+        :param workstations: iterable of LDAP workstation entries
+        :return: generator of reachable workstation entries
+        """
+        workstations = iter(workstations)
+        while True:
+            chunk = list(islice(workstations, PREFLIGHT_CHUNK_SIZE))
+            if not chunk:
+                return
+            self.endpoints.update(sweep([self.target_name(workstation) for workstation in chunk],
+                                        self.state_store, self.reachability_ttl))
+            yield from (workstation for workstation in chunk if self.target_name(workstation) in self.endpoints)
+
+    def connect_to_evtx(self, host):
+        """
+        Connect and authenticate a host to a remote event viewer.
+        :param host: NETBIOS name or ip
+        :return: rpc session handle
+        """
+        try:
+            handle = win32evtlog.EvtOpenSession(
+                Login=(host, self.credentials.username, self.credentials.domain, self.credentials.password,
+                       win32evtlog.EvtRpcLoginAuthDefault),
+                Timeout=0, Flags=0)
+            return handle
+        except Exception as e:
+            logging.exception(f"Unable to open session to {host}: ")
+
+    def query_evtx(self, session_handle, workstation, query: EventQuery):
+        """
+        Query event viewer according to the required filter.
+        Events are read oldest first so an interrupted collection can resume from its last watermark.
+        :param workstation:
+        :param session_handle: RPC authenticated Session handle
+        :param query: events to read
+        :return: Handle to query results.
+        """
+        try:
+            handle = win32evtlog.EvtQuery(query.log, win32evtlog.EvtQueryForwardDirection, query.xml,
+                                          Session=session_handle)
+        except pywintypes.error as e:
+            logging.error(f"Unable to query {workstation}: {e.strerror}")
+            return None
+        return handle
+
+    def read(self, workstation, query: EventQuery):
+        """
+        Authenticate and query a remote host.
+        :param workstation: remote hostname fqdn string
+        :param query: events to read
+        """
+        logging.debug(f"Connecting to {workstation}")
+        if workstation not in self.endpoints:
+            with metrics.timer('test_connection_seconds'):
+                reachable = test_connection(workstation)
+            if not reachable:
+                metrics.increment('hosts_unreachable_total', log=query.log)
+                return
+        connect_start = monotonic()
+        session_handle = self.connect_to_evtx(workstation)
+        query_start = monotonic()
+        query_handle = self.query_evtx(session_handle, workstation, query)
+        query_end = monotonic()
+        metrics.observe('host_connect_seconds', query_start - connect_start, log=query.log)
+        metrics.observe('host_query_seconds', query_end - query_start, log=query.log)
+        metrics.record_host(query.log, workstation, connect_seconds=query_start - connect_start,
+                            query_seconds=query_end - query_start)
+        if query_handle is None:
+            metrics.increment('host_query_errors_total', log=query.log)
+            return
+
+        yield from self._collect_events(query_handle, workstation, query.log)
+
+    def _collect_events(self, handle, workstation, log):
+        """
+        Stream the query results of a host using pywin32. EvtNext moves the result cursor forward by itself, the page
+        size adapts to the host latency and the host is abandoned once its time or event budget is spent. Since events
+        are read oldest first, a host cut by its budget resumes from its watermark on the next run.
+        :param handle: handle to a remote host-  authenticated and queried event viewer .
+        :param log: queried log name, labels the page metrics
+        """
+        bulk_size = EVENT_BULK_START
+        event_count = 0
+        fetch_time = 0
+        while True:
+            timeout = -1
+            if self.time_budget:
+                timeout = int((self.time_budget - fetch_time) * 1000)
+                if timeout <= 0:
+                    logging.warning(f"{workstation} exceeded its time budget of {self.time_budget}s, "
+                                    f"remaining events will be collected on the next run")
+                    break
+            page_size = min(bulk_size, self.event_budget - event_count) if self.event_budget else bulk_size
+            page_start = monotonic()
+            try:
+                events = win32evtlog.EvtNext(handle, page_size, timeout, 0)
+            except pywintypes.error as e:
+                if e.winerror == ERROR_TIMEOUT:
+                    logging.warning(f"{workstation} exceeded its time budget of {self.time_budget}s")
+                else:
+                    logging.error(f"Unable to collect events from {workstation}: {e.strerror}")
+                break
+            latency = monotonic() - page_start
+            metrics.observe('evtnext_seconds', latency, log=log)
+            if not events:
+                break
+            batch = [win32evtlog.EvtRender(event, 1) for event in events]
+            fetch_time += monotonic() - page_start
+            event_count += len(batch)
+            yield batch
+
+            bulk_size = self._next_bulk_size(bulk_size, page_size, len(events), latency)
+            if self.event_budget and event_count >= self.event_budget:
+                logging.warning(f"{workstation} reached its budget of {self.event_budget} events, "
+                                f"remaining events will be collected on the next run")
+                break
+        metrics.record_host(log, workstation, fetch_seconds=fetch_time, events=event_count)
+        logging.info(f"Collected {event_count} events from {workstation} in {fetch_time:.1f}s "
+                     f"({event_count / fetch_time if fetch_time else 0:.0f} events/s)")
+
+    @staticmethod
+    def _next_bulk_size(bulk_size, requested, received, latency):
+        """
+        Grow the page size while full pages return quickly, shrink it when a page is slower than the target latency.
+        """
+        if received == requested and latency < TARGET_PAGE_LATENCY / 2:
+            return min(bulk_size * 2, EVENT_BULK_MAX)
+        if latency > TARGET_PAGE_LATENCY:
+            return max(bulk_size // 2, EVENT_BULK_MIN)
+        return bulk_size
+
+
+def read_evtx_chunks(path, start, stop, query: EventQuery):
+    """
+    Render the matching records of a range of evtx chunks. Runs inside a reader process.
+    :param path: evtx file path
+    :param start: first chunk index
+    :param stop: chunk index to stop at
+    :param query: events to keep
+    :return: list of event xml strings
+    """
+    event_id_regex = _event_id_regex(query.event_id)
+    events = []
+    with Evtx(path) as log:
+        for chunk in islice(log.get_file_header().chunks(), start, stop):
+            if not chunk.check_magic() or chunk.log_last_record_number() <= query.min_record_id:
+                continue
+            for record in chunk.records():
+                if record.record_num() <= query.min_record_id:
+                    continue
+                event_xml = record.xml()
+                if _matches(event_xml, event_id_regex, query):
+                    events.append(event_xml)
+    return events
+
+
+class EvtxFileEventSource(EventSource):
+    """
+    Reads events exported from windows hosts, so collected logs can be processed on any platform.
+    Supports .evtx files, rendered using a pool of reader processes, and xml exports of wevtutil or the event viewer.
+    Each file is a collection target.
+    """
+
+    def __init__(self, paths, processes=None):
+        """
+        :param paths: list of files or directories containing exported logs
+        :param processes: amount of evtx reader processes. Default is the cpu count.
+        """
+        self.paths = paths
+        self.processes = processes
+        self.pool = None
+
+    def list_targets(self):
+        targets = []
+        for path in self.paths:
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    targets.extend(os.path.join(root, file_name) for file_name in sorted(files)
+                                   if file_name.lower().endswith((EVTX_EXTENSION, XML_EXTENSION)))
+            else:
+                targets.append(path)
+        return targets
+
+    def read(self, path, query: EventQuery):
+        logging.debug(f"Reading {path}")
+        if path.lower().endswith(EVTX_EXTENSION):
+            yield from self._read_evtx(path, query)
+        else:
+            yield from self._read_xml(path, query)
+
+    def _read_evtx(self, path, query: EventQuery):
+        if Evtx is None:
+            raise RuntimeError("Reading evtx files requires python-evtx, install it with: pip install python-evtx")
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.processes)
+        with Evtx(path) as log:
+            chunk_count = log.get_file_header().chunk_count()
+        pending = deque()
+        for start in range(0, chunk_count, EVTX_CHUNKS_PER_TASK):
+            pending.append(self.pool.submit(read_evtx_chunks, path, start, start + EVTX_CHUNKS_PER_TASK, query))
+            if len(pending) >= EVTX_TASKS_IN_FLIGHT:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def _read_xml(self, path, query: EventQuery):
+        event_id_regex = _event_id_regex(query.event_id)
+        parser = etree.XMLPullParser(events=('end',), tag=_EVENT_TAG, huge_tree=True)
+        # wevtutil exports events without a root element, wrap them in one
+        parser.feed(b'<Events>')
+        batch = []
+        with open(path, 'rb') as xml_file:
+            data = _XML_DECLARATION_REGEX.sub(b'', xml_file.read(XML_READ_SIZE))
+            while data:
+                parser.feed(data)
+                for _, element in parser.read_events():
+                    event_xml = etree.tostring(element, encoding='unicode')
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+                    if _matches(event_xml, event_id_regex, query):
+                        batch.append(event_xml)
+                if len(batch) >= EVENT_BULK_MAX:
+                    yield batch
+                    batch = []
+                data = xml_file.read(XML_READ_SIZE)
+        yield batch
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
@@ -0,0 +1,230 @@
+import logging
+import sqlite3
+from threading import Lock
+from time import time
+
+STATE_FILE_NAME = "collector_state.db"
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS watermarks (
+        host TEXT NOT NULL,
+        log TEXT NOT NULL,
+        record_id INTEGER NOT NULL,
+        system_time TEXT,
+        PRIMARY KEY (host, log)
+    )""",
+    """CREATE TABLE IF NOT EXISTS reachability (
+        host TEXT PRIMARY KEY,
+        endpoint INTEGER,
+        checked REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS computers (
+        guid TEXT PRIMARY KEY,
+        domain TEXT NOT NULL,
+        dn TEXT NOT NULL,
+        name TEXT,
+        dns_host_name TEXT,
+        operating_system TEXT,
+        is_dc INTEGER NOT NULL,
+        usn_changed INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS computers_dn ON computers (dn COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS computers_dns_host_name ON computers (dns_host_name COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS computers_name ON computers (name COLLATE NOCASE)",
+    """CREATE TABLE IF NOT EXISTS inventory_sync (
+        domain TEXT PRIMARY KEY,
+        server TEXT NOT NULL,
+        highest_usn INTEGER NOT NULL,
+        synced REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS host_history (
+        host TEXT NOT NULL,
+        log TEXT NOT NULL,
+        events INTEGER NOT NULL,
+        duration REAL NOT NULL,
+        updated REAL NOT NULL,
+        PRIMARY KEY (host, log)
+    )""",
+    """CREATE TABLE IF NOT EXISTS sign_in_watermarks (
+        tenant TEXT PRIMARY KEY,
+        created_date_time TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS sign_in_watermark_ids (
+        tenant TEXT NOT NULL,
+        id TEXT NOT NULL,
+        created_date_time TEXT NOT NULL,
+        PRIMARY KEY (tenant, id)
+    )""",
+]
+
+
+class StateStore:
+    """
+    Persistent collector state kept in a local sqlite database, shared by all collecting threads.
+    """
+
+    def __init__(self, path=STATE_FILE_NAME):
+        self.path = path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            # one transaction, so other collectors reading this file never see a part of the schema
+            self.conn.execute("BEGIN")
+            for statement in _SCHEMA:
+                self.conn.execute(statement)
+        logging.debug(f"Using collector state file {path}")
+
+    def get_watermark(self, host, log):
+        """
+        Get the last committed event of a host log.
+        :param host: remote hostname
+        :param log: event log path
+        :return: tuple of (EventRecordID, SystemTime), None if the log was never collected.
+        """
+        with self.lock:
+            return self.conn.execute("SELECT record_id, system_time FROM watermarks WHERE host=? AND log=?",
+                                     (host, log)).fetchone()
+
+    def set_watermarks(self, watermarks):
+        """
+        Commit collected watermarks in a single transaction. A watermark never moves backwards.
+        :param watermarks: dict of (host, log) to (EventRecordID, SystemTime)
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO watermarks (host, log, record_id, system_time) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (host, log) DO UPDATE SET record_id=excluded.record_id, system_time=excluded.system_time "
+                "WHERE excluded.record_id > watermarks.record_id",
+                [(host, log, record_id, system_time) for (host, log), (record_id, system_time) in watermarks.items()])
+
+    def get_reachability(self, max_age):
+        """
+        Get the recent reachability checks.
+        :param max_age: maximal age of a check in seconds
+        :return: dict of host to its event log RPC endpoint port, None for unreachable hosts.
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT host, endpoint FROM reachability WHERE checked >= ?",
+                                     (time() - max_age,)).fetchall()
+        return dict(rows)
+
+    def set_reachability(self, endpoints):
+        """
+        Store reachability check results.
+        :param endpoints: dict of host to its event log RPC endpoint port, None for unreachable hosts
+        """
+        checked = time()
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO reachability (host, endpoint, checked) VALUES (?, ?, ?)",
+                                  [(host, endpoint, checked) for host, endpoint in endpoints.items()])
+
+    def get_host_history(self, log):
+        """
+        Get the collection cost of every host from previous runs.
+        :param log: event log path
+        :return: dict of host to (events collected, fetch duration in seconds) of its last complete collection.
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT host, events, duration FROM host_history WHERE log=?", (log,)).fetchall()
+        return {host: (events, duration) for host, events, duration in rows}
+
+    def set_host_history(self, log, history):
+        """
+        Store the collection cost of hosts.
+        :param log: event log path
+        :param history: dict of host to (events collected, fetch duration in seconds)
+        """
+        updated = time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO host_history (host, log, events, duration, updated) VALUES (?, ?, ?, ?, ?)",
+                [(host, log, events, duration, updated) for host, (events, duration) in history.items()])
+
+    def get_sign_in_watermark(self, tenant):
+        """
+        :param tenant: Azure AD tenant id
+        :return: createdDateTime of the last collected sign-in of the tenant, None if it was never collected.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT created_date_time FROM sign_in_watermarks WHERE tenant=?",
+                                    (tenant,)).fetchone()
+        return row[0] if row else None
+
+    def get_sign_in_watermark_ids(self, tenant):
+        """
+        :param tenant: Azure AD tenant id
+        :return: set of the ids of the collected sign-ins of the tenant that are fetched again, see
+                 set_sign_in_watermark
+        """
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT id FROM sign_in_watermark_ids WHERE tenant=?",
+                                                        (tenant,))}
+
+    def set_sign_in_watermark(self, tenant, created_date_time, ids=(), keep_since=None):
+        """
+        :param tenant: Azure AD tenant id
+        :param created_date_time: createdDateTime of the last collected sign-in
+        :param ids: (id, createdDateTime) of the newly collected sign-ins, dropped when they are fetched again
+        :param keep_since: createdDateTime the next run fetches from, the ids of sign-ins created in an earlier second
+                           are forgotten. None keeps all ids.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO sign_in_watermarks (tenant, created_date_time) VALUES (?, ?)",
+                              (tenant, created_date_time))
+            self.conn.executemany("INSERT OR IGNORE INTO sign_in_watermark_ids (tenant, id, created_date_time) "
+                                  "VALUES (?, ?, ?)", [(tenant, sign_in_id, created) for sign_in_id, created in ids])
+            if keep_since is not None:
+                # compared by the second, createdDateTime may carry fractions of a second
+                self.conn.execute("DELETE FROM sign_in_watermark_ids WHERE tenant=? AND "
+                                  "substr(created_date_time, 1, 19) < substr(?, 1, 19)", (tenant, keep_since))
+
+    def adopt(self, path, owns):
+        """
+        Copy the per-host state of the hosts this store's collector owns from the state file of another collector,
+        e.g. of another shard before the shards changed. Watermarks never move backwards and the computer inventory
+        is copied only when this store has none.
+        :param path: state file of the other collector, tables it doesn't have yet, e.g. while the other collector
+                     is starting, are skipped
+        :param owns: predicate of the host names to copy
+        :return: amount of watermarks added or moved forward
+        """
+        other = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            tables = {name for name, in other.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+            def select(table, columns):
+                return other.execute(f"SELECT {columns} FROM {table}").fetchall() if table in tables else []
+
+            watermarks = {(host, log): (record_id, system_time) for host, log, record_id, system_time in
+                          select('watermarks', "host, log, record_id, system_time") if owns(host)}
+            history = [row for row in select('host_history', "host, log, events, duration, updated") if owns(row[0])]
+            with self.lock:
+                has_inventory = self.conn.execute("SELECT COUNT(*) FROM inventory_sync").fetchone()[0] > 0
+            computers = inventory_sync = []
+            if not has_inventory:
+                computers = select('computers', "guid, domain, dn, name, dns_host_name, operating_system, is_dc, "
+                                                "usn_changed")
+                inventory_sync = select('inventory_sync', "domain, server, highest_usn, synced")
+        finally:
+            other.close()
+        changes = self.conn.total_changes
+        self.set_watermarks(watermarks)
+        adopted = self.conn.total_changes - changes
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO host_history (host, log, events, duration, updated) "
+                                  "VALUES (?, ?, ?, ?, ?)", history)
+            self.conn.executemany("INSERT OR IGNORE INTO computers (guid, domain, dn, name, dns_host_name, "
+                                  "operating_system, is_dc, usn_changed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", computers)
+            self.conn.executemany("INSERT OR IGNORE INTO inventory_sync (domain, server, highest_usn, synced) "
+                                  "VALUES (?, ?, ?, ?)", inventory_sync)
+        return adopted
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,8 +1,9 @@
 import logging
 import re
 import socket
-import sys
 import xml.etree.ElementTree as ET
+from queue import Queue
+from threading import Thread
 
 from impacket.dcerpc.v5 import epm, transport
 from impacket.dcerpc.v5.rpcrt import DCERPCException
@@ -12,6 +13,10 @@ from ldap3.core.exceptions import LDAPBindError
 
 LDAP_PORT = 389
 LDAPS_PORT = 636
+LDAP_PAGE_SIZE = 1000
+LDAP_PAGES_IN_FLIGHT = 8
+PAGED_RESULTS_CONTROL = '1.2.840.113556.1.4.319'
+WORKSTATION_ATTRIBUTES = ["name", "dNSHostName", "operatingSystem"]
 MSRPC_UUID_ENDPOINT = uuidtup_to_bin(('F6BEAFF7-1E19-4FBB-9F8F-B89E2018337C', '1.0'))
 CREDENTIAL_REGEX = r"(?:(?:([^/:]*)/)?([^:]*)(?::(.*))?)?"
 DN_REGEX = '^((CN=([^,]*)),)?(((?:CN|OU)=[^,]+,?)+)$'
@@ -31,7 +36,17 @@ def parse_credentials(credentials):
     return domain, username, password
 
 
-def evtx_query_builder(log_num, path, start_date, suppress_query=None) -> str:
+def evtx_query_builder(log_num, path, start_date, suppress_query=None, min_record_id=None, event_filter=None) -> str:
+    """
+    Build a structured event query of a log.
+    :param log_num: EventID to select
+    :param path: log channel
+    :param start_date: datetime of the oldest selected event, None selects all
+    :param suppress_query: XPath of events to suppress
+    :param min_record_id: select only events after this EventRecordID
+    :param event_filter: EventFilter whose XPath expressible conditions are added to the Select and Suppress clauses
+    :return: QueryList xml string
+    """
     query_tree = ET.Element('QueryList')
     query = ET.SubElement(query_tree, "Query")
     query.set("Id", "0")
@@ -41,13 +56,20 @@ def evtx_query_builder(log_num, path, start_date, suppress_query=None) -> str:
     select_query.text = f"*[System[(EventID={log_num})"
     if start_date:
         zulutime = start_date.isoformat() + '.000Z'
-        select_query.text += f" and TimeCreated[@SystemTime&gt;='{zulutime}']"
-    select_query.text += ']]'
-    if suppress_query:
+        select_query.text += f" and TimeCreated[@SystemTime>='{zulutime}']"
+    if min_record_id:
+        select_query.text += f" and (EventRecordID>{min_record_id})"
+    select_query.text += ']'
+    event_data = event_filter.select_xpath() if event_filter is not None else None
+    if event_data:
+        select_query.text += f" and {event_data}"
+    select_query.text += ']'
+    suppress_queries = [suppress_query, event_filter.suppress_xpath() if event_filter is not None else None]
+    for suppress in filter(None, suppress_queries):
         suppress_element = ET.SubElement(query, "Suppress")
         suppress_element.set("Path", path)
-        suppress_element.text = suppress_query
-    return ET.tostring(query_tree, encoding='unicode').replace("&amp;", "&")
+        suppress_element.text = suppress
+    return ET.tostring(query_tree, encoding='unicode')
 
 
 def domain_to_dn(domain: str) -> str:
@@ -68,12 +90,11 @@ def is_arg_dn(argument: str) -> bool:
     return bool(re.search(pattern=DN_REGEX, string=argument))
 
 
-def test_connection(host):
+def resolve_evtx_endpoint(host):
     """
-    Tests a connection to a windows machine.
-    Pings a host, if ping is unavailable, it will tcp syn SMB port.
+    Resolve the remote event log RPC endpoint of a host using the endpoint mapper on port 135.
     :param host:
-    :return: Bool, True for dc is alive and False if DC is down
+    :return: endpoint tcp port, None if the host or its endpoint mapper is unreachable.
     """
     string_binding = None
     try:
@@ -81,14 +102,30 @@ def test_connection(host):
     except DCERPCException as e:
         if "10060" in e.__str__():
             logging.error(f"{host} is unreachable")
-            return False
+            return None
+    except OSError as e:
+        logging.error(f"{host} is unreachable: {e}")
+        return None
     if string_binding is None:
         logging.error(f"Unable to contact {host} in rpc port 135.")
-        return False
+        return None
     string_binding_parsed = transport.DCERPCStringBinding(string_binding)
+    return int(string_binding_parsed.get_endpoint())
+
+
+def test_connection(host):
+    """
+    Tests a connection to a windows machine.
+    Pings a host, if ping is unavailable, it will tcp syn SMB port.
+    :param host:
+    :return: Bool, True for dc is alive and False if DC is down
+    """
+    endpoint = resolve_evtx_endpoint(host)
+    if endpoint is None:
+        return False
     socket_session = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     socket_session.settimeout(3)
-    conn_result = socket_session.connect_ex((host, int(string_binding_parsed.get_endpoint())))
+    conn_result = socket_session.connect_ex((host, endpoint))
     socket_session.close()
     if conn_result == 0:
         return True
@@ -106,7 +143,7 @@ class Credentials:
 
 
 class Ldap:
-    def __init__(self, domain, username, password, use_ldap, ldap_domain):
+    def __init__(self, domain, username, password, use_ldap, ldap_domain, host=None):
         self.domain = domain
         port = LDAPS_PORT
         use_ldaps = True
@@ -116,37 +153,68 @@ class Ldap:
             use_ldaps = False
         logging.debug(f"Login to: {self.domain}, is LDAPs: {use_ldaps}, port: {port}, domain: {ldap_domain}, user: {username}")
         try:
-            server = Server(host=self.domain, port=port, use_ssl=use_ldaps, get_info=ALL)
+            server = Server(host=host or self.domain, port=port, use_ssl=use_ldaps, get_info=ALL)
             self.conn = Connection(server, user=f"{ldap_domain}\\{username}", password=password,
                                    client_strategy=SAFE_SYNC, auto_bind=True)
             if use_ldaps is True:
                 self.conn.start_tls()
         except LDAPBindError as e:
-            logging.error(f"Unable to bind due to: {e}. User: {ldap_domain}\\{username}")
-            sys.exit(0)
-
+            raise ConnectionError(f"Unable to bind due to: {e}. User: {ldap_domain}\\{username}") from e
         except Exception as e:
-            logging.exception(f'Unable to connect LDAP due to: ')
-            sys.exit(0)
+            raise ConnectionError(f"Unable to connect LDAP due to: {e}") from e
+
+    def get_root_dse_attribute(self, attribute):
+        """
+        :param attribute: root DSE attribute name, e.g. highestCommittedUSN
+        :return: attribute value of the connected domain controller, None if unavailable.
+        """
+        values = (self.conn.server.info.other if self.conn.server.info else {}).get(attribute)
+        return values[0] if values else None
 
-    def get_workstations(self, search_filter, base_filter=None):
+    def get_workstations(self, search_filter, base_filter=None, attributes=None, controls=None):
         """
-        Get all workstations list from domain using LDAP
+        Enumerate workstations from domain using paged LDAP searches, searching all OUs in parallel.
         :param base_filter: will filter search base by RDN
         :param search_filter: search filter query
-        :return: workstation list
+        :param attributes: attributes to fetch, default is WORKSTATION_ATTRIBUTES
+        :param controls: additional LDAP controls
+        :return: generator of workstation entries, yielded as pages arrive.
         """
-        workstation_list = []
         ou_list = [domain_to_dn(self.domain)]
-        attrs = ["name", "dNSHostName", "operatingSystem"]
         if base_filter is not None:
             ou_list = base_filter.split(';')
+        pages = Queue(maxsize=LDAP_PAGES_IN_FLIGHT)
         for ou in ou_list:
-            try:
-                status, result, response, _ = self.conn.search(ou, search_filter, attributes=attrs,
-                                                               search_scope=SUBTREE)
-                workstation_list.extend(response)
-            except AttributeError as e:
-                logging.exception("Unable to query LDAP: ")
-                return []
-        return workstation_list
+            Thread(target=self._search_ou, args=(ou, search_filter, attributes or WORKSTATION_ATTRIBUTES, controls,
+                                                 pages), daemon=True).start()
+        remaining_ous = len(ou_list)
+        while remaining_ous:
+            page = pages.get()
+            if page is None:
+                remaining_ous -= 1
+                continue
+            yield from page
+
+    def _search_ou(self, ou, search_filter, attributes, controls, pages):
+        """
+        Page through the workstations of a single OU.
+        :param ou: search base
+        :param search_filter: search filter query
+        :param attributes: attributes to fetch
+        :param controls: additional LDAP controls
+        :param pages: queue receiving result pages, and None once the OU is done
+        """
+        cookie = None
+        try:
+            while True:
+                status, result, response, _ = self.conn.search(ou, search_filter, attributes=attributes,
+                                                               search_scope=SUBTREE, paged_size=LDAP_PAGE_SIZE,
+                                                               paged_cookie=cookie, controls=controls)
+                pages.put([entry for entry in response if entry.get('type') == 'searchResEntry'])
+                cookie = result.get('controls', {}).get(PAGED_RESULTS_CONTROL, {}).get('value', {}).get('cookie')
+                if not cookie:
+                    break
+        except Exception:
+            logging.exception(f"Unable to query LDAP for {ou}: ")
+        finally:
+            pages.put(None)
@@ -0,0 +1,108 @@
+import csv
+import importlib
+import json
+from urllib.parse import unquote
+
+import pytest
+
+TENANT_ID = 'tenant'
+
+
+def _sign_in(sign_in_id, created, device='WS01'):
+    return {'id': sign_in_id, 'userPrincipalName': 'alice@corp.local', 'createdDateTime': created,
+            'resourceDisplayName': 'Office 365', 'deviceDetail': {'displayName': device}}
+
+
+class FakeGraphClient:
+    """
+    Stand-in for latma.azure_ad.graph_client.GraphClient, serving the sign-ins of the next run as one page.
+    """
+    threads = 1
+    runs = []
+    urls = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def iter_pages_concurrently(self, urls):
+        FakeGraphClient.urls = urls
+        yield FakeGraphClient.runs.pop(0)
+
+
+@pytest.fixture
+def aad_collector(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'azure_config.json').write_text(json.dumps({'TENANT_ID': TENANT_ID, 'RAW_HOSTS': True}))
+    from latma.azure_ad import aad_collector
+    aad_collector = importlib.reload(aad_collector)
+    monkeypatch.setattr(aad_collector, 'GraphClient', FakeGraphClient)
+    return aad_collector
+
+
+def test_only_the_first_window_includes_its_start(aad_collector):
+    windows = aad_collector.split_time_range('2022-05-01T10:00:00Z', aad_collector.datetime(2022, 5, 1, 11), 2)
+    urls = [unquote(aad_collector.build_sign_in_logs_url(low, high, include_since=index == 0))
+            for index, (low, high) in enumerate(windows)]
+    assert ['createdDateTime ge 2022-05-01T10:00:00Z' in url for url in urls] == [True, False]
+    assert 'createdDateTime gt 2022-05-01T10:30:00Z' in urls[1]
+    assert urls[0].split('$select=')[1].startswith('id,')
+
+
+def _collected_ids(aad_collector):
+    with aad_collector.StateStore(aad_collector.STATE_FILE_NAME) as state_store:
+        return state_store.get_sign_in_watermark(TENANT_ID), state_store.get_sign_in_watermark_ids(TENANT_ID)
+
+
+def _written_times():
+    with open('cloud_logs.csv', newline='') as output_file:
+        return [row[1] for row in list(csv.reader(output_file))[1:]]
+
+
+def test_sign_ins_listed_late_are_collected_once(aad_collector, monkeypatch):
+    monkeypatch.setitem(aad_collector.config, 'SIGN_IN_DELAY_MINUTES', 10)
+    monkeypatch.setattr(FakeGraphClient, 'runs', [
+        [_sign_in('a', '2022-05-01T10:00:00Z'), _sign_in('b', '2022-05-01T10:05:00Z')],
+        # c was created before the watermark but only listed on the next run
+        [_sign_in('a', '2022-05-01T10:00:00Z'), _sign_in('b', '2022-05-01T10:05:00Z'),
+         _sign_in('c', '2022-05-01T10:01:00Z'), _sign_in('d', '2022-05-01T10:20:00Z')],
+        [_sign_in('d', '2022-05-01T10:20:00Z'), _sign_in('e', '2022-05-01T10:20:00Z')],
+    ])
+    aad_collector.collect()
+    assert _collected_ids(aad_collector) == ('2022-05-01T10:05:00Z', {'a', 'b'})
+    aad_collector.collect()
+    assert 'createdDateTime ge 2022-05-01T09:55:00Z' in unquote(FakeGraphClient.urls[0])
+    # ids of sign-ins before the next fetched range are forgotten
+    assert _collected_ids(aad_collector) == ('2022-05-01T10:20:00Z', {'d'})
+    aad_collector.collect()
+    assert 'createdDateTime ge 2022-05-01T10:10:00Z' in unquote(FakeGraphClient.urls[0])
+    assert _collected_ids(aad_collector) == ('2022-05-01T10:20:00Z', {'d', 'e'})
+    assert _written_times() == ['2022-05-01T10:00:00Z', '2022-05-01T10:05:00Z', '2022-05-01T10:01:00Z',
+                                '2022-05-01T10:20:00Z', '2022-05-01T10:20:00Z']
+
+
+def test_sign_ins_of_the_watermark_second_are_collected_once(aad_collector, monkeypatch):
+    monkeypatch.setitem(aad_collector.config, 'SIGN_IN_DELAY_MINUTES', 0)
+    monkeypatch.setattr(FakeGraphClient, 'runs', [
+        [_sign_in('a', '2022-05-01T10:00:00Z'), _sign_in('b', '2022-05-01T10:00:05Z')],
+        # c was created in the watermark second but only listed on the next run
+        [_sign_in('b', '2022-05-01T10:00:05Z'), _sign_in('c', '2022-05-01T10:00:05Z', device='')],
+        [_sign_in('b', '2022-05-01T10:00:05Z'), _sign_in('c', '2022-05-01T10:00:05Z', device=''),
+         _sign_in('d', '2022-05-01T10:00:05Z')],
+        [_sign_in('b', '2022-05-01T10:00:05Z'), _sign_in('c', '2022-05-01T10:00:05Z', device=''),
+         _sign_in('d', '2022-05-01T10:00:05Z'), _sign_in('e', '2022-05-01T10:00:09Z')],
+    ])
+    ids = []
+    for _ in range(4):
+        aad_collector.collect()
+        assert 'createdDateTime ge ' in unquote(FakeGraphClient.urls[0])
+        ids.append(_collected_ids(aad_collector))
+    assert ids == [('2022-05-01T10:00:05Z', {'b'}), ('2022-05-01T10:00:05Z', {'b', 'c'}),
+                   ('2022-05-01T10:00:05Z', {'b', 'c', 'd'}), ('2022-05-01T10:00:09Z', {'e'})]
+    assert _written_times() == ['2022-05-01T10:00:00Z', '2022-05-01T10:00:05Z', '2022-05-01T10:00:05Z',
+                                '2022-05-01T10:00:09Z']
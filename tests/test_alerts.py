@@ -0,0 +1,76 @@
+from latma.analyzer.alerts import CREATED, EXPIRATION_INTERVAL, JOINED, MERGED, AlertGraph, PropagationTracker
+from latma.analyzer.authentications import MINUTES_PER_DAY, Authentication
+from latma.analyzer.baseline import Baseline
+from latma.analyzer.detection import BLAST, WHITE_CANE, StreamingDetector
+
+START_MINUTE = 30 * MINUTES_PER_DAY
+
+
+def _edge(username, source, destination, minute=START_MINUTE):
+    return Authentication(username, source, destination, 'cifs/x', minute, 'NTLM')
+
+
+def test_edges_create_join_and_merge_alerts():
+    alert_graph = AlertGraph()
+    assert alert_graph.add(_edge('alice', 'ws1', 'ws2')) == (1, CREATED, [])
+    assert alert_graph.add(_edge('bob', 'ws3', 'ws4')) == (2, CREATED, [])
+    assert alert_graph.add(_edge('alice', 'ws2', 'ws5')) == (1, JOINED, [])
+    assert alert_graph.add(_edge('carol', 'ws6', 'ws7')) == (3, CREATED, [])
+    # the oldest alert keeps its id
+    assert alert_graph.add(_edge('carol', 'ws4', 'ws5')) == (1, MERGED, [2, 3])
+    hosts, accounts = alert_graph.members(1)
+    assert sorted(hosts) == ['ws1', 'ws2', 'ws3', 'ws4', 'ws5', 'ws6', 'ws7']
+    assert sorted(accounts) == ['alice', 'bob', 'carol']
+    assert alert_graph.members(2) is None and alert_graph.members(3) is None
+    alert = alert_graph.host_alert('ws7')
+    assert alert is alert_graph.account_alert('bob')
+    assert (alert.alert_id, alert.edge_count) == (1, 5)
+    assert alert_graph.host_alert('ws8') is None
+
+
+def test_merging_an_alert_with_itself_joins_it():
+    alert_graph = AlertGraph()
+    alert_graph.add(_edge('alice', 'ws1', 'ws2'))
+    alert_graph.add(_edge('bob', 'ws2', 'ws3'))
+    assert alert_graph.add(_edge('bob', 'ws1', 'ws3')) == (1, JOINED, [])
+    assert alert_graph.host_alert('ws3').edge_count == 3
+
+
+def test_alerts_expire_without_new_edges():
+    alert_graph = AlertGraph(expiration=120)
+    alert_graph.add(_edge('alice', 'ws1', 'ws2'))
+    alert_graph.add(_edge('bob', 'ws3', 'ws4', START_MINUTE + 100))
+    assert alert_graph.expire(START_MINUTE + 120) == []
+    assert alert_graph.expire(START_MINUTE + 121) == [1]
+    assert alert_graph.host_alert('ws1') is None and alert_graph.account_alert('alice') is None
+    assert alert_graph.members(1) is None
+    # expired hosts and accounts join other alerts like new ones, reusing their slots
+    slots = len(alert_graph.parent)
+    assert alert_graph.add(_edge('alice', 'ws1', 'ws3', START_MINUTE + 130)) == (2, JOINED, [])
+    assert len(alert_graph.parent) == slots
+    assert sorted(alert_graph.members(2)[0]) == ['ws1', 'ws3', 'ws4']
+
+
+def test_new_edges_expire_alerts_periodically():
+    alert_graph = AlertGraph(expiration=10)
+    alert_graph.add(_edge('alice', 'ws1', 'ws2'))
+    alert_graph.add(_edge('bob', 'ws3', 'ws4', START_MINUTE + EXPIRATION_INTERVAL - 1))
+    assert alert_graph.members(1) is not None
+    assert alert_graph.add(_edge('alice', 'ws1', 'ws5', START_MINUTE + EXPIRATION_INTERVAL)) == (3, CREATED, [])
+    assert alert_graph.members(1) is None and alert_graph.members(2) is not None
+
+
+def test_an_edge_of_several_iocs_is_added_to_the_alert_graph_once():
+    # one learning day and nothing benign, so every relevant authentication after the first day is an edge
+    baseline = Baseline(sink_accounts=10 ** 6, hub_accounts=10 ** 6, match_days=2, window_days=1)
+    tracker = PropagationTracker(StreamingDetector(baseline))
+    tracker.process(Authentication('learner', 'g0', 'g0', '', START_MINUTE - MINUTES_PER_DAY, 'NTLM'))
+    rows = []
+    for destination in range(1, 11):
+        rows.extend(tracker.process(_edge('alice', 'ws0', f'ws{destination}')))
+    iocs = [row[6] for row in rows]
+    assert iocs.count(WHITE_CANE) == 10 and iocs.count(BLAST) == 10
+    assert {row[7] for row in rows} == {1}
+    assert [row[8] for row in rows if row[2] == 'ws1'] == [CREATED, CREATED]
+    assert {row[8] for row in rows if row[2] != 'ws1'} == {JOINED}
+    assert tracker.alert_graph.host_alert('ws0').edge_count == 10
@@ -0,0 +1,84 @@
+from latma.analyzer.authentications import Authentication
+from latma.analyzer.baseline import BENIGN_HUB, BENIGN_MATCH, BENIGN_SINK, Baseline
+from latma.analyzer.detection import filter_edges
+
+FIRST_DAY = 19000
+WINDOW_DAYS = 3
+
+
+def _baseline():
+    return Baseline(sink_accounts=3, hub_accounts=3, match_days=2, window_days=WINDOW_DAYS)
+
+
+def test_learning_period():
+    baseline = _baseline()
+    assert baseline.in_learning_period(FIRST_DAY)
+    baseline.learn('alice', 'ws1', 'fs1', FIRST_DAY)
+    assert baseline.in_learning_period(FIRST_DAY + WINDOW_DAYS - 1)
+    assert not baseline.in_learning_period(FIRST_DAY + WINDOW_DAYS)
+
+
+def test_sink_accounts_must_be_seen_within_the_window():
+    baseline = _baseline()
+    for day, username in enumerate(('alice', 'bob', 'carol'), FIRST_DAY):
+        baseline.learn(username, f'ws-{username}', 'fs1', day)
+        assert baseline.is_sink('fs1') is (username == 'carol')
+    # alice was last seen before the window of the first day after the learning period
+    assert not baseline.is_sink('fs1', FIRST_DAY + WINDOW_DAYS)
+    baseline.learn('dave', 'ws1', 'ws2', FIRST_DAY + WINDOW_DAYS)
+    assert not baseline.is_sink('fs1')
+    baseline.learn('alice', 'ws-alice', 'fs1', FIRST_DAY + WINDOW_DAYS)
+    assert baseline.is_sink('fs1')
+    assert not baseline.is_hub('fs1') and not baseline.is_sink('ws-alice')
+
+
+def test_hub_keeps_the_most_recent_accounts():
+    baseline = _baseline()
+    for index, username in enumerate(('alice', 'bob', 'carol', 'dave', 'erin')):
+        baseline.learn(username, 'jump1', f'srv{index}', FIRST_DAY + index // 2)
+    assert list(baseline.source_accounts[baseline.hosts.get('jump1')]) == [
+        baseline.accounts.get(username) for username in ('carol', 'dave', 'erin')]
+    assert baseline.is_hub('jump1', FIRST_DAY + WINDOW_DAYS)
+    assert not baseline.is_hub('jump1', FIRST_DAY + WINDOW_DAYS + 1)
+
+
+def test_account_machine_match_needs_different_days_within_the_window():
+    baseline = _baseline()
+    baseline.learn('alice', 'ws1', 'fs1', FIRST_DAY)
+    baseline.learn('alice', 'ws1', 'fs2', FIRST_DAY)
+    assert not baseline.is_match('alice', 'ws1')
+    baseline.learn('alice', 'ws1', 'fs1', FIRST_DAY + 2)
+    assert baseline.is_match('alice', 'ws1')
+    assert not baseline.is_match('alice', 'ws2') and not baseline.is_match('bob', 'ws1')
+    # the first day leaves the window on the first day after the learning period
+    assert baseline.is_match('alice', 'ws1', FIRST_DAY + WINDOW_DAYS - 1)
+    assert not baseline.is_match('alice', 'ws1', FIRST_DAY + WINDOW_DAYS)
+    baseline.learn('alice', 'ws1', 'fs1', FIRST_DAY + WINDOW_DAYS)
+    assert baseline.is_match('alice', 'ws1')
+    assert not baseline.is_match('alice', 'ws1', FIRST_DAY + 2 * WINDOW_DAYS)
+
+
+def test_eviction_drops_profiles_outside_the_window():
+    baseline = _baseline()
+    baseline.learn('alice', 'ws1', 'fs1', FIRST_DAY)
+    baseline.learn('bob', 'ws2', 'fs2', FIRST_DAY + WINDOW_DAYS)
+    assert baseline.size() == {'accounts': 2, 'hosts': 4, 'destinations': 1, 'sources': 1, 'pairs': 1}
+
+
+def test_benign_reasons_across_the_learning_period_boundary():
+    baseline = _baseline()
+    learning = []
+    for day in range(FIRST_DAY, FIRST_DAY + WINDOW_DAYS):
+        for username in ('alice', 'bob', 'carol'):
+            learning.append(Authentication(username, f'ws-{username}', 'fs1', '', day * 1440, 'NTLM'))
+            learning.append(Authentication(username, 'jump1', f'srv-{username}', '', day * 1440 + 1, 'NTLM'))
+        learning.append(Authentication('dave', 'ws-dave', 'ws-erin', '', day * 1440 + 2, 'NTLM'))
+    assert list(filter_edges(learning, baseline)) == []
+    day = FIRST_DAY + WINDOW_DAYS
+    after = [Authentication('erin', 'ws-erin', 'fs1', '', day * 1440, 'NTLM'),
+             Authentication('erin', 'jump1', 'ws-dave', '', day * 1440, 'NTLM'),
+             Authentication('dave', 'ws-dave', 'ws-frank', '', day * 1440, 'NTLM'),
+             Authentication('erin', 'ws-erin', 'ws-dave', '', day * 1440, 'NTLM')]
+    assert list(filter_edges(after, baseline)) == [after[3]]
+    assert [baseline.benign_reason(*authentication[:3], day) for authentication in after[:3]] == [
+        BENIGN_SINK, BENIGN_HUB, BENIGN_MATCH]
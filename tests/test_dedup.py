@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+
+from latma.dedup import DedupIndex
+
+LOG = 'Security'
+CAPACITY = 1000
+
+
+def _keys(host, record_ids):
+    return [(host, LOG, record_id) for record_id in record_ids]
+
+
+def _filter(dedup_index, keys):
+    rows = [[host, str(record_id)] for host, _, record_id in keys]
+    kept, kept_keys = dedup_index.filter(rows, keys)
+    assert [[host, str(record_id)] for host, _, record_id in kept_keys] == kept
+    return [record_id for _, _, record_id in kept_keys]
+
+
+def _seen(dedup_index):
+    return dedup_index.conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+
+def test_a_rerun_drops_the_committed_keys(tmp_path):
+    path = str(tmp_path / 'collector_dedup')
+    with DedupIndex(path, capacity=CAPACITY) as dedup_index:
+        assert _filter(dedup_index, _keys('ws1', [1, 2, 3])) == [1, 2, 3]
+        # a batch collected twice in the same run
+        assert _filter(dedup_index, _keys('ws1', [3, 4])) == [4]
+        dedup_index.commit()
+    with DedupIndex(path, capacity=CAPACITY) as dedup_index:
+        assert _filter(dedup_index, _keys('ws1', [2, 4, 5]) + _keys('ws2', [1])) == [5, 1]
+        assert dedup_index.duplicates == 2
+        # rows of events without an EventRecordID, decoded as 0, are always kept
+        assert _filter(dedup_index, _keys('ws1', [0, 0])) == [0, 0]
+
+
+def test_keys_the_filter_reports_as_seen_are_looked_up_in_the_table(tmp_path):
+    with DedupIndex(str(tmp_path / 'collector_dedup'), capacity=CAPACITY) as dedup_index:
+        _filter(dedup_index, _keys('ws1', [1, 2]))
+        dedup_index.commit()
+        # every key is a false positive of a full filter
+        dedup_index.bits[:] = 0xff
+        assert _filter(dedup_index, _keys('ws1', [1, 2, 3, 4])) == [3, 4]
+        assert dedup_index.duplicates == 2
+
+
+def test_the_filter_is_rebuilt_when_missing_or_sized_for_another_capacity(tmp_path):
+    path = str(tmp_path / 'collector_dedup')
+    with DedupIndex(path, capacity=CAPACITY) as dedup_index:
+        _filter(dedup_index, _keys('ws1', range(1, 101)))
+        dedup_index.commit()
+        bits = np.array(dedup_index.bits)
+    os.remove(f"{path}.bloom")
+    with DedupIndex(path, capacity=CAPACITY) as dedup_index:
+        assert np.array_equal(dedup_index.bits, bits)
+        assert _filter(dedup_index, _keys('ws1', [100, 101])) == [101]
+    with DedupIndex(path, capacity=CAPACITY * 10) as dedup_index:
+        assert os.path.getsize(f"{path}.bloom") == len(dedup_index.bits) > len(bits)
+        # the rebuilt filter holds all 100 committed keys, so none of them is dropped without the table
+        assert np.count_nonzero(dedup_index.bits) >= 100
+        assert _filter(dedup_index, _keys('ws1', [1, 50, 101])) == [101]
+
+
+def test_held_keys_are_committed_by_a_later_commit(tmp_path):
+    path = str(tmp_path / 'collector_dedup')
+    with DedupIndex(path, capacity=CAPACITY) as dedup_index:
+        _filter(dedup_index, _keys('ws1', [1, 2, 3]))
+        dedup_index.commit(held_keys=_keys('ws1', [3]))
+        assert _seen(dedup_index) == 2 and len(dedup_index.pending) == 1
+        # a held key is still dropped when it repeats in the same run
+        assert _filter(dedup_index, _keys('ws1', [3])) == []
+    # held keys that were never committed are collected again
+    with DedupIndex(path, capacity=CAPACITY) as dedup_index:
+        assert _filter(dedup_index, _keys('ws1', [2, 3])) == [3]
+        dedup_index.commit(held_keys=_keys('ws1', [3]))
+        dedup_index.commit()
+        assert _seen(dedup_index) == 3 and not dedup_index.pending
@@ -0,0 +1,105 @@
+import random
+
+import pytest
+
+from latma.analyzer.authentications import MINUTES_PER_DAY, Authentication
+from latma.analyzer.baseline import Baseline
+from latma.analyzer.detection import (BLAST, SWITCHED_BRIDGE, WHITE_CANE, Detection, StreamingDetector, detect_batch,
+                                      edge_frame, filter_edges)
+
+START_MINUTE = 30 * MINUTES_PER_DAY
+HOSTS = 15
+ACCOUNTS = 8
+
+
+def _baseline():
+    # one learning day and nothing benign, so every relevant authentication after the first day is an edge
+    return Baseline(sink_accounts=10 ** 6, hub_accounts=10 ** 6, match_days=2, window_days=1)
+
+
+def _authentications(seed, count=1500):
+    """
+    Random authentications with fan-out bursts and gaps crossing the bridge and weight shift windows, after one
+    authentication ending the learning period.
+    """
+    rng = random.Random(seed)
+    minute = START_MINUTE
+    authentications = [Authentication('learner', 'g0', 'g0', '', minute - MINUTES_PER_DAY, 'NTLM')]
+    while len(authentications) < count:
+        minute += rng.choice((0, 0, 1, 2, 5, 30, 400))
+        if rng.random() < 0.03:
+            username, source = f"u{rng.randrange(ACCOUNTS)}", rng.randrange(HOSTS)
+            for destination in rng.sample([host for host in range(HOSTS) if host != source], rng.randrange(3, 13)):
+                minute += rng.choice((0, 0, 1))
+                authentications.append(Authentication(username, f"g{source}", f"g{destination}", 'cifs/x', minute,
+                                                      'NTLM'))
+            continue
+        source, destination = rng.sample(range(HOSTS), 2)
+        authentications.append(Authentication(f"u{rng.randrange(ACCOUNTS)}", f"g{source}", f"g{destination}",
+                                              'cifs/x', minute, 'NTLM'))
+    return authentications
+
+
+def _stream(authentications):
+    detector = StreamingDetector(_baseline())
+    detections = []
+    for authentication in authentications:
+        detections.extend(detector.process(authentication))
+    return detections
+
+
+def _batch(authentications):
+    return detect_batch(edge_frame(filter_edges(authentications, _baseline())))
+
+
+def _join_fan_outs(detections):
+    """
+    Join the streaming reports of every fan-out, its start and every edge continuing it, into one Detection as batch
+    detection reports it.
+    """
+    fan_outs = {}
+    joined = []
+    for detection in detections:
+        if detection.ioc not in (BLAST, WHITE_CANE):
+            joined.append(detection)
+            continue
+        key = detection.ioc, detection.edges[0]
+        if key in fan_outs:
+            fan_outs[key] = fan_outs[key]._replace(edges=fan_outs[key].edges + detection.edges[1:])
+        else:
+            fan_outs[key] = detection
+    return sorted(joined + list(fan_outs.values()))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_streaming_and_batch_detections_are_identical(seed):
+    authentications = _authentications(seed)
+    streaming = _join_fan_outs(_stream(authentications))
+    assert {detection.ioc for detection in streaming} == {'White Cane', 'Blast', 'Bridge', 'Switched Bridge',
+                                                          'Weight Shift'}
+    assert streaming == sorted(_batch(authentications))
+
+
+def test_switched_bridge_falls_back_to_earlier_predecessor():
+    minute = START_MINUTE
+    authentications = [
+        Authentication('learner', 'g9', 'g9', '', minute - MINUTES_PER_DAY, 'NTLM'),
+        Authentication('u3', 'g3', 'g0', 'cifs/x', minute, 'NTLM'),
+        # the latest edge into g0 comes from the destination of the edge out of g0
+        Authentication('u1', 'g10', 'g0', 'cifs/x', minute + 1, 'NTLM'),
+        Authentication('u4', 'g0', 'g10', 'cifs/x', minute + 2, 'NTLM'),
+    ]
+    expected = Detection(SWITCHED_BRIDGE, minute + 2, (0, 2))
+    assert [detection for detection in _stream(authentications) if detection.ioc == SWITCHED_BRIDGE] == [expected]
+    assert [detection for detection in _batch(authentications) if detection.ioc == SWITCHED_BRIDGE] == [expected]
+
+
+def test_bridge_ignores_later_edges_of_the_same_minute():
+    minute = START_MINUTE
+    authentications = [
+        Authentication('learner', 'g9', 'g9', '', minute - MINUTES_PER_DAY, 'NTLM'),
+        Authentication('u1', 'g0', 'g1', 'cifs/x', minute, 'NTLM'),
+        Authentication('u1', 'g2', 'g0', 'cifs/x', minute, 'NTLM'),
+    ]
+    assert _stream(authentications) == []
+    assert _batch(authentications) == []
@@ -0,0 +1,68 @@
+import pytest
+
+from latma.bench.generators import SyntheticEnvironment
+from latma.bench.legacy_parser import legacy_parse_event
+from latma.event_parser import parse_event
+
+pytest.importorskip('bs4')
+
+DOMAIN = 'corp.local'
+NTLM_EVENT = (
+    '<Event xmlns="http://schemas.microsoft.com/win/2004/08/events/event"><System>'
+    '<Provider Name="Microsoft-Windows-NTLM"/><EventID>8004</EventID>'
+    '<TimeCreated SystemTime="2022-05-01T10:11:12.1234567Z"/><EventRecordID>17</EventRecordID>'
+    '<Channel>Microsoft-Windows-NTLM/Operational</Channel><Computer>DC01.corp.local</Computer></System><EventData>'
+    '<Data Name="SChannelName">DC01</Data><Data Name="UserName">{user}</Data><Data Name="DomainName">CORP</Data>'
+    '<Data Name="WorkstationName">{workstation}</Data><Data Name="SChannelType">2</Data></EventData></Event>'
+)
+KERBEROS_EVENT = (
+    '<Event xmlns="http://schemas.microsoft.com/win/2004/08/events/event"><System>'
+    '<Provider Name="Microsoft-Windows-Security-Auditing"/><EventID>4648</EventID>'
+    '<TimeCreated SystemTime="2022-05-01T23:59:59.9999999Z"/><EventRecordID>4242</EventRecordID>'
+    '<Channel>Security</Channel><Computer>WS01.corp.local</Computer></System><EventData>'
+    '<Data Name="SubjectUserSid">S-1-5-18</Data><Data Name="SubjectUserName">WS01$</Data>'
+    '<Data Name="SubjectDomainName">CORP</Data><Data Name="SubjectLogonId">0x3e7</Data>'
+    '<Data Name="LogonGuid">{{00000000-0000-0000-0000-000000000000}}</Data>'
+    '<Data Name="TargetUserName">{user}</Data><Data Name="TargetDomainName">CORP</Data>'
+    '<Data Name="TargetLogonGuid">{{00000000-0000-0000-0000-000000000000}}</Data>'
+    '<Data Name="TargetServerName">WS02.corp.local</Data>{target_info}'
+    '<Data Name="ProcessId">0x4</Data><Data Name="IpAddress">-</Data><Data Name="IpPort">-</Data></EventData></Event>'
+)
+TARGET_INFO = '<Data Name="TargetInfo">TERMSRV/WS02</Data>'
+
+
+def test_parity_with_the_beautifulsoup_parser_on_synthetic_events():
+    environment = SyntheticEnvironment(hosts=20, accounts=50, domain_controllers=2, seed=7)
+    events = environment.mixed_events(1000)
+    assert {event.split('<EventID>')[1][:4] for event in events} == {'8004', '4648'}
+    for event in events:
+        assert parse_event(event, environment.domain) == legacy_parse_event(event, environment.domain)
+
+
+@pytest.mark.parametrize('event', [
+    NTLM_EVENT.format(user='Alice', workstation='WS01'),
+    NTLM_EVENT.format(user='a&amp;b', workstation='WS01'),
+    # a field with an empty value is rendered as an empty element
+    NTLM_EVENT.format(user='Alice', workstation=''),
+    NTLM_EVENT.format(user='Alice', workstation='').replace('<Data Name="WorkstationName"></Data>',
+                                                            '<Data Name="WorkstationName"/>'),
+    KERBEROS_EVENT.format(user='Bob', target_info=TARGET_INFO),
+    KERBEROS_EVENT.format(user='', target_info=TARGET_INFO),
+    KERBEROS_EVENT.format(user='Bob', target_info='<Data Name="TargetInfo"/>'),
+])
+def test_parity_with_the_beautifulsoup_parser(event):
+    assert parse_event(event, DOMAIN) == legacy_parse_event(event, DOMAIN)
+
+
+def test_missing_data_field():
+    event = KERBEROS_EVENT.format(user='Bob', target_info='')
+    assert parse_event(event, DOMAIN) == ['bob', 'ws01.corp.local', 'ws02.corp.local', '', '01/05/2022 23:59',
+                                          'KERBEROS']
+    # the positional parser read the field after the missing one
+    assert legacy_parse_event(event, DOMAIN)[3] == '0x4'
+
+
+def test_unsupported_event():
+    event = NTLM_EVENT.format(user='Alice', workstation='WS01').replace('8004', '8003')
+    assert parse_event(event, DOMAIN) is None
+    assert legacy_parse_event(event, DOMAIN) is None
@@ -0,0 +1,110 @@
+from datetime import datetime
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from latma.event_parser import KERBEROS_EVENT_ID, NTLM_EVENT_ID, EventRecord
+from latma.filters import EventFilter, FieldCondition, _literal, build_filter
+from latma.utils import evtx_query_builder
+
+NTLM_LOG = 'Microsoft-Windows-NTLM/Operational'
+SECURITY_LOG = 'Security'
+HOST = 'WS01.corp.local'
+EXCLUDED_ACCOUNTS = ('svc1', "o'brien")
+START_DATE = datetime(2022, 5, 1)
+
+NTLM_SELECT = (f'<Select Path="{NTLM_LOG}">*[System[(EventID=8004) and '
+               "TimeCreated[@SystemTime&gt;='2022-05-01T00:00:00.000Z'] and (EventRecordID&gt;7)]]</Select>")
+KERBEROS_SELECT = (f'<Select Path="{SECURITY_LOG}">*[System[(EventID=4648) and '
+                   "TimeCreated[@SystemTime&gt;='2022-05-01T00:00:00.000Z'] and (EventRecordID&gt;7)]]</Select>")
+LOOPBACK = ("(Data[@Name='TargetServerName']='localhost' or Data[@Name='TargetServerName']='127.0.0.1' or "
+            "Data[@Name='TargetServerName']='::1')")
+SELF = ("(Data[@Name='TargetServerName']='WS01.corp.local' or Data[@Name='TargetServerName']='ws01.corp.local' or "
+        "Data[@Name='TargetServerName']='WS01' or Data[@Name='TargetServerName']='ws01')")
+
+
+def _query(log, select, *suppress):
+    suppress_element = f'<Suppress Path="{log}">*[EventData[{" or ".join(suppress)}]]</Suppress>' if suppress else ''
+    return f'<QueryList><Query Id="0" Path="{log}">{select}{suppress_element}</Query></QueryList>'
+
+
+def _excluded(field):
+    return f"(Data[@Name='{field}']='svc1' or Data[@Name='{field}']=\"o'brien\")"
+
+
+@pytest.mark.parametrize('event_id, log, relevant_only, excluded_accounts, expected', [
+    (NTLM_EVENT_ID, NTLM_LOG, False, (), _query(NTLM_LOG, NTLM_SELECT)),
+    (NTLM_EVENT_ID, NTLM_LOG, False, EXCLUDED_ACCOUNTS, _query(NTLM_LOG, NTLM_SELECT, _excluded('UserName'))),
+    (NTLM_EVENT_ID, NTLM_LOG, True, (), _query(NTLM_LOG, NTLM_SELECT)),
+    (NTLM_EVENT_ID, NTLM_LOG, True, EXCLUDED_ACCOUNTS, _query(NTLM_LOG, NTLM_SELECT, _excluded('UserName'))),
+    (KERBEROS_EVENT_ID, SECURITY_LOG, False, (), _query(SECURITY_LOG, KERBEROS_SELECT, LOOPBACK)),
+    (KERBEROS_EVENT_ID, SECURITY_LOG, False, EXCLUDED_ACCOUNTS,
+     _query(SECURITY_LOG, KERBEROS_SELECT, LOOPBACK, _excluded('TargetUserName'))),
+    (KERBEROS_EVENT_ID, SECURITY_LOG, True, (), _query(SECURITY_LOG, KERBEROS_SELECT, LOOPBACK, SELF)),
+    (KERBEROS_EVENT_ID, SECURITY_LOG, True, EXCLUDED_ACCOUNTS,
+     _query(SECURITY_LOG, KERBEROS_SELECT, LOOPBACK, _excluded('TargetUserName'), SELF)),
+])
+def test_compiled_query(event_id, log, relevant_only, excluded_accounts, expected):
+    event_filter = build_filter(event_id, relevant_only, excluded_accounts).for_host(HOST)
+    query = evtx_query_builder(event_id, log, START_DATE, min_record_id=7, event_filter=event_filter)
+    assert query == expected
+    ET.fromstring(query)
+
+
+def test_compiled_query_without_start_and_watermark():
+    query = evtx_query_builder(KERBEROS_EVENT_ID, SECURITY_LOG, None, event_filter=build_filter(KERBEROS_EVENT_ID))
+    assert query == (f'<QueryList><Query Id="0" Path="{SECURITY_LOG}"><Select Path="{SECURITY_LOG}">'
+                     f'*[System[(EventID=4648)]]</Select><Suppress Path="{SECURITY_LOG}">*[EventData[{LOOPBACK}]]'
+                     '</Suppress></Query></QueryList>')
+
+
+def test_relevance_filter_keeps_the_same_query_for_logs_not_naming_the_destination():
+    event_filter = build_filter(NTLM_EVENT_ID, relevant_only=True)
+    assert event_filter.for_host(HOST) is event_filter
+
+
+@pytest.mark.parametrize('value, literal', [
+    ('svc1', "'svc1'"),
+    ("o'brien", '"o\'brien"'),
+    ('say "hi"', '\'say "hi"\''),
+    ('it\'s "both"', None),
+])
+def test_literal(value, literal):
+    assert _literal(value) == literal
+
+
+def test_value_with_both_quotes_is_left_to_the_parsers():
+    both_quotes = 'it\'s "both"'
+    event_filter = EventFilter(select=(FieldCondition('TargetInfo', ('rpcss/a', both_quotes)),),
+                               suppress=(FieldCondition('TargetUserName', ('svc1', both_quotes)),))
+    # a select condition can't leave out a value without dropping the events matching it
+    assert event_filter.select_xpath() is None
+    assert event_filter.suppress_xpath() == "*[EventData[(Data[@Name='TargetUserName']='svc1')]]"
+    query = evtx_query_builder(KERBEROS_EVENT_ID, SECURITY_LOG, None, event_filter=event_filter)
+    ET.fromstring(query)
+    event = EventRecord(KERBEROS_EVENT_ID, 1, None, HOST, SECURITY_LOG,
+                        {'TargetInfo': 'rpcss/a', 'TargetUserName': both_quotes})
+    assert not event_filter.accepts(event, ['user', 'ws01.corp.local', 'ws02', 'rpcss/a', '', 'Kerberos'])
+
+
+def test_ampersand_in_a_value_stays_valid_xml():
+    event_filter = build_filter(NTLM_EVENT_ID, excluded_accounts=('r&d',))
+    query = evtx_query_builder(NTLM_EVENT_ID, NTLM_LOG, None, event_filter=event_filter)
+    suppress = ET.fromstring(query).find('Query/Suppress')
+    assert suppress.text == "*[EventData[(Data[@Name='UserName']='r&d')]]"
+
+
+@pytest.mark.parametrize('event_id, data, row, accepted', [
+    # machine accounts are part of the authentication graph
+    (NTLM_EVENT_ID, {'UserName': 'WS02$'}, ['ws02$', 'ws02@corp', 'dc01@corp', '-', '', 'NTLM'], True),
+    (NTLM_EVENT_ID, {'UserName': 'user'}, ['user', 'ws02@corp', 'ws02@corp', '-', '', 'NTLM'], False),
+    (KERBEROS_EVENT_ID, {'TargetInfo': 'TERMSRV/ws02', 'TargetServerName': 'ws02'},
+     ['user', 'ws01.corp.local', 'ws02', 'termsrv/ws02', '', 'Kerberos'], True),
+    (KERBEROS_EVENT_ID, {'TargetInfo': 'cifs/ws02', 'TargetServerName': 'ws02'},
+     ['user', 'ws01.corp.local', 'ws02', 'cifs/ws02', '', 'Kerberos'], False),
+    (KERBEROS_EVENT_ID, {'TargetInfo': 'rpcss/ws01', 'TargetServerName': 'WS01'},
+     ['user', 'ws01.corp.local', 'ws01', 'rpcss/ws01', '', 'Kerberos'], False),
+])
+def test_relevance_filter_accepts(event_id, data, row, accepted):
+    event = EventRecord(event_id, 1, None, HOST, SECURITY_LOG, data)
+    assert build_filter(event_id, relevant_only=True).accepts(event, row) is accepted
@@ -0,0 +1,97 @@
+import threading
+from http import HTTPStatus
+from itertools import islice
+
+import pytest
+
+from latma.azure_ad.graph_client import GraphClient
+from latma.bench.graph_server import SIGN_IN_LOGS_PATH, SignInGraphServer
+
+SIGN_INS = [{'id': str(index), 'createdDateTime': f'2022-05-01T10:{index // 60:02}:{index % 60:02}Z'}
+            for index in range(100)]
+PAGE_SIZE = 10
+# one query of all sign-ins, and two windows of half of them
+QUERY = ('auditLogs/signIns?$filter=createdDateTime ge 2022-05-01T10:00:00Z and createdDateTime le '
+         '2022-05-01T11:00:00Z')
+WINDOWS = ['auditLogs/signIns?$filter=createdDateTime ge 2022-05-01T10:00:00Z and createdDateTime le '
+           '2022-05-01T10:00:49Z',
+           'auditLogs/signIns?$filter=createdDateTime gt 2022-05-01T10:00:49Z and createdDateTime le '
+           '2022-05-01T11:00:00Z']
+
+
+@pytest.fixture
+def graph_server(request):
+    with SignInGraphServer(SIGN_INS, page_size=PAGE_SIZE, **getattr(request, 'param', {})) as server:
+        yield server
+
+
+def _client(server, **kwargs):
+    kwargs.setdefault('requests_per_second', 1000)
+    kwargs.setdefault('max_retry_wait', 0)
+    return GraphClient(lambda: 'token', base_url=server.url, **kwargs)
+
+
+def _ids(pages):
+    return sorted(int(sign_in['id']) for page in pages for sign_in in page)
+
+
+def _fetch_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith('ThreadPoolExecutor')]
+
+
+@pytest.mark.parametrize('graph_server', [{'throttle_every': 5, 'retry_after': 1}], indirect=True)
+def test_retry_after_holds_every_thread(graph_server):
+    with _client(graph_server, threads=2, max_retry_wait=5) as client:
+        assert _ids(client.iter_pages_concurrently(WINDOWS)) == list(range(100))
+    throttled = [time for time, status, _ in graph_server.responses if status == HTTPStatus.TOO_MANY_REQUESTS]
+    assert len(throttled) == graph_server.throttled >= 2
+    for throttle_time in throttled:
+        # requests sent before the client received the 429 are answered right after it, then all threads wait
+        assert not [time for time, _, _ in graph_server.responses
+                    if throttle_time + 0.2 < time < throttle_time + 0.9]
+
+
+@pytest.mark.parametrize('graph_server', [{'failures': {3: HTTPStatus.SERVICE_UNAVAILABLE}}], indirect=True)
+def test_only_the_failed_page_is_retried(graph_server):
+    with _client(graph_server, threads=1) as client:
+        assert _ids(client.iter_pages(QUERY)) == list(range(100))
+    paths = [path for _, _, path in graph_server.responses]
+    assert len(paths) == 100 // PAGE_SIZE + 1
+    assert paths[2] == paths[3] and len(set(paths)) == 100 // PAGE_SIZE
+    assert [status for _, status, _ in graph_server.responses].count(HTTPStatus.SERVICE_UNAVAILABLE) == 1
+
+
+@pytest.mark.parametrize('graph_server', [{'tokens': {'refreshed'}}], indirect=True)
+def test_an_expired_token_is_refreshed_once_for_all_threads(graph_server):
+    tokens = ['expired', 'refreshed']
+    provided = []
+    client = GraphClient(lambda: provided.append(1) or tokens[len(provided) - 1], base_url=graph_server.url,
+                         threads=2, requests_per_second=1000, max_retry_wait=0)
+    with client:
+        assert _ids(client.iter_pages_concurrently(WINDOWS)) == list(range(100))
+    assert len(provided) == 2 and client.token == 'refreshed'
+    unauthorized = [status for _, status, _ in graph_server.responses].count(HTTPStatus.UNAUTHORIZED)
+    assert 1 <= unauthorized <= 2
+
+
+@pytest.mark.parametrize('graph_server', [{'failures': {2: HTTPStatus.FORBIDDEN}}], indirect=True)
+def test_an_unexpected_status_raises(graph_server):
+    with _client(graph_server, threads=1) as client:
+        pages = client.iter_pages(QUERY)
+        assert len(next(pages)) == PAGE_SIZE
+        with pytest.raises(RuntimeError, match='403'):
+            next(pages)
+
+
+@pytest.mark.parametrize('graph_server', [{'failures': {4: HTTPStatus.NOT_FOUND}}], indirect=True)
+def test_concurrent_fetching_raises_the_error_of_a_query_and_stops_its_threads(graph_server):
+    with _client(graph_server, threads=2) as client:
+        with pytest.raises(RuntimeError, match='404'):
+            list(client.iter_pages_concurrently(WINDOWS))
+        assert not _fetch_threads()
+        # a consumer that stops early doesn't leave threads behind either
+        pages = client.iter_pages_concurrently(WINDOWS)
+        assert len(list(islice(pages, 2))) == 2
+        pages.close()
+        assert not _fetch_threads()
+    assert graph_server.responses[0][2].startswith(SIGN_IN_LOGS_PATH)
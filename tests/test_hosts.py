@@ -0,0 +1,86 @@
+from threading import Barrier, current_thread
+
+import pytest
+
+from latma.hosts import HostCanonicalizer
+
+DOMAIN = 'corp.local'
+ADDRESSES = ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4']
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """
+    Reverse DNS stand-in, every address resolves to its last octet once 4 lookups run at the same time.
+    """
+    barrier = Barrier(len(ADDRESSES), timeout=5)
+    calls = []
+
+    def resolve(address):
+        calls.append((address, current_thread().name))
+        barrier.wait()
+        return f"ws{address.rsplit('.', 1)[1]}.{DOMAIN}" if address != '10.0.0.4' else None
+
+    monkeypatch.setattr(HostCanonicalizer, '_resolve', staticmethod(resolve))
+    return calls
+
+
+@pytest.mark.parametrize('host, canonical', [
+    ('WS01@corp', 'ws01'),
+    ('WS01.corp.local', 'ws01'),
+    ('cifs/WS01.corp.local:445', 'ws01'),
+    ('\\\\WS01', 'ws01'),
+    ('server.other.org', 'server.other.org'),
+    ('', ''),
+])
+def test_canonical(host, canonical):
+    assert HostCanonicalizer(DOMAIN, resolve_ips=False).canonical(host) == canonical
+
+
+def test_known_computers_keep_their_netbios_name():
+    host_canonicalizer = HostCanonicalizer(DOMAIN, resolve_ips=False)
+    host_canonicalizer.add_computer('SRV-A', 'web.corp.local')
+    assert host_canonicalizer.canonical('http/web.corp.local') == 'srv-a'
+
+
+def test_addresses_resolve_concurrently_away_from_the_writer(lookups):
+    host_canonicalizer = HostCanonicalizer(DOMAIN)
+    rows = [['alice', address, ADDRESSES[-index - 1], '-', '01/05/2022 10:11', 'NTLM']
+            for index, address in enumerate(ADDRESSES)]
+    host_canonicalizer.prefetch(rows)
+    assert host_canonicalizer.canonicalize_rows(rows) == [
+        ['alice', 'ws1', '10.0.0.4', '-', '01/05/2022 10:11', 'NTLM'],
+        ['alice', 'ws2', 'ws3', '-', '01/05/2022 10:11', 'NTLM'],
+        ['alice', 'ws3', 'ws2', '-', '01/05/2022 10:11', 'NTLM'],
+        ['alice', '10.0.0.4', 'ws1', '-', '01/05/2022 10:11', 'NTLM']]
+    assert sorted(address for address, _ in lookups) == ADDRESSES
+    assert all(thread.startswith('dns') for _, thread in lookups)
+    # answers are cached
+    host_canonicalizer.names.clear()
+    assert host_canonicalizer.canonical('10.0.0.2') == 'ws2'
+    assert len(lookups) == len(ADDRESSES)
+    host_canonicalizer.close()
+
+
+def test_no_lookups_without_resolve_ips(lookups):
+    host_canonicalizer = HostCanonicalizer(DOMAIN, resolve_ips=False)
+    rows = [['alice', '10.0.0.1', '10.0.0.2', '-', '01/05/2022 10:11', 'NTLM']]
+    host_canonicalizer.prefetch(rows)
+    assert host_canonicalizer.canonicalize_rows(rows)[0][1:3] == ['10.0.0.1', '10.0.0.2']
+    assert lookups == [] and host_canonicalizer.dns_pool is None
+
+
+def test_caches_evict_the_least_recently_used_entries(monkeypatch):
+    monkeypatch.setattr(HostCanonicalizer, '_resolve', staticmethod(lambda address: f"ws{address[-1]}.{DOMAIN}"))
+    host_canonicalizer = HostCanonicalizer(DOMAIN, dns_cache_size=2, name_cache_size=2)
+    assert [host_canonicalizer.canonical(address) for address in ADDRESSES[:2]] == ['ws1', 'ws2']
+    # using the first address again keeps it over the second one
+    assert host_canonicalizer.canonical(ADDRESSES[0]) == 'ws1'
+    assert host_canonicalizer.canonical(ADDRESSES[2]) == 'ws3'
+    assert list(host_canonicalizer.names) == [ADDRESSES[0], ADDRESSES[2]]
+    # lookups are only used when a name isn't cached
+    assert list(host_canonicalizer.lookups) == [ADDRESSES[1], ADDRESSES[2]]
+    host_canonicalizer.names.clear()
+    assert host_canonicalizer.canonical(ADDRESSES[1]) == 'ws2'
+    assert list(host_canonicalizer.lookups) == [ADDRESSES[2], ADDRESSES[1]]
+    host_canonicalizer.close()
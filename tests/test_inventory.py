@@ -0,0 +1,78 @@
+import pytest
+
+from latma import inventory as inventory_module
+from latma.inventory import ComputerInventory
+from latma.state import StateStore
+from latma.utils import Credentials
+
+DOMAIN = 'corp.local'
+COMPUTERS = [
+    ('CN=WS01,OU=Sales_EU,DC=corp,DC=local', 'WS01', 'ws01.corp.local', 'Windows 10 Enterprise'),
+    ('CN=WS02,OU=SalesXEU,DC=corp,DC=local', 'WS02', 'ws02.corp.local', 'Windows 10 Enterprise'),
+    ('CN=WS03,OU=100%,DC=corp,DC=local', 'WS03', 'ws03.corp.local', 'Windows 11 Pro'),
+    ('CN=WS04,OU=1000,DC=corp,DC=local', 'WS04', 'ws04.corp.local', 'Windows Server 2019'),
+]
+
+
+class FakeLdap:
+    """
+    Stand-in for latma.utils.Ldap, serving COMPUTERS from one reachable domain controller.
+    """
+    reachable = 'dc02.corp.local'
+    hosts = []
+
+    def __init__(self, domain, username, password, use_ldap, ldap_domain, host=None):
+        FakeLdap.hosts.append(host)
+        if host is not None and host != self.reachable:
+            raise ConnectionError(f"Unable to connect LDAP due to: {host} is down")
+        if host is None and self.reachable is None:
+            raise ConnectionError(f"Unable to connect LDAP due to: {domain} is down")
+
+    def get_root_dse_attribute(self, attribute):
+        return {'dnsHostName': self.reachable, 'highestCommittedUSN': '100'}[attribute]
+
+    def get_workstations(self, search_filter, base_filter=None, attributes=None, controls=None):
+        if controls:
+            return
+        for index, (dn, name, dns_host_name, operating_system) in enumerate(COMPUTERS):
+            yield {'dn': dn, 'attributes': {'objectGUID': f'guid-{index}', 'name': name, 'dNSHostName': dns_host_name,
+                                            'operatingSystem': operating_system, 'userAccountControl': 4096,
+                                            'primaryGroupID': 515, 'uSNChanged': 10 + index}}
+
+
+@pytest.fixture
+def inventory(tmp_path, monkeypatch):
+    monkeypatch.setattr(inventory_module, 'Ldap', FakeLdap)
+    monkeypatch.setattr(FakeLdap, 'hosts', [])
+    with StateStore(str(tmp_path / 'collector_state.db')) as state_store:
+        computer_inventory = ComputerInventory(state_store, DOMAIN)
+        computer_inventory.sync(Credentials('user', 'password', DOMAIN), use_ldap=False)
+        yield computer_inventory
+
+
+@pytest.mark.parametrize('search_bases, names', [
+    ('OU=Sales_EU,DC=corp,DC=local', ['WS01']),
+    ('OU=100%,DC=corp,DC=local', ['WS03']),
+    ('OU=Sales_EU,DC=corp,DC=local;OU=1000,DC=corp,DC=local', ['WS01', 'WS04']),
+    ('DC=corp,DC=local', ['WS01', 'WS02', 'WS03', 'WS04']),
+])
+def test_search_bases_match_literally(inventory, search_bases, names):
+    assert sorted(entry['attributes']['name'] for entry in inventory.workstations(search_bases=search_bases)) == names
+
+
+def test_operating_system_matches_literally(inventory):
+    assert [entry['attributes']['name'] for entry in inventory.workstations(operating_system='Windows 1_')] == []
+    assert len(inventory.workstations(operating_system='windows 10')) == 2
+
+
+def test_sync_falls_back_to_a_full_sync_when_the_previous_server_is_unreachable(inventory):
+    inventory.conn.execute("UPDATE inventory_sync SET server='dc01.corp.local'")
+    inventory.sync(Credentials('user', 'password', DOMAIN), use_ldap=False)
+    assert FakeLdap.hosts == [None, 'dc01.corp.local', None]
+    assert inventory.size() == len(COMPUTERS)
+
+
+def test_sync_raises_when_no_server_is_reachable(inventory, monkeypatch):
+    monkeypatch.setattr(FakeLdap, 'reachable', None)
+    with pytest.raises(ConnectionError):
+        inventory.sync(Credentials('user', 'password', DOMAIN), use_ldap=False, full=True)
@@ -0,0 +1,41 @@
+from latma.metrics import Metrics
+
+
+def test_disabled_metrics_record_nothing():
+    run_metrics = Metrics()
+    run_metrics.increment('events_read_total', 10)
+    with run_metrics.timer('parse_batch_seconds'):
+        pass
+    report = run_metrics.report()
+    assert not report['counters'] and not report['summaries']
+
+
+def test_metrics_without_details_record_counters_and_gauges_only():
+    run_metrics = Metrics(enabled=True, detailed=False)
+    run_metrics.increment('events_read_total', 10, log='Security')
+    run_metrics.increment('events_read_total', 5, log='Security')
+    run_metrics.set_gauge('pending_hosts', 3)
+    with run_metrics.timer('parse_batch_seconds'):
+        pass
+    run_metrics.observe('host_fetch_seconds', 1.5)
+    run_metrics.record_host('Security', 'ws01', events=10)
+    run_metrics.sample('pending_hosts', 3)
+    report = run_metrics.report()
+    assert run_metrics.total('events_read_total') == 15
+    assert report['gauges'] == {'pending_hosts': {'': 3}}
+    assert not report['summaries'] and not report['hosts'] and not report['samples']
+
+
+def test_detailed_metrics():
+    run_metrics = Metrics(enabled=True)
+    with run_metrics.timer('parse_batch_seconds', log='Security'):
+        pass
+    run_metrics.observe('parse_batch_seconds', 2, log='Security')
+    run_metrics.record_host('Security', 'ws01', events=10)
+    run_metrics.record_host('Security', 'ws01', events=5)
+    run_metrics.sample('pending_hosts', 3)
+    report = run_metrics.report()
+    assert report['summaries']['parse_batch_seconds']['log=Security']['count'] == 2
+    assert report['summaries']['parse_batch_seconds']['log=Security']['max'] == 2
+    assert report['hosts'] == [{'log': 'Security', 'host': 'ws01', 'events': 15}]
+    assert [value for _, value in report['samples']['pending_hosts']] == [3]
@@ -0,0 +1,71 @@
+import csv
+
+from latma.dedup import DedupIndex
+from latma.pipeline import ParsePipeline, parse_batch
+from latma.sinks import COUNT_COLUMN, OUTPUT_HEADER, AggregatingSink, CsvSink
+
+DOMAIN = 'corp.local'
+LOG = 'Microsoft-Windows-NTLM/Operational'
+NTLM_EVENT = (
+    '<Event xmlns="http://schemas.microsoft.com/win/2004/08/events/event"><System><EventID>8004</EventID>'
+    '<TimeCreated SystemTime="2022-05-01T10:{minute:02}:00.0000000Z"/><EventRecordID>{record_id}</EventRecordID>'
+    '<Channel>{log}</Channel><Computer>{computer}</Computer></System><EventData>'
+    '<Data Name="SChannelName">DC01</Data><Data Name="UserName">alice</Data><Data Name="DomainName">CORP</Data>'
+    '<Data Name="WorkstationName">WS01</Data><Data Name="SChannelType">2</Data></EventData></Event>'
+)
+
+
+def _events(computer, minutes, first_record_id):
+    return [NTLM_EVENT.format(minute=minute, record_id=record_id, log=LOG, computer=computer)
+            for record_id, minute in enumerate(minutes, first_record_id)]
+
+
+def _aggregating_sink(tmp_path):
+    return AggregatingSink(CsvSink(str(tmp_path / 'logs_aggregated.csv'), OUTPUT_HEADER + [COUNT_COLUMN]))
+
+
+def _written(sink):
+    with open(sink.path, newline='') as output_file:
+        return sorted((row[4], int(row[6])) for row in list(csv.reader(output_file))[1:])
+
+
+def test_checkpoint_writes_the_buckets_older_than_the_newest_complete_minute(tmp_path):
+    sink = _aggregating_sink(tmp_path)
+    rows = [['alice', 'ws01', 'dc01', '-', f'01/05/2022 10:{minute:02}', 'NTLM'] for minute in (9, 10, 10, 11, 59)]
+    # 09:59 sorts after 10:09 as text, and before it in time
+    rows.append(['alice', 'ws01', 'dc01', '-', '01/05/2022 09:59', 'NTLM'])
+    sink.writerows(rows)
+    assert sink.checkpoint() == {'01/05/2022 10:11', '01/05/2022 10:59'}
+    assert _written(sink) == [('01/05/2022 09:59', 1), ('01/05/2022 10:09', 1), ('01/05/2022 10:10', 2)]
+    assert sink.checkpoint() == {'01/05/2022 10:11', '01/05/2022 10:59'}
+    sink.close()
+    assert _written(sink)[-2:] == [('01/05/2022 10:11', 1), ('01/05/2022 10:59', 1)]
+
+
+def test_watermarks_move_past_closed_buckets_only(tmp_path):
+    checkpoints = []
+    sink = _aggregating_sink(tmp_path)
+    with DedupIndex(str(tmp_path / 'collector_dedup')) as dedup_index:
+        pipeline = ParsePipeline(DOMAIN, sink, processes=0, on_checkpoint=lambda marks: checkpoints.append(dict(marks)),
+                                 dedup_index=dedup_index)
+        batches = [(('dc01', LOG), _events('DC01.corp.local', [0, 1, 2, 3], 1)),
+                   (('dc02', LOG), _events('DC02.corp.local', [1, 2], 1)),
+                   (('dc01', LOG), _events('DC01.corp.local', [3, 4, 5, 6], 5)),
+                   (('dc01', LOG), _events('DC01.corp.local', [1], 9))]
+        for tag, batch in batches:
+            pipeline._write(lambda: parse_batch(batch, DOMAIN), tag, len(batch))
+        pipeline._checkpoint()
+        # 10:05 and 10:06 are held back, the second batch of dc01 isn't written yet and neither is the third
+        assert checkpoints == [{('dc01', LOG): (4, '2022-05-01T10:03:00.0000000Z'),
+                                ('dc02', LOG): (2, '2022-05-01T10:02:00.0000000Z')}]
+        assert dedup_index.conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0] == 9
+        assert len(dedup_index.pending) == 2
+        # events of rows held back are still dropped when they repeat
+        pipeline._write(lambda: parse_batch(batches[2][1], DOMAIN), None, len(batches[2][1]))
+        assert dedup_index.duplicates == 4
+        pipeline._checkpoint(final=True)
+        assert checkpoints[1] == {('dc01', LOG): (9, '2022-05-01T10:01:00.0000000Z')}
+        assert dedup_index.conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0] == 11
+        assert not dedup_index.pending
+    sink.close()
+    assert sum(count for _, count in _written(sink)) == 11
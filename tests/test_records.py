@@ -0,0 +1,83 @@
+import csv
+import os
+
+import pandas as pd
+import pytest
+
+from latma.records import NO_TIMESTAMP, RecordStore, RecordWriter, export_csv, import_csv
+from latma.sinks import COUNT_COLUMN, OUTPUT_HEADER
+
+AGGREGATED_HEADER = OUTPUT_HEADER + [COUNT_COLUMN]
+ROWS = [['alice', 'ws01', 'dc01', '-', '01/05/2022 10:11', 'NTLM', '2'],
+        ['bob', 'ws02', 'dc01', 'cifs/fs01', '01/05/2022 10:12', 'Kerberos', '1'],
+        ['alice', 'ws01', 'fs01', '-', '', 'NTLM', '5']]
+
+
+def _write(path, rows, header=AGGREGATED_HEADER):
+    writer = RecordWriter(str(path), header)
+    writer.writerows(rows)
+    writer.close()
+
+
+def _rows(path):
+    return list(RecordStore(str(path)).iter_rows())
+
+
+def test_csv_round_trip(tmp_path):
+    csv_path = str(tmp_path / 'logs_aggregated.csv')
+    with open(csv_path, 'w', newline='', encoding='utf-8') as csv_file:
+        csv.writer(csv_file).writerows([AGGREGATED_HEADER] + ROWS)
+    store_path = str(tmp_path / 'logs_aggregated.records')
+    assert import_csv(csv_path, store_path) == len(ROWS)
+    store = RecordStore(store_path)
+    assert store.header == AGGREGATED_HEADER
+    assert store.column(COUNT_COLUMN).tolist() == [2, 1, 5]
+    assert store.column('timestamp')[2] == NO_TIMESTAMP
+    assert store.values('username') == ['alice', 'bob']
+    exported_path = str(tmp_path / 'exported.csv')
+    assert export_csv(store_path, exported_path) == len(ROWS)
+    with open(exported_path, newline='', encoding='utf-8') as csv_file:
+        assert list(csv.reader(csv_file)) == [AGGREGATED_HEADER] + [[str(value) for value in row] for row in ROWS]
+
+
+def test_appending_after_reopening(tmp_path):
+    _write(tmp_path, ROWS[:2])
+    _write(tmp_path, [ROWS[2], ['carol', 'ws03', 'dc02', '-', '01/05/2022 10:13', 'NTLM', '1']])
+    store = RecordStore(str(tmp_path))
+    assert len(store) == 4
+    assert store.values('username') == ['alice', 'bob', 'carol']
+    assert [row[0] for row in store.iter_rows()] == ['alice', 'bob', 'alice', 'carol']
+    with pytest.raises(ValueError):
+        RecordWriter(str(tmp_path), OUTPUT_HEADER)
+
+
+def test_reopening_truncates_the_bytes_of_an_interrupted_flush(tmp_path):
+    _write(tmp_path, ROWS[:2])
+    # column bytes of rows whose meta.json was never written
+    with open(tmp_path / '0.bin', 'ab') as column_file:
+        column_file.write(b'\x01\x00\x00\x00\x01')
+    _write(tmp_path, ROWS[2:])
+    assert os.path.getsize(tmp_path / '0.bin') == 3 * 4
+    assert _rows(tmp_path) == [[str(value) for value in row[:-1]] + [int(row[-1])] for row in ROWS]
+
+
+def test_iso_timestamps_are_kept_in_their_format(tmp_path):
+    header = ['Username', 'timestamp', 'destination', 'source host', 'auth type']
+    rows = [['alice@corp.local', '', 'Office 365', 'ws01', 'Cloud'],
+            ['alice@corp.local', '2022-05-01T10:11:12Z', 'Office 365', 'ws01', 'Cloud']]
+    _write(tmp_path, rows, header)
+    store = RecordStore(str(tmp_path))
+    assert store.timestamp_format == '%Y-%m-%dT%H:%M:%SZ'
+    assert _rows(tmp_path) == rows
+
+
+def test_to_frame_keeps_strings_categorical(tmp_path):
+    _write(tmp_path, ROWS)
+    frame = RecordStore(str(tmp_path)).to_frame(['username', 'timestamp', COUNT_COLUMN])
+    assert list(frame.columns) == ['username', 'timestamp', COUNT_COLUMN]
+    assert isinstance(frame['username'].dtype, pd.CategoricalDtype)
+    assert list(frame['username'].cat.categories) == ['alice', 'bob']
+    assert frame['username'].tolist() == ['alice', 'bob', 'alice']
+    assert frame['timestamp'].tolist()[:2] == [pd.Timestamp('2022-05-01 10:11'), pd.Timestamp('2022-05-01 10:12')]
+    assert pd.isna(frame['timestamp'][2])
+    assert frame[COUNT_COLUMN].tolist() == [2, 1, 5]
@@ -0,0 +1,79 @@
+import pytest
+
+from latma import sources
+from latma.bench.fake_win32evtlog import FakeEventLog, installed
+from latma.bench.generators import NTLM_CHANNEL, SyntheticEnvironment
+from latma.event_parser import get_record_id
+from latma.sources import EVENT_BULK_MAX, EVENT_BULK_MIN, EVENT_BULK_START, EventQuery, RpcEventSource
+from latma.utils import Credentials, evtx_query_builder
+
+HOST = 'WS00000'
+
+
+class PagedEventLog(FakeEventLog):
+    """
+    FakeEventLog recording the page size of every EvtNext call.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.page_sizes = []
+
+    def EvtNext(self, ResultSet, Count, Timeout=-1, Flags=0):
+        self.page_sizes.append(Count)
+        return super().EvtNext(ResultSet, Count, Timeout, Flags)
+
+
+@pytest.fixture
+def environment():
+    return SyntheticEnvironment(hosts=1, accounts=10, domain_controllers=1)
+
+
+def _query(min_record_id=0):
+    xml = evtx_query_builder('8004', NTLM_CHANNEL, None, min_record_id=min_record_id)
+    return EventQuery(NTLM_CHANNEL, '8004', xml, None, min_record_id)
+
+
+def _read(event_log, min_record_id=0, **kwargs):
+    host = event_log.environment.fqdn(HOST)
+    with installed(event_log):
+        source = RpcEventSource(Credentials('user', 'password', event_log.environment.domain), **kwargs)
+        source.endpoints[host] = True
+        batches = list(source.read(host, _query(min_record_id)))
+    assert all(len(batch) <= page_size for batch, page_size in zip(batches, event_log.page_sizes))
+    return [get_record_id(event) for batch in batches for event in batch]
+
+
+def test_pages_grow_while_they_return_quickly(environment):
+    event_log = PagedEventLog(environment, events_per_host=3000)
+    assert _read(event_log) == list(range(1, 3001))
+    assert event_log.page_sizes[:4] == [EVENT_BULK_START, EVENT_BULK_START * 2, EVENT_BULK_MAX, EVENT_BULK_MAX]
+    assert max(event_log.page_sizes) == EVENT_BULK_MAX
+
+
+def test_pages_shrink_once_they_are_slower_than_the_target_latency(environment, monkeypatch):
+    monkeypatch.setattr(sources, 'TARGET_PAGE_LATENCY', 0.05)
+    # a page of 128 events takes 64ms, a page of 64 events 32ms
+    event_log = PagedEventLog(environment, events_per_host=600, event_latency=0.0005)
+    assert _read(event_log) == list(range(1, 601))
+    assert event_log.page_sizes[:4] == [EVENT_BULK_START, EVENT_BULK_START // 2, EVENT_BULK_MIN, EVENT_BULK_MIN]
+
+
+def test_a_page_timing_out_on_the_time_budget_stops_the_host_at_its_last_page(environment):
+    # two pages fit the budget, the third one times out after the remaining 50ms
+    event_log = PagedEventLog(environment, events_per_host=5000, page_latency=0.1)
+    record_ids = _read(event_log, time_budget=0.25)
+    assert len(event_log.page_sizes) == 3
+    # the pages of 256 and 512 events
+    assert record_ids == list(range(1, 3 * EVENT_BULK_START + 1))
+    resumed_log = PagedEventLog(environment, events_per_host=5000)
+    assert _read(resumed_log, min_record_id=record_ids[-1]) == list(range(record_ids[-1] + 1, 5001))
+
+
+def test_the_event_budget_stops_the_host_at_the_budget(environment):
+    event_log = PagedEventLog(environment, events_per_host=1000)
+    record_ids = _read(event_log, event_budget=600)
+    assert event_log.page_sizes == [EVENT_BULK_START, 600 - EVENT_BULK_START]
+    assert record_ids == list(range(1, 601))
+    resumed_log = PagedEventLog(environment, events_per_host=1000)
+    assert _read(resumed_log, min_record_id=600, event_budget=600) == list(range(601, 1001))
@@ -0,0 +1,131 @@
+from collections import defaultdict
+from threading import Lock
+from time import monotonic, sleep
+
+from latma import scheduler as scheduler_module
+from latma.eventlogcollector import KerberosCollector, NTLMCollector
+from latma.scheduler import CollectionScheduler
+from latma.state import StateStore
+from latma.sinks import open_sink
+from latma.sources import EventSource
+from latma.utils import Credentials
+
+DOMAIN = 'corp.local'
+NTLM_LOG = 'Microsoft-Windows-NTLM/Operational'
+NTLM_EVENT = (
+    '<Event xmlns="http://schemas.microsoft.com/win/2004/08/events/event"><System><EventID>8004</EventID>'
+    '<TimeCreated SystemTime="2022-05-01T10:00:00.0000000Z"/><EventRecordID>{record_id}</EventRecordID>'
+    '<Channel>Microsoft-Windows-NTLM/Operational</Channel><Computer>{computer}</Computer></System><EventData>'
+    '<Data Name="SChannelName">DC01</Data><Data Name="UserName">alice</Data><Data Name="DomainName">CORP</Data>'
+    '<Data Name="WorkstationName">WS01</Data><Data Name="SChannelType">2</Data></EventData></Event>'
+)
+
+
+class StubEventSource(EventSource):
+    """
+    Serves NTLM events of every target in batches of one event, recording the reads and the concurrent sessions of
+    every target.
+    """
+
+    def __init__(self, targets, batches=None, batch_seconds=0.0):
+        """
+        :param targets: target names
+        :param batches: dict of target name to its amount of events, default is 1
+        :param batch_seconds: seconds reading a batch takes
+        """
+        self.targets = targets
+        self.batches = batches or {}
+        self.batch_seconds = batch_seconds
+        self.lock = Lock()
+        self.reads = []
+        self.sessions = defaultdict(int)
+        self.max_sessions = defaultdict(int)
+
+    def list_targets(self):
+        return list(self.targets)
+
+    def read(self, target_name, query):
+        with self.lock:
+            self.reads.append((target_name, query.log, query.min_record_id))
+            self.sessions[target_name] += 1
+            self.max_sessions[target_name] = max(self.max_sessions[target_name], self.sessions[target_name])
+        try:
+            self.on_read(target_name)
+            for record_id in range(query.min_record_id + 1, self.batches.get(target_name, 1) + 1):
+                sleep(self.batch_seconds)
+                yield [NTLM_EVENT.format(record_id=record_id, computer=target_name)] if query.log == NTLM_LOG else []
+        finally:
+            with self.lock:
+                self.sessions[target_name] -= 1
+
+    def on_read(self, target_name):
+        pass
+
+
+def _collectors(source, kerberos=True):
+    credentials = Credentials('user', 'password', DOMAIN)
+    collectors = [NTLMCollector(credentials, None, None, threads=4, use_ldap=False, source=source)]
+    if kerberos:
+        collectors.append(KerberosCollector(credentials, None, None, threads=4, use_ldap=False, source=source))
+    return collectors
+
+
+def test_collectors_sharing_a_host_hold_one_session_to_it(tmp_path):
+    source = StubEventSource(['dc01.corp.local', 'ws01.corp.local', 'ws02.corp.local', 'ws03.corp.local'])
+    collectors = _collectors(source)
+    with open_sink(path=str(tmp_path / 'logs.csv')) as output_sink:
+        scheduler = CollectionScheduler(collectors, 4, output_sink, parsers=0, target_sessions=1)
+        deferred = []
+
+        def wait_for_the_deferred_job(target_name):
+            # the first session to the shared host stays open until the other collector's job was deferred
+            if target_name == 'dc01.corp.local' and not deferred:
+                deadline = monotonic() + 5
+                while target_name not in scheduler.deferred and monotonic() < deadline:
+                    sleep(0.01)
+                deferred.append(target_name in scheduler.deferred)
+
+        source.on_read = wait_for_the_deferred_job
+        scheduler.run()
+    assert deferred == [True]
+    assert sorted((target, log) for target, log, _ in source.reads) == sorted(
+        (target, log) for target in source.targets for log in (NTLM_LOG, 'Security'))
+    assert max(source.max_sessions.values()) == 1
+    assert scheduler.outstanding == 0 and not scheduler.active_sessions and not scheduler.deferred
+    with open(tmp_path / 'logs.csv') as output_file:
+        assert len(output_file.readlines()) == 1 + len(source.targets)
+
+
+def test_hosts_are_queued_longest_first_by_their_history(tmp_path):
+    source = StubEventSource(['ws01.corp.local', 'ws02.corp.local', 'ws03.corp.local', 'ws04.corp.local'])
+    collector = _collectors(source, kerberos=False)[0]
+    with StateStore(str(tmp_path / 'collector_state.db')) as state_store:
+        state_store.set_host_history(NTLM_LOG, {'ws01.corp.local': (10, 5.0), 'ws02.corp.local': (100, 50.0),
+                                                'ws04.corp.local': (40, 20.0)})
+        scheduler = CollectionScheduler([collector], 1, None, parsers=0)
+        scheduler.history[NTLM_LOG] = state_store.get_host_history(NTLM_LOG)
+    scheduler._produce(collector)
+    # ws03 was never collected and is expected to take the average 25s
+    assert [scheduler.queue.get()[2].target for _ in range(scheduler.queue.qsize())] == [
+        'ws02.corp.local', 'ws03.corp.local', 'ws04.corp.local', 'ws01.corp.local']
+    assert scheduler.outstanding == 4
+
+
+def test_a_straggler_resumes_after_the_other_hosts_from_its_last_record(tmp_path, monkeypatch):
+    monkeypatch.setattr(scheduler_module, 'STRAGGLER_MIN_DURATION', 0)
+    source = StubEventSource(['ws01.corp.local', 'ws02.corp.local', 'ws03.corp.local'],
+                             batches={'ws01.corp.local': 10}, batch_seconds=0.02)
+    collectors = _collectors(source, kerberos=False)
+    with StateStore(str(tmp_path / 'collector_state.db')) as state_store:
+        # ws01 took 10ms before, it becomes a straggler after 30ms
+        state_store.set_host_history(NTLM_LOG, {'ws01.corp.local': (1, 0.01)})
+        with open_sink(path=str(tmp_path / 'logs.csv')) as output_sink:
+            CollectionScheduler(collectors, 1, output_sink, parsers=0, history_store=state_store).run()
+        history = state_store.get_host_history(NTLM_LOG)
+    first_reads, resumed_read = source.reads[:-1], source.reads[-1]
+    assert sorted(target for target, _, _ in first_reads) == source.targets
+    assert resumed_read[0] == 'ws01.corp.local' and 0 < resumed_read[2] < 10
+    with open(tmp_path / 'logs.csv') as output_file:
+        assert len(output_file.readlines()) == 1 + 10 + 2
+    # the history of the straggler covers both of its reads
+    assert history['ws01.corp.local'][0] == 10
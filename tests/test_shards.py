@@ -0,0 +1,149 @@
+import csv
+import gzip
+import os
+import sqlite3
+import subprocess
+import sys
+
+import latma
+from latma import shards
+from latma.shards import HostShard, merge_outputs, read_output
+from latma.sinks import COUNT_COLUMN, OUTPUT_HEADER
+from latma.state import StateStore
+
+LOG = 'Security'
+HOSTS = [f'ws{index:03}.corp.local' for index in range(200)]
+NTLM_EVENT = (
+    '<Event xmlns="http://schemas.microsoft.com/win/2004/08/events/event"><System><EventID>8004</EventID>'
+    '<TimeCreated SystemTime="2022-05-01T{hour:02}:{minute:02}:00.0000000Z"/><EventRecordID>{record_id}</EventRecordID>'
+    '<Channel>Microsoft-Windows-NTLM/Operational</Channel><Computer>DC{dc}.corp.local</Computer></System><EventData>'
+    '<Data Name="SChannelName">DC{dc}</Data><Data Name="UserName">user{dc}</Data><Data Name="DomainName">CORP</Data>'
+    '<Data Name="WorkstationName">WS{minute:02}</Data><Data Name="SChannelType">2</Data></EventData></Event>'
+)
+
+
+def _row(minute, username='alice', hour=10):
+    return [username, 'ws01', 'dc01', '-', f'01/05/2022 {hour:02}:{minute:02}', 'NTLM']
+
+
+def _write_csv(path, header, rows):
+    output_file = gzip.open(path, 'wt', newline='', encoding='utf-8') if path.endswith('.gz') else \
+        open(path, 'w', newline='', encoding='utf-8')
+    with output_file:
+        csv.writer(output_file).writerows([header] + rows)
+    return path
+
+
+def _merged(path):
+    header, rows = read_output(path)
+    return header, list(rows)
+
+
+def test_state_path_is_kept_when_the_amount_of_shards_changes():
+    assert HostShard(1, 4).state_path('collector_state.db') == 'collector_state_shard1.db'
+    assert HostShard(1, 5).state_path('collector_state.db') == HostShard(1, 4).state_path('collector_state.db')
+    assert HostShard(1, 4).path('logs.csv') == 'logs_shard1of4.csv'
+
+
+def test_sibling_state_paths(tmp_path):
+    state = str(tmp_path / 'collector_state.db')
+    for name in ('collector_state_shard0.db', 'collector_state_shard1.db', 'collector_state_shard2of3.db',
+                 'collector_state_shard0.db-wal', 'collector_dedup_shard0.db'):
+        (tmp_path / name).touch()
+    assert HostShard(1, 5).sibling_state_paths(state) == [
+        str(tmp_path / 'collector_state_shard0.db'), str(tmp_path / 'collector_state_shard2of3.db')]
+
+
+def test_resharding_keeps_the_watermarks_of_moved_hosts(tmp_path):
+    state = str(tmp_path / 'collector_state.db')
+    for index in range(4):
+        shard = HostShard(index, 4)
+        with StateStore(shard.state_path(state)) as store:
+            store.set_watermarks({(host, LOG): (100, '2022-05-01T00:00:00Z') for host in HOSTS if shard.owns(host)})
+    new_shard = HostShard(4, 5)
+    moved = [host for host in HOSTS if new_shard.owns(host)]
+    assert moved
+    with StateStore(new_shard.state_path(state)) as store:
+        adopted = sum(store.adopt(path, new_shard.owns) for path in new_shard.sibling_state_paths(state))
+        assert adopted == len(moved)
+        assert all(store.get_watermark(host, LOG) == (100, '2022-05-01T00:00:00Z') for host in moved)
+        assert all(store.get_watermark(host, LOG) is None for host in HOSTS if not new_shard.owns(host))
+        # a watermark never moves backwards
+        store.set_watermarks({(moved[0], LOG): (200, '2022-05-02T00:00:00Z')})
+        assert store.adopt(new_shard.sibling_state_paths(state)[0], new_shard.owns) == 0
+        assert store.get_watermark(moved[0], LOG) == (200, '2022-05-02T00:00:00Z')
+
+
+def test_adopting_skips_the_tables_a_starting_shard_has_not_created_yet(tmp_path):
+    state = str(tmp_path / 'collector_state.db')
+    sibling = sqlite3.connect(HostShard(0, 2).state_path(state))
+    sibling.execute("CREATE TABLE watermarks (host TEXT, log TEXT, record_id INTEGER, system_time TEXT)")
+    sibling.executemany("INSERT INTO watermarks VALUES (?, ?, 100, NULL)", [(host, LOG) for host in HOSTS])
+    sibling.commit()
+    sibling.close()
+    shard = HostShard(1, 2)
+    with StateStore(shard.state_path(state)) as store:
+        assert store.adopt(shard.sibling_state_paths(state)[0], shard.owns) == len(
+            [host for host in HOSTS if shard.owns(host)])
+
+
+def test_merge_sorts_by_time_and_writes_rows_of_several_inputs_once(tmp_path, monkeypatch):
+    written_runs = []
+    write_run = shards._write_run
+    monkeypatch.setattr(shards, '_write_run', lambda rows, temp_dir: written_runs.append(1) or
+                        write_run(rows, temp_dir))
+    # 09:59 sorts after 10:09 as text, and before it in time
+    first = _write_csv(str(tmp_path / 'logs_shard0of2.csv'), OUTPUT_HEADER,
+                       [_row(9), _row(30), _row(30), _row(5, 'bob'), _row(59, hour=9), _row(45)])
+    second = _write_csv(str(tmp_path / 'logs_shard1of2.csv.gz'), OUTPUT_HEADER,
+                        [_row(30), _row(5, 'bob'), _row(20, 'carol'), _row(0, hour=11)])
+    output = str(tmp_path / 'logs_merged.csv')
+    assert merge_outputs([first, second], output, run_size=2, fan_in=2, temp_dir=str(tmp_path)) == 8
+    # 5 sorted runs, merged 2 at a time twice before the last pass
+    assert len(written_runs) == 5 + 3
+    assert _merged(output) == (OUTPUT_HEADER, [
+        _row(59, hour=9), _row(5, 'bob'), _row(9), _row(20, 'carol'), _row(30), _row(30), _row(45), _row(0, hour=11)])
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('latma-merge-')]
+
+
+def test_merge_takes_the_largest_count_of_aggregated_inputs(tmp_path):
+    header = OUTPUT_HEADER + [COUNT_COLUMN]
+    first = _write_csv(str(tmp_path / 'logs_aggregated_shard0of2.csv.gz'), header,
+                       [_row(10) + ['2'], _row(11) + ['1'], _row(10) + ['1']])
+    second = _write_csv(str(tmp_path / 'logs_aggregated_shard1of2.csv'), header,
+                        [_row(10) + ['2'], _row(11) + ['4'], _row(12) + ['1']])
+    output = str(tmp_path / 'logs_merged.csv.gz')
+    assert merge_outputs([first, second], output, output_format='csv.gz', run_size=1, fan_in=2) == 3
+    assert _merged(output) == (header, [_row(10) + ['3'], _row(11) + ['4'], _row(12) + ['1']])
+
+
+def test_shard_workers_collect_every_file_once(tmp_path):
+    logs = tmp_path / 'evtx'
+    logs.mkdir()
+    record_id = 1
+    for dc in range(8):
+        events = []
+        for minute in range(dc, 60, 7):
+            events.append(NTLM_EVENT.format(hour=10, minute=minute, record_id=record_id, dc=dc))
+            record_id += 1
+        (logs / f'dc{dc}.xml').write_text(''.join(events))
+    owners = {HostShard(0, 2).owns(str(path)) for path in logs.iterdir()}
+    assert owners == {True, False}
+    environment = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(latma.__file__)))
+    workers = [subprocess.Popen([sys.executable, '-m', 'latma.eventlogcollector', 'corp.local/user:password', '-ntlm',
+                                 '-evtx', str(logs), '-shards', '2', '-shard', str(shard), '-parsers', '0',
+                                 '-no_dns', '-progress_interval', '0'],
+                                cwd=tmp_path, env=environment, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+               for shard in range(2)]
+    for worker in workers:
+        worker.communicate(b'y\n', timeout=120)
+        assert worker.returncode == 0
+    outputs = [str(tmp_path / f'logs_shard{shard}of2.csv') for shard in range(2)]
+    assert all(os.path.exists(tmp_path / f'collector_state_shard{shard}.db') for shard in range(2))
+    shard_rows = [len(list(read_output(path)[1])) for path in outputs]
+    assert all(shard_rows) and sum(shard_rows) == record_id - 1
+    output = str(tmp_path / 'logs_merged.csv')
+    # rows found in several outputs, e.g. collected again after the shards changed, are written once
+    assert merge_outputs(outputs + [outputs[0]], output) == record_id - 1
+    _, rows = _merged(output)
+    assert [row[4] for row in rows] == sorted(row[4] for row in rows)
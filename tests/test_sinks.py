@@ -0,0 +1,79 @@
+import csv
+import gzip
+from collections import Counter
+
+import pytest
+
+from latma.sinks import COUNT_COLUMN, OUTPUT_HEADER, AggregatingSink, CsvSink, GzipCsvSink, ParquetSink, open_sink
+
+ROWS = [['alice', 'ws01', 'dc01', '-', f'01/05/2022 10:{minute:02}', 'NTLM'] for minute in range(10)]
+
+
+def _read_csv(csv_file):
+    return list(csv.reader(csv_file))
+
+
+def test_csv_header_is_written_on_a_new_file_only(tmp_path):
+    path = str(tmp_path / 'logs.csv')
+    for rows in (ROWS[:4], ROWS[4:]):
+        with CsvSink(path) as sink:
+            sink.writerows(rows)
+    with open(path, newline='', encoding='utf-8') as csv_file:
+        assert _read_csv(csv_file) == [OUTPUT_HEADER] + ROWS
+
+
+def test_gzip_appends_are_read_as_one_csv(tmp_path):
+    path = str(tmp_path / 'logs.csv.gz')
+    for rows in (ROWS[:4], ROWS[4:7], ROWS[7:]):
+        with GzipCsvSink(path) as sink:
+            sink.writerows(rows)
+    with open(path, 'rb') as gzip_file:
+        # every session appended its own gzip member
+        assert gzip_file.read().count(b'\x1f\x8b\x08') == 3
+    with gzip.open(path, 'rt', newline='', encoding='utf-8') as csv_file:
+        assert _read_csv(csv_file) == [OUTPUT_HEADER] + ROWS
+
+
+def test_parquet_files_rotate_at_the_maximal_file_size(tmp_path):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    path = str(tmp_path / 'logs.parquet')
+    # every row group fills a file
+    with ParquetSink(path, row_group_size=4, max_file_size=1) as sink:
+        sink.writerows(ROWS[:6])
+        sink.writerows(ROWS[6:])
+    with ParquetSink(path, max_file_size=1) as sink:
+        sink.writerows(ROWS[:1])
+    paths = sorted(tmp_path.glob('logs.*.parquet'))
+    assert [path.name for path in paths] == [f'logs.{index:05d}.parquet' for index in range(4)]
+    tables = [parquet.read_table(str(path)) for path in paths]
+    assert [table.num_rows for table in tables] == [4, 4, 2, 1]
+    assert [list(row.values()) for table in tables[:3] for row in table.to_pylist()] == ROWS
+    # files below the maximal size keep their row groups
+    with ParquetSink(str(tmp_path / 'large.parquet'), row_group_size=4) as sink:
+        sink.writerows(ROWS)
+    assert parquet.ParquetFile(str(tmp_path / 'large.00000.parquet')).num_row_groups == 3
+
+
+def test_aggregated_counts_add_up_across_flushes(tmp_path):
+    path = str(tmp_path / 'logs_aggregated.csv')
+    rows = [ROWS[minute % 3] for minute in range(30)]
+    with AggregatingSink(CsvSink(path, OUTPUT_HEADER + [COUNT_COLUMN]), max_keys=2) as sink:
+        for start in range(0, len(rows), 7):
+            sink.writerows(rows[start:start + 7])
+            sink.flush()
+    with open(path, newline='', encoding='utf-8') as csv_file:
+        aggregated = _read_csv(csv_file)
+    assert aggregated[0] == OUTPUT_HEADER + [COUNT_COLUMN]
+    # rows repeat with partial counts, no row holds more than the rows written between two flushes
+    assert len(aggregated) - 1 > 3 and all(int(row[-1]) <= 7 for row in aggregated[1:])
+    counts = Counter()
+    for row in aggregated[1:]:
+        counts[tuple(row[:-1])] += int(row[-1])
+    assert counts == Counter(tuple(row) for row in rows)
+
+
+def test_aggregating_sinks_default_to_their_own_file(tmp_path):
+    with open_sink('csv.gz', base_name=str(tmp_path / 'logs'), aggregate=True) as sink:
+        assert isinstance(sink, AggregatingSink) and isinstance(sink.sink, GzipCsvSink)
+        assert sink.path == str(tmp_path / 'logs_aggregated.csv.gz')
+        assert sink.header == OUTPUT_HEADER
@@ -0,0 +1,130 @@
+from datetime import datetime
+
+import pytest
+
+from latma import sources
+from latma.event_parser import get_record_id
+from latma.sources import EventQuery, EvtxFileEventSource, read_evtx_chunks
+
+NTLM_LOG = 'Microsoft-Windows-NTLM/Operational'
+EVENT = (
+    '<Event xmlns="http://schemas.microsoft.com/win/2004/08/events/event"><System><EventID>{event_id}</EventID>'
+    '<TimeCreated SystemTime="2022-05-01T10:{minute:02}:00.0000000Z"/><EventRecordID>{record_id}</EventRecordID>'
+    '<Channel>Microsoft-Windows-NTLM/Operational</Channel><Computer>DC01.corp.local</Computer></System>'
+    '<EventData><Data Name="UserName">alice</Data></EventData></Event>'
+)
+RECORD_IDS = range(1, 51)
+
+
+def _events(record_ids=RECORD_IDS):
+    # every fifth event has another id
+    return [EVENT.format(event_id=8004 if record_id % 5 else 8001, minute=record_id, record_id=record_id)
+            for record_id in record_ids]
+
+
+def _query(min_record_id=0, start_date=None):
+    return EventQuery(NTLM_LOG, '8004', '*', start_date, min_record_id)
+
+
+def _read(path, query):
+    source = EvtxFileEventSource([str(path)])
+    assert source.list_targets() == [str(path)]
+    return [[get_record_id(event) for event in batch] for batch in source.read(str(path), query)]
+
+
+@pytest.fixture(autouse=True)
+def small_reads(monkeypatch):
+    # events span several reads and batches
+    monkeypatch.setattr(sources, 'XML_READ_SIZE', 1000)
+    monkeypatch.setattr(sources, 'EVENT_BULK_MAX', 16)
+
+
+@pytest.mark.parametrize('prefix, suffix', [
+    ('', ''),
+    ('<?xml version="1.0" encoding="UTF-8"?>\r\n', ''),
+    ('\ufeff<?xml version="1.0" encoding="UTF-8"?>\r\n<Events>', '</Events>'),
+    ('<Events>\r\n', '\r\n</Events>'),
+])
+def test_xml_exports_with_and_without_a_root_element(tmp_path, prefix, suffix):
+    path = tmp_path / 'dc01.xml'
+    path.write_text(prefix + '\r\n'.join(_events()) + suffix, encoding='utf-8')
+    batches = _read(path, _query())
+    assert [record_id for batch in batches for record_id in batch] == [
+        record_id for record_id in RECORD_IDS if record_id % 5]
+    assert len(batches) > 1 and all(len(batch) <= 16 for batch in batches)
+
+
+def test_xml_exports_are_filtered_by_record_id_and_start_date(tmp_path):
+    path = tmp_path / 'dc01.xml'
+    path.write_text(''.join(_events()), encoding='utf-8')
+    assert [record_id for batch in _read(path, _query(min_record_id=30)) for record_id in batch] == [
+        record_id for record_id in range(31, 51) if record_id % 5]
+    assert [record_id for batch in _read(path, _query(start_date=datetime(2022, 5, 1, 10, 42))) for record_id in
+            batch] == [42, 43, 44, 46, 47, 48, 49]
+
+
+def test_directories_list_their_exports(tmp_path):
+    (tmp_path / 'b.xml').touch()
+    (tmp_path / 'a.evtx').touch()
+    (tmp_path / 'notes.txt').touch()
+    assert EvtxFileEventSource([str(tmp_path)]).list_targets() == [str(tmp_path / 'a.evtx'), str(tmp_path / 'b.xml')]
+
+
+class FakeChunk:
+    def __init__(self, record_ids):
+        self.record_ids = record_ids
+
+    def check_magic(self):
+        return True
+
+    def log_last_record_number(self):
+        return self.record_ids[-1]
+
+    def records(self):
+        return [FakeRecord(record_id) for record_id in self.record_ids]
+
+
+class FakeRecord:
+    def __init__(self, record_id):
+        self.record_id = record_id
+
+    def record_num(self):
+        return self.record_id
+
+    def xml(self):
+        return _events([self.record_id])[0]
+
+
+class FakeEvtx:
+    """
+    Stand-in for python-evtx, an evtx file of 5 chunks of 10 records.
+    """
+    def __init__(self, path):
+        self.file_chunks = [FakeChunk(list(RECORD_IDS[start:start + 10])) for start in range(0, len(RECORD_IDS), 10)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def get_file_header(self):
+        return self
+
+    def chunk_count(self):
+        return len(self.file_chunks)
+
+    def chunks(self):
+        return iter(self.file_chunks)
+
+
+def test_evtx_chunks_before_the_record_id_are_skipped(monkeypatch):
+    monkeypatch.setattr(sources, 'Evtx', FakeEvtx)
+    events = read_evtx_chunks('dc01.evtx', 1, 4, _query(min_record_id=25))
+    assert [get_record_id(event) for event in events] == [26, 27, 28, 29, 31, 32, 33, 34, 36, 37, 38, 39]
+
+
+def test_evtx_files_require_python_evtx(monkeypatch):
+    monkeypatch.setattr(sources, 'Evtx', None)
+    with pytest.raises(RuntimeError, match='python-evtx'):
+        next(EvtxFileEventSource(['dc01.evtx']).read('dc01.evtx', _query()))
@@ -0,0 +1,83 @@
+from latma.dedup import DedupIndex
+from latma.eventlogcollector import KerberosCollector, NTLMCollector
+from latma.pipeline import ParsePipeline, parse_batch
+from latma.sinks import OUTPUT_HEADER, CsvSink
+from latma.sources import EvtxFileEventSource
+from latma.state import StateStore
+from latma.utils import Credentials
+
+DOMAIN = 'corp.local'
+HOST = 'dc01.corp.local'
+NTLM_LOG = 'Microsoft-Windows-NTLM/Operational'
+NTLM_EVENT = (
+    '<Event xmlns="http://schemas.microsoft.com/win/2004/08/events/event"><System><EventID>8004</EventID>'
+    '<TimeCreated SystemTime="2022-05-01T10:{minute:02}:00.0000000Z"/><EventRecordID>{record_id}</EventRecordID>'
+    '<Channel>Microsoft-Windows-NTLM/Operational</Channel><Computer>DC01.corp.local</Computer></System><EventData>'
+    '<Data Name="SChannelName">DC01</Data><Data Name="UserName">alice</Data><Data Name="DomainName">CORP</Data>'
+    '<Data Name="WorkstationName">WS01</Data><Data Name="SChannelType">2</Data></EventData></Event>'
+)
+
+
+def _events(record_ids):
+    return [NTLM_EVENT.format(minute=record_id, record_id=record_id) for record_id in record_ids]
+
+
+def _collector(collector_class, state_store):
+    return collector_class(Credentials('user', 'password', DOMAIN), None, None, threads=1, use_ldap=False,
+                           state_store=state_store, source=EvtxFileEventSource([]))
+
+
+def test_host_queries_resume_after_the_committed_watermark(tmp_path):
+    with StateStore(str(tmp_path / 'collector_state.db')) as state_store:
+        state_store.set_watermarks({(HOST, NTLM_LOG): (42, '2022-05-01T10:42:00.0000000Z'),
+                                    (HOST, 'Security'): (7, '2022-05-01T10:07:00.0000000Z')})
+        collector = _collector(NTLMCollector, state_store)
+        query = collector.build_host_query(HOST)
+        assert query.min_record_id == 42 and 'EventRecordID&gt;42' in query.xml
+        # a host read further during this run resumes after the events it already read
+        query = collector.build_host_query(HOST, min_record_id=50)
+        assert query.min_record_id == 50 and 'EventRecordID&gt;50' in query.xml
+        assert 'EventRecordID&gt;7' in _collector(KerberosCollector, state_store).build_host_query(HOST).xml
+        # hosts without a watermark are read from their first event
+        query = collector.build_host_query('ws01.corp.local')
+        assert query.min_record_id == 0 and 'EventRecordID' not in query.xml
+
+
+def test_watermarks_never_move_backwards(tmp_path):
+    with StateStore(str(tmp_path / 'collector_state.db')) as state_store:
+        state_store.set_watermarks({(HOST, NTLM_LOG): (42, '2022-05-01T10:42:00.0000000Z')})
+        state_store.set_watermarks({(HOST, NTLM_LOG): (41, '2022-05-01T10:41:00.0000000Z'),
+                                    ('ws01.corp.local', NTLM_LOG): (3, '2022-05-01T10:03:00.0000000Z')})
+        assert state_store.get_watermark(HOST, NTLM_LOG) == (42, '2022-05-01T10:42:00.0000000Z')
+        assert state_store.get_watermark('ws01.corp.local', NTLM_LOG) == (3, '2022-05-01T10:03:00.0000000Z')
+        state_store.set_watermarks({(HOST, NTLM_LOG): (43, '2022-05-01T10:43:00.0000000Z')})
+        assert state_store.get_watermark(HOST, NTLM_LOG) == (43, '2022-05-01T10:43:00.0000000Z')
+
+
+class FailingSink(CsvSink):
+    """
+    CsvSink failing on its second write.
+    """
+    writes = 0
+
+    def writerows(self, rows):
+        if self.writes:
+            raise OSError("No space left on device")
+        self.writes += 1
+        super().writerows(rows)
+
+
+def test_a_failed_run_commits_nothing(tmp_path):
+    sink = FailingSink(str(tmp_path / 'logs.csv'), OUTPUT_HEADER)
+    with StateStore(str(tmp_path / 'collector_state.db')) as state_store, \
+            DedupIndex(str(tmp_path / 'collector_dedup')) as dedup_index:
+        pipeline = ParsePipeline(DOMAIN, sink, processes=0, on_checkpoint=state_store.set_watermarks,
+                                 dedup_index=dedup_index)
+        for record_ids in ([1, 2], [3, 4], [5]):
+            batch = _events(record_ids)
+            pipeline._write(lambda: parse_batch(batch, DOMAIN), (HOST, NTLM_LOG), len(batch))
+        assert pipeline.failed
+        pipeline._checkpoint(final=True)
+        assert state_store.get_watermark(HOST, NTLM_LOG) is None
+        assert dedup_index.conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0] == 0
+    sink.close()